@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+# coding=utf-8
+'''
+Benchmarks for the per-tick hot path.
+
+Runs the real BatteryTaskBarIcon against the stand-in wx in lifesaver.fakewx,
+one update interval at a time, and one headless Daemon tick at a time, against
+a FakeProvider. Needs neither wx nor WMI.
+
+    python -m lifesaver.bench --save before.json
+    python -m lifesaver.bench --compare before.json
+'''
+import gc
+import sys
+import json
+import time
+import logging
+import platform
+import tracemalloc
+
+from lifesaver import fakewx
+from lifesaver import monitor
+from lifesaver.daemon import Daemon
+from lifesaver.fakes import FakePowerPlans, FakeProvider
+from lifesaver.soak import VirtualClock
+
+try:
+    _cpu_clock = time.thread_time
+except AttributeError:
+    _cpu_clock = time.process_time
+
+# metrics where a larger value in the new run is a regression
+COMPARED = ['queries_per_tick', 'wall_us_per_tick', 'cpu_us_per_tick',
+            'alloc_peak_bytes_per_tick', 'time_remaining_us']
+
+
+def make_tray(provider):
+    ''' Returns a started BatteryTaskBarIcon on the stand-in wx, and the virtual
+        clock its timers run on '''
+    clock = VirtualClock()
+    fakewx.install(clock)
+    from lifesaver import ui # imported once the stand-in wx is installed
+    frame = ui.TaskBarFrame(None, 'TaskBarFrame', connections={'battery': lambda: provider,
+                                                               'power plans': FakePowerPlans})
+    tray = frame.tbicon
+    for thread in tray.connector.threads:
+        thread.join()
+    clock.advance(0) # finishes startup, including the first update
+    return tray, clock
+
+
+def make_tray_tick(provider):
+    ''' Returns a tick which advances the tray's clock by one update interval,
+        so that Update and any other timers due run as they would in wx. An
+        update which failed raises IOError, as a failed daemon tick does '''
+    tray, clock = make_tray(provider)
+
+    def tick():
+        failures = fakewx.failures
+        clock.advance(tray.monitor_frequency)
+        if fakewx.failures != failures:
+            raise IOError('Tray update failed')
+    tick.tray = tray
+    return tick
+
+
+def make_daemon_tick(batt_mon):
+    ''' Returns the tick of a headless Daemon with no alert sinks '''
+    return Daemon(batt_mon, sinks=[]).tick
+
+
+def measure(tick, provider, ticks):
+    ''' Times a tick callable. Returns a dict of per-tick costs '''
+    wall = cpu = 0.0
+    failed = 0
+    queries = provider.queries
+    for _i in range(ticks):
+        wall_started = time.perf_counter()
+        cpu_started = _cpu_clock()
+        try:
+            tick()
+        except IOError:
+            failed += 1
+        cpu += _cpu_clock() - cpu_started
+        wall += time.perf_counter() - wall_started
+        provider.advance(2)
+    return {'queries_per_tick': (provider.queries - queries) / float(ticks),
+            'wall_us_per_tick': wall / ticks * 1e6,
+            'cpu_us_per_tick': cpu / ticks * 1e6,
+            'failed_ticks': failed}
+
+
+def measure_allocations(tick, provider, ticks):
+    ''' Runs the tick under tracemalloc, which is too slow to combine with timing.
+        Returns the mean peak bytes allocated within a tick, and the net number of
+        memory blocks left behind by all the ticks '''
+    gc.collect()
+    tracemalloc.start()
+    peak = 0
+    blocks = sys.getallocatedblocks()
+    for _i in range(ticks):
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        try:
+            tick()
+        except IOError:
+            pass
+        peak += tracemalloc.get_traced_memory()[1] - before
+        provider.advance(2)
+    tracemalloc.stop()
+    gc.collect()
+    return {'alloc_peak_bytes_per_tick': peak / float(ticks),
+            'alloc_net_blocks': sys.getallocatedblocks() - blocks}
+
+
+def measure_time_remaining(batt_mon, provider, ticks):
+    provider.unplug()
+    started = time.perf_counter()
+    for _i in range(ticks):
+        try:
+            batt_mon.time_remaining
+        except IOError:
+            pass
+    return {'time_remaining_us': (time.perf_counter() - started) / ticks * 1e6}
+
+
+def run_scenario(kind, batteries, latency, failure_rate, plugged_in, ticks):
+    provider = FakeProvider(batteries=batteries, latency=latency, failure_rate=failure_rate,
+                            plugged_in=plugged_in, charge=0.75)
+    if kind == 'tray':
+        tick = make_tray_tick(provider)
+        batt_mon = tick.tray.batt_mon
+    else:
+        batt_mon = monitor.BatteryMonitor(provider)
+        tick = make_daemon_tick(batt_mon)
+    result = {'kind': kind, 'batteries': batteries, 'latency': latency,
+              'failure_rate': failure_rate, 'plugged_in': plugged_in, 'ticks': ticks}
+    result.update(measure(tick, provider, ticks))
+    provider.latency = 0 # allocations and estimate cost don't depend on backend latency
+    result.update(measure_allocations(tick, provider, min(ticks, 200)))
+    result.update(measure_time_remaining(batt_mon, provider, ticks))
+    return result
+
+
+def scenario_key(result):
+    return '%(kind)s b=%(batteries)i lat=%(latency)g fail=%(failure_rate)g ac=%(plugged_in)i' % result
+
+
+def run(ticks=500, kinds=('tray', 'daemon'), batteries=(1, 2, 8), latencies=(0,),
+        failure_rates=(0, 0.05), power=(False, True)):
+    results = []
+    for kind in kinds:
+        for b in batteries:
+            for latency in latencies:
+                for failure_rate in failure_rates:
+                    for plugged_in in power:
+                        results.append(run_scenario(kind, b, latency, failure_rate,
+                                                    plugged_in, ticks))
+    return {'version': monitor.VERSION_NUMBER, 'python': platform.python_version(),
+            'platform': platform.platform(), 'created': time.time(), 'results': results}
+
+
+def compare(baseline, current, tolerance=0.1):
+    ''' Returns lines comparing two runs, flagging metrics more than tolerance worse '''
+    base = dict((scenario_key(r), r) for r in baseline['results'])
+    lines = []
+    for r in current['results']:
+        key = scenario_key(r)
+        if key not in base:
+            continue
+        for metric in COMPARED:
+            old, new = base[key][metric], r[metric]
+            change = (new - old) / old if old else (0.0 if new == old else float('inf'))
+            flag = '  REGRESSION' if change > tolerance else ''
+            lines.append('%-44s %-26s %12.1f -> %12.1f (%+.0f%%)%s' % (
+                key, metric, old, new, change * 100, flag))
+    return lines
+
+
+def report(data):
+    header = '%-44s %8s %10s %10s %12s %10s %7s' % ('scenario', 'queries', 'wall us',
+                                                     'cpu us', 'alloc bytes', 'est us', 'failed')
+    lines = [header, '-' * len(header)]
+    for r in data['results']:
+        lines.append('%-44s %8.1f %10.1f %10.1f %12.0f %10.1f %7i' % (
+            scenario_key(r), r['queries_per_tick'], r['wall_us_per_tick'], r['cpu_us_per_tick'],
+            r['alloc_peak_bytes_per_tick'], r['time_remaining_us'], r['failed_ticks']))
+    return lines
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(prog='lifesaver.bench', description='Benchmark the monitor tick')
+    parser.add_argument('--ticks', type=int, default=500)
+    parser.add_argument('--kind', nargs='+', default=['tray', 'daemon'], choices=['tray', 'daemon'])
+    parser.add_argument('--batteries', type=int, nargs='+', default=[1, 2, 8])
+    parser.add_argument('--latency', type=float, nargs='+', default=[0],
+                        help='simulated secs per backend query')
+    parser.add_argument('--failure-rate', type=float, nargs='+', default=[0, 0.05])
+    parser.add_argument('--save', metavar='FILE', help='write results as JSON')
+    parser.add_argument('--compare', metavar='FILE', help='compare against saved results')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='relative increase reported as a regression (default: 0.2)')
+    parser.add_argument('--log-level', default='WARNING',
+                        help='logging level while benchmarking (default: WARNING)')
+    args = parser.parse_args(argv)
+    # configured before the tray is imported, so its own logging setup leaves this alone
+    logging.basicConfig(level=args.log_level.upper())
+    logging.getLogger().setLevel(args.log_level.upper())
+    data = run(args.ticks, args.kind, args.batteries, args.latency, args.failure_rate)
+    print('\n'.join(report(data)))
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(data, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            lines = compare(json.load(f), data, args.tolerance)
+        print('\n'.join(lines))
+        if any(line.endswith('REGRESSION') for line in lines):
+            return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
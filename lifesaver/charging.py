@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+# coding=utf-8
+'''
+Charging curve model.
+
+Lithium ion chargers supply a constant current (CC) until the cell reaches its
+charge voltage, then hold that voltage (CV) while the current tapers off. In
+the CV phase the charge rate falls roughly in proportion to the charge still
+missing, so charge approaches full exponentially. ChargeEstimator fits the CC
+rate and the knee where the taper starts from recent samples, updating in
+constant time, and predicts the time to reach any level of charge.
+
+backtest() replays a recorded trace, such as telemetry frames or a battery
+history file, through the estimator and measures its predictions against what
+actually happened. Without a recording, noisy_samples() generates charging
+sessions which deliberately do not follow the estimator's model.
+
+    python -m lifesaver.charging bl_spool/*.frame
+    python -m lifesaver.charging battery.blh
+'''
+import math
+import random
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class ChargeEstimator(object):
+    ''' Incremental estimate of a CC/CV charging curve for one charging session.
+        Capacities are in mWh, rates in mW and times in hours '''
+
+    KNEE = 0.8 # assumed start of the CV phase, until one is observed
+    MIN_KNEE = 0.5
+    TAPER = 0.9 # a rate below this proportion of the CC rate means the taper has begun
+    TERMINATION = 0.05 # chargers stop, and report full, when the rate falls this low
+
+    def __init__(self, alpha=0.2, min_interval=1.0):
+        self.alpha = alpha # smoothing of the fitted CC rate and knee
+        self.min_interval = min_interval # samples closer together than this are ignored
+        self.reset()
+
+    def reset(self):
+        self.cc_rate = None
+        self.knee = self.KNEE
+        self.knee_observed = False
+        self.full = None
+        self.charge = None
+        self.rate = None
+        self.timestamp = None
+        self.samples = 0
+        self._changed_at = None # last time RemainingCapacity changed, and its value
+        self._changed_capacity = None
+
+    def update(self, timestamp, remaining, full, charge_rate):
+        ''' Adds one sample taken while charging '''
+        if not full:
+            return
+        if self.timestamp is not None and timestamp - self.timestamp < self.min_interval:
+            return
+        charge = min(float(remaining) / full, 1.0)
+        rate = float(charge_rate or 0) or self._rate_from_capacity(timestamp, remaining)
+        if remaining != self._changed_capacity:
+            self._changed_at, self._changed_capacity = timestamp, remaining
+        self.timestamp, self.full, self.charge = timestamp, float(full), charge
+        self.samples += 1
+        if not rate or charge >= 1.0:
+            return
+        # reported rates are noisy, so a single low reading must not be taken
+        # as the start of the taper
+        self.rate = rate = self._smooth(self.rate, rate)
+        tapering = self.cc_rate is not None and rate < self.TAPER * self.cc_rate
+        if charge < self.knee and not tapering:
+            self.cc_rate = self._smooth(self.cc_rate, rate)
+        elif self.cc_rate is None:
+            # plugged in part way through the taper: infer the CC rate from the
+            # assumed knee, since rate = cc_rate * (1 - charge) / (1 - knee)
+            self.cc_rate = rate * (1 - self.knee) / (1 - charge)
+        elif tapering:
+            knee = 1 - (1 - charge) * self.cc_rate / rate
+            knee = min(max(knee, self.MIN_KNEE), charge)
+            self.knee = self._smooth(self.knee if self.knee_observed else None, knee)
+            self.knee_observed = True
+        elif charge > self.knee:
+            # still charging at the CC rate, so the knee is higher than thought
+            self.knee = charge
+            self.cc_rate = self._smooth(self.cc_rate, rate)
+
+    def _rate_from_capacity(self, timestamp, remaining):
+        ''' Charge rate implied by the change in capacity since it last changed,
+            for batteries which report a ChargeRate of zero '''
+        if self._changed_at is None or remaining == self._changed_capacity:
+            return 0.0
+        hours = (timestamp - self._changed_at) / 3600.0
+        return max(0.0, (remaining - self._changed_capacity) / hours) if hours > 0 else 0.0
+
+    def _smooth(self, old, new):
+        return new if old is None else old + self.alpha * (new - old)
+
+    @property
+    def phase(self):
+        ''' 'cc', 'cv' or None if there are no samples yet '''
+        if self.charge is None:
+            return None
+        return 'cv' if self.charge >= self.knee else 'cc'
+
+    @property
+    def full_level(self):
+        ''' Proportion of charge at which the charger terminates '''
+        return 1 - self.TERMINATION * (1 - self.knee)
+
+    def time_to(self, target):
+        ''' Returns the predicted hours until charge reaches target, 0 if already
+            there, or None if there is not enough data yet '''
+        if self.charge is None:
+            return None
+        if self.charge >= target:
+            return 0.0
+        if not self.cc_rate:
+            return None
+        target = min(target, self.full_level)
+        charge, knee = self.charge, self.knee
+        hours = 0.0
+        if charge < knee:
+            hours += (min(target, knee) - charge) * self.full / self.cc_rate
+        if target > knee:
+            start = max(charge, knee)
+            tau = self.full * (1 - knee) / self.cc_rate
+            hours += tau * math.log((1 - start) / (1 - target))
+        return max(hours, 0.0)
+
+    def time_to_full(self):
+        return self.time_to(1.0)
+
+
+def sessions(samples):
+    ''' Splits (timestamp, remaining, full, charge_rate, plugged_in) samples into
+        lists of consecutive samples taken on AC '''
+    session = []
+    for sample in samples:
+        if sample[4]:
+            session.append(sample)
+        elif session:
+            yield session
+            session = []
+    if session:
+        yield session
+
+
+def backtest(samples, target=0.8, estimator_factory=ChargeEstimator):
+    ''' Replays each charging session in a trace, comparing the estimator's
+        prediction of the time to reach target after every sample with when the
+        trace actually reached it. Sessions which end before reaching target are
+        skipped. Returns a summary of the errors in minutes '''
+    errors = []
+    by_horizon = {}
+    skipped = 0
+    for session in sessions(samples):
+        reached = next((s[0] for s in session if s[2] and float(s[1]) / s[2] >= target), None)
+        if reached is None:
+            skipped += 1
+            continue
+        estimator = estimator_factory()
+        for timestamp, remaining, full, charge_rate, _plugged_in in session:
+            if timestamp >= reached:
+                break
+            estimator.update(timestamp, remaining, full, charge_rate)
+            predicted = estimator.time_to(target)
+            if predicted is None:
+                continue
+            actual = (reached - timestamp) / 60.0
+            error = predicted * 60 - actual
+            errors.append(error)
+            horizon = _horizon(actual)
+            by_horizon.setdefault(horizon, []).append(error)
+    return {'target': target,
+            'predictions': len(errors),
+            'sessions_skipped': skipped,
+            'mean_abs_error_min': _mean([abs(e) for e in errors]),
+            'bias_min': _mean(errors),
+            'by_horizon': dict((h, {'predictions': len(e), 'mean_abs_error_min': _mean([abs(x) for x in e])})
+                               for h, e in sorted(by_horizon.items()))}
+
+
+HORIZONS = [(10, '<10 min'), (30, '10-30 min'), (60, '30-60 min'), (float('inf'), '>60 min')]
+
+
+def _horizon(minutes):
+    for limit, name in HORIZONS:
+        if minutes < limit:
+            return name
+
+
+def _mean(values):
+    return sum(values) / len(values) if values else 0.0
+
+
+def frame_samples(paths):
+    ''' Reads (timestamp, remaining, full, charge_rate, plugged_in) samples from
+        telemetry frame files, in the order given '''
+    from lifesaver.frames import decode_frame
+    for path in paths:
+        with open(path, 'rb') as f:
+            columns = decode_frame(f.read()).columns
+        for sample in zip(columns['timestamp'], columns['remaining_capacity'],
+                          columns['full_charge_capacity'], columns['charge_rate'],
+                          columns['plugged_in']):
+            yield sample
+
+
+def history_samples(paths):
+    ''' Reads (timestamp, remaining, full, charge_rate, plugged_in) samples from
+        battery history files (see lifesaver.history). Needs NumPy '''
+    from lifesaver.history import HistoryReader
+    for path in paths:
+        with open(path, 'rb') as f:
+            for block in HistoryReader(f):
+                for sample in zip(block['timestamp'].tolist(), block['remaining_capacity'].tolist(),
+                                  block['full_charge_capacity'].tolist(), block['charge_rate'].tolist(),
+                                  block['plugged_in'].tolist()):
+                    yield sample
+
+
+def recorded_samples(paths):
+    ''' Reads samples from telemetry frames and history files, by extension '''
+    for path in paths:
+        if path.endswith('.blh'):
+            for sample in history_samples([path]):
+                yield sample
+        else:
+            for sample in frame_samples([path]):
+                yield sample
+
+
+def simulated_samples(charge=0.2, capacity=50000, charge_rate=25000, cv_knee=0.8,
+                      interval=2, hours=4, start=0.0):
+    ''' Samples of a FakeProvider battery charging with a CC/CV taper. This
+        follows the estimator's own model exactly, so it only checks the
+        arithmetic; use noisy_samples() or a recording to judge accuracy '''
+    from lifesaver.fakes import FakeProvider
+    provider = FakeProvider(capacity=capacity, charge=charge, charge_rate=charge_rate,
+                            cv_knee=cv_knee, plugged_in=True)
+    for i in range(int(hours * 3600 / interval)):
+        status = provider.ExecQuery('Select * from BatteryStatus where Voltage > 0')[0]
+        yield (start + i * interval, status.RemainingCapacity, capacity, status.ChargeRate, True)
+        provider.advance(interval)
+
+
+def noisy_samples(sessions=20, seed=0, capacity=50000, interval=10, start=0.0):
+    ''' Samples of charging sessions which differ from the estimator's model.
+        Each session draws its own CC rate, knee and taper shape: the rate in
+        the CV phase falls as (1 - charge) to a power between 0.6 and 1.6, not
+        linearly. Reported charge rates carry 10% noise, capacity is only
+        reported in 1% steps, and some sessions report no charge rate at all.
+        The charger stops, and reports full, once the rate falls to 5% of the
+        CC rate. Sessions are separated by an unplugged sample '''
+    rng = random.Random(seed)
+    step = capacity / 100.0
+    t = start
+    for _session in range(sessions):
+        cc_rate = capacity * rng.uniform(0.3, 1.0)
+        knee = rng.uniform(0.6, 0.9)
+        power = rng.uniform(0.6, 1.6)
+        reports_rate = rng.random() > 0.3
+        charge = rng.uniform(0.05, 0.6)
+        while True:
+            rate = cc_rate if charge < knee else cc_rate * ((1 - charge) / (1 - knee)) ** power
+            if rate < ChargeEstimator.TERMINATION * cc_rate:
+                yield (t, capacity, capacity, 0, True)
+                break
+            reported = rate * rng.lognormvariate(0, 0.1) if reports_rate else 0
+            yield (t, math.floor(charge * capacity / step) * step, capacity, reported, True)
+            charge += rate * interval / 3600.0 / capacity
+            t += interval
+        yield (t + interval, capacity, capacity, 0, False)
+        t += 3600
+
+
+def main(argv=None):
+    import json
+    import argparse
+    parser = argparse.ArgumentParser(prog='lifesaver.charging',
+                                     description='Backtest the charging time estimate')
+    parser.add_argument('files', nargs='*',
+                        help='telemetry frame or .blh history files; simulated noisy sessions if none')
+    parser.add_argument('--target', type=float, action='append',
+                        help='proportion of charge to predict (default: 0.8 and 1.0)')
+    parser.add_argument('--seed', type=int, default=0, help='seed for the simulated sessions')
+    args = parser.parse_args(argv)
+    for target in args.target or [0.8, 1.0]:
+        samples = recorded_samples(args.files) if args.files else noisy_samples(seed=args.seed)
+        if target >= 1.0:
+            target = ChargeEstimator().full_level
+        print(json.dumps(backtest(samples, target), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,399 @@
+#!/usr/bin/env python
+# coding=utf-8
+'''
+Fleet telemetry collector.
+
+Accepts frames from TelemetryAgents over HTTP, using asyncio so thousands of
+devices can upload concurrently, and keeps them in a per-device index split
+into fixed-length time partitions. Each partition stores its samples as
+columns of arrays, so ingesting a frame extends arrays and no object is built
+per sample.
+
+    python -m lifesaver.collector serve --port 8470
+    python -m lifesaver.collector bench --devices 2000
+'''
+import json
+import time
+import asyncio
+import logging
+from array import array
+from bisect import bisect_left
+from urllib.parse import urlsplit, parse_qs
+
+from lifesaver.frames import COLUMNS, FrameError, encode_frame, decode_frame
+
+logger = logging.getLogger(__name__)
+
+
+class Partition(object):
+    ''' Samples for one device within one time window, as parallel arrays '''
+
+    __slots__ = ['start', 'columns']
+
+    def __init__(self, start):
+        self.start = start
+        self.columns = dict((name, array(typecode)) for name, typecode in COLUMNS)
+
+    def extend(self, columns, lo, hi):
+        for name, column in self.columns.items():
+            column.extend(columns[name][lo:hi])
+
+    def __len__(self):
+        return len(self.columns['timestamp'])
+
+
+class Device(object):
+    ''' A device's partitions, plus running values that queries are answered from '''
+
+    __slots__ = ['device_id', 'partitions', 'last_seen', 'charge', 'plugged_in',
+                 'full_charge_capacity', 'peak_full_charge_capacity', 'events']
+
+    def __init__(self, device_id):
+        self.device_id = device_id
+        self.partitions = {}
+        self.last_seen = 0.0
+        self.charge = None
+        self.plugged_in = None
+        self.full_charge_capacity = 0
+        self.peak_full_charge_capacity = 0
+        self.events = 0
+
+    @property
+    def capacity_fade(self):
+        ''' Loss of full charge capacity relative to the most seen for this device '''
+        if not self.peak_full_charge_capacity:
+            return 0.0
+        return 1.0 - self.full_charge_capacity / float(self.peak_full_charge_capacity)
+
+
+class TimeSeriesIndex(object):
+    ''' Per-device, time-partitioned columnar store '''
+
+    def __init__(self, partition_secs=3600, retention_secs=30 * 86400):
+        self.partition_secs = partition_secs
+        self.retention_secs = retention_secs
+        self.devices = {}
+        self.samples = 0
+        self.frames = 0
+
+    def ingest(self, frame):
+        ''' Adds a decoded Frame. Samples out of time order, as after the
+            device's clock was set back, are sorted first, since partitions
+            are searched by timestamp '''
+        if frame.count == 0 and not frame.events:
+            return
+        device = self.devices.get(frame.device_id)
+        if device is None:
+            device = self.devices[frame.device_id] = Device(frame.device_id)
+        columns = frame.columns
+        timestamps = columns['timestamp']
+        if any(timestamps[i] > timestamps[i + 1] for i in range(frame.count - 1)):
+            order = sorted(range(frame.count), key=timestamps.__getitem__)
+            columns = dict((name, array(column.typecode, [column[i] for i in order]))
+                           for name, column in columns.items())
+            timestamps = columns['timestamp']
+        lo = 0
+        while lo < frame.count:
+            start = timestamps[lo] - timestamps[lo] % self.partition_secs
+            hi = bisect_left(timestamps, start + self.partition_secs, lo)
+            partition = device.partitions.get(start)
+            if partition is None:
+                partition = device.partitions[start] = Partition(start)
+            partition.extend(columns, lo, hi)
+            lo = hi
+        if frame.count:
+            last = frame.count - 1
+            full = columns['full_charge_capacity']
+            device.last_seen = max(device.last_seen, timestamps[last])
+            device.full_charge_capacity = full[last]
+            device.peak_full_charge_capacity = max(device.peak_full_charge_capacity, max(full))
+            if full[last]:
+                device.charge = min(columns['remaining_capacity'][last] / float(full[last]), 1.0)
+            device.plugged_in = bool(columns['plugged_in'][last])
+        device.events += len(frame.events)
+        self.samples += frame.count
+        self.frames += 1
+
+    def expire(self, now=None):
+        ''' Drops partitions older than the retention period '''
+        cutoff = (now if now is not None else time.time()) - self.retention_secs
+        for device in self.devices.values():
+            for start in [s for s in device.partitions if s + self.partition_secs < cutoff]:
+                del device.partitions[start]
+
+    def capacity_fade(self, threshold=0.2):
+        ''' Returns {device id: fade} for devices whose capacity fade exceeds threshold '''
+        return dict((d.device_id, d.capacity_fade) for d in self.devices.values()
+                    if d.capacity_fade > threshold)
+
+    def charge_distribution(self, bins=10, max_age=None, now=None):
+        ''' Returns a histogram of the latest charge of each device seen within max_age
+            secs, as a list of counts over equal-width bins from 0% to 100% '''
+        counts = [0] * bins
+        cutoff = None
+        if max_age is not None:
+            cutoff = (now if now is not None else time.time()) - max_age
+        for d in self.devices.values():
+            if d.charge is None or (cutoff is not None and d.last_seen < cutoff):
+                continue
+            counts[min(int(d.charge * bins), bins - 1)] += 1
+        return counts
+
+    def series(self, device_id, column, start=None, end=None):
+        ''' Returns an array of one column for a device between start and end '''
+        device = self.devices.get(device_id)
+        typecode = dict(COLUMNS)[column]
+        result = array(typecode)
+        if device is None:
+            return result
+        for partition_start in sorted(device.partitions):
+            if start is not None and partition_start + self.partition_secs <= start:
+                continue
+            if end is not None and partition_start >= end:
+                break
+            partition = device.partitions[partition_start]
+            timestamps = partition.columns['timestamp']
+            lo = bisect_left(timestamps, start) if start is not None else 0
+            hi = bisect_left(timestamps, end) if end is not None else len(timestamps)
+            result.extend(partition.columns[column][lo:hi])
+        return result
+
+
+class BadRequest(ValueError):
+    pass
+
+
+class Collector(object):
+    ''' asyncio HTTP/1.1 server in front of a TimeSeriesIndex. Partitions past
+        the index's retention period are dropped every expire_interval secs.
+
+        POST /ingest          body is a frame
+        GET  /query/fade      ?threshold=0.2
+        GET  /query/charge    ?bins=10&max_age=900
+        GET  /stats
+    '''
+
+    MAX_BODY = 4 * 1024 * 1024
+    MAX_BINS = 1000
+
+    def __init__(self, index=None, host='0.0.0.0', port=8470, expire_interval=600):
+        self.index = index or TimeSeriesIndex()
+        self.host = host
+        self.port = port
+        self.expire_interval = expire_interval
+        self.server = None
+        self.expiry = None
+        self.rejected = 0
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.expiry = asyncio.ensure_future(self.expire_periodically())
+        logger.info('Collector listening on %s:%i', self.host, self.port)
+        return self
+
+    async def stop(self):
+        self.expiry.cancel()
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def expire_periodically(self):
+        while True:
+            await asyncio.sleep(self.expire_interval)
+            started = time.perf_counter()
+            self.index.expire()
+            logger.debug('Expired old partitions in %.1f ms', (time.perf_counter() - started) * 1000)
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b'\r\n\r\n')
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                lines = head.decode('latin-1').split('\r\n')
+                request_line = lines[0].split(' ')
+                if len(request_line) < 3:
+                    await self.respond(writer, 400, b'')
+                    break
+                method, target = request_line[:2]
+                headers = dict((k.strip().lower(), v.strip()) for k, _sep, v in
+                               (line.partition(':') for line in lines[1:] if line))
+                try:
+                    length = int(headers.get('content-length', 0))
+                except ValueError:
+                    length = -1
+                if length < 0:
+                    await self.respond(writer, 400, b'')
+                    break
+                if length > self.MAX_BODY:
+                    await self.respond(writer, 413, b'')
+                    break
+                body = await reader.readexactly(length) if length else b''
+                status, payload = self.route(method, target, body)
+                await self.respond(writer, status, payload)
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        finally:
+            writer.close()
+
+    def route(self, method, target, body):
+        url = urlsplit(target)
+        query = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+        if method == 'POST' and url.path == '/ingest':
+            try:
+                self.index.ingest(decode_frame(body))
+            except FrameError as e:
+                self.rejected += 1
+                logger.warning('Rejected frame: %s', e)
+                return 400, str(e).encode('utf-8')
+            return 204, b''
+        if method != 'GET':
+            return 405, b''
+        try:
+            if url.path == '/query/fade':
+                result = self.index.capacity_fade(self._param(query, 'threshold', float, 0.2))
+            elif url.path == '/query/charge':
+                bins = self._param(query, 'bins', int, 10)
+                if not 1 <= bins <= self.MAX_BINS:
+                    raise BadRequest('bins must be between 1 and %i' % self.MAX_BINS)
+                result = self.index.charge_distribution(bins, self._param(query, 'max_age', float, None))
+            elif url.path == '/stats':
+                result = {'devices': len(self.index.devices), 'samples': self.index.samples,
+                          'frames': self.index.frames, 'rejected': self.rejected}
+            else:
+                return 404, b''
+        except BadRequest as e:
+            return 400, json.dumps({'error': str(e)}).encode('utf-8')
+        return 200, json.dumps(result).encode('utf-8')
+
+    @staticmethod
+    def _param(query, name, convert, default):
+        value = query.get(name)
+        if not value:
+            return default
+        try:
+            return convert(value)
+        except ValueError:
+            raise BadRequest('Invalid %s: %r' % (name, value))
+
+    async def respond(self, writer, status, payload):
+        reasons = {200: 'OK', 204: 'No Content', 400: 'Bad Request', 404: 'Not Found',
+                   405: 'Method Not Allowed', 413: 'Payload Too Large'}
+        head = 'HTTP/1.1 %i %s\r\nContent-Length: %i\r\n' % (status, reasons[status], len(payload))
+        if payload:
+            head += 'Content-Type: application/json\r\n'
+        writer.write(head.encode('latin-1') + b'\r\n' + payload)
+        await writer.drain()
+
+
+def synthetic_frames(devices, frames_per_device, samples_per_frame, interval=2.0, start=None):
+    ''' Pre-encodes frames from simulated devices for load generation, as one list
+        of frames per device. Each device reports its full design capacity in its
+        first frame and a device-specific amount of capacity fade afterwards '''
+    start = start if start is not None else time.time() - frames_per_device * samples_per_frame * interval
+    fleet = []
+    for d in range(devices):
+        faded = 50000 - (d * 7919) % 15000
+        remaining = faded
+        t = start
+        frames = []
+        for f in range(frames_per_device):
+            full = 50000 if f == 0 else faded
+            columns = dict((name, array(typecode)) for name, typecode in COLUMNS)
+            for _s in range(samples_per_frame):
+                remaining = max(0, remaining - 5 - d % 11)
+                columns['timestamp'].append(t)
+                columns['remaining_capacity'].append(remaining)
+                columns['full_charge_capacity'].append(full)
+                columns['discharge_rate'].append(9000 + d % 11 * 1000)
+                columns['charge_rate'].append(0)
+                columns['plugged_in'].append(0)
+                t += interval
+            frames.append(encode_frame('device-%05i' % d, columns))
+        fleet.append(frames)
+    return fleet
+
+
+async def load_generator(host, port, fleet, connections=200):
+    ''' Posts each device's frames in order, spreading devices over concurrent
+        keep-alive connections. Returns elapsed secs '''
+    queue = asyncio.Queue()
+    for frames in fleet:
+        queue.put_nowait(frames)
+
+    async def worker():
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            while not queue.empty():
+                for frame in queue.get_nowait():
+                    writer.write(b'POST /ingest HTTP/1.1\r\nHost: %s\r\nContent-Length: %i\r\n\r\n'
+                                 % (host.encode('ascii'), len(frame)) + frame)
+                    head = await reader.readuntil(b'\r\n\r\n')
+                    if not head.startswith(b'HTTP/1.1 204'):
+                        raise IOError('Collector rejected frame: %r' % head)
+        finally:
+            writer.close()
+
+    started = time.perf_counter()
+    await asyncio.gather(*[worker() for _i in range(connections)])
+    return time.perf_counter() - started
+
+
+async def benchmark(devices=2000, frames_per_device=5, samples_per_frame=150, connections=200):
+    ''' Runs a collector and a load generator in one process and reports the
+        sustained ingest rate and query latency '''
+    logger.info('Encoding %i frames', devices * frames_per_device)
+    fleet = synthetic_frames(devices, frames_per_device, samples_per_frame)
+    collector = await Collector(host='127.0.0.1', port=0).start()
+    try:
+        elapsed = await load_generator('127.0.0.1', collector.port, fleet, connections)
+    finally:
+        await collector.stop()
+    index = collector.index
+    timings = {}
+    for name, query in [('capacity_fade', lambda: index.capacity_fade(0.2)),
+                        ('charge_distribution', lambda: index.charge_distribution())]:
+        started = time.perf_counter()
+        query()
+        timings[name] = (time.perf_counter() - started) * 1000
+    return {'devices': len(index.devices), 'frames': index.frames, 'samples': index.samples,
+            'elapsed_secs': elapsed, 'frames_per_sec': index.frames / elapsed,
+            'samples_per_sec': index.samples / elapsed,
+            'bytes_ingested': sum(len(f) for frames in fleet for f in frames), 'query_ms': timings,
+            'devices_with_fade_over_20pct': len(index.capacity_fade(0.2))}
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(prog='lifesaver.collector',
+                                     description='Battery Lifesaver fleet telemetry collector')
+    sub = parser.add_subparsers(dest='command', required=True)
+    serve = sub.add_parser('serve', help='run the collector')
+    serve.add_argument('--host', default='0.0.0.0')
+    serve.add_argument('--port', type=int, default=8470)
+    bench = sub.add_parser('bench', help='measure sustained ingest rate against a local collector')
+    bench.add_argument('--devices', type=int, default=2000)
+    bench.add_argument('--frames-per-device', type=int, default=5)
+    bench.add_argument('--samples-per-frame', type=int, default=150)
+    bench.add_argument('--connections', type=int, default=200)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    if args.command == 'bench':
+        result = asyncio.run(benchmark(args.devices, args.frames_per_device,
+                                       args.samples_per_frame, args.connections))
+        print(json.dumps(result, indent=2))
+        return
+
+    async def serve_forever():
+        collector = await Collector(host=args.host, port=args.port).start()
+        async with collector.server:
+            await collector.server.serve_forever()
+    try:
+        asyncio.run(serve_forever())
+    except KeyboardInterrupt:
+        logger.info('Closing collector')
+
+
+if __name__ == '__main__':
+    main()
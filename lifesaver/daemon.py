@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+# coding=utf-8
+'''
+Headless battery monitor.
+
+Runs the same sampling and alert logic as the notification area icon without
+importing wx or decoding icons. Alerts are passed to one or more sinks, which
+are any callables taking an Alert.
+'''
+import sys
+import time
+import logging
+import platform
+import importlib
+import logging.handlers
+
+from lifesaver import monitor
+from lifesaver.instrument import Instrumentation
+from lifesaver.resume import SuspendDetector
+from lifesaver.startup import TIMELINE
+
+logger = logging.getLogger(__name__)
+
+
+def stdout_sink(alert):
+    ''' Writes an alert to stdout '''
+    sys.stdout.write('%s: %s\n' % (alert.title, alert.message))
+    sys.stdout.flush()
+
+
+class SyslogSink(object):
+    ''' Sends alerts to the local syslog daemon '''
+
+    def __init__(self, address=None):
+        if address is None:
+            address = '/dev/log' if sys.platform.startswith('linux') else ('localhost', 514)
+        self.handler = logging.handlers.SysLogHandler(address=address)
+        self.handler.ident = 'lifesaver: '
+        self.handler.setFormatter(logging.Formatter('%(message)s'))
+
+    def __call__(self, alert):
+        record = logging.LogRecord('lifesaver', logging.WARNING, __file__, 0,
+                                   '%s: %s', (alert.title, alert.message), None)
+        self.handler.emit(record)
+
+
+def load_hook(spec):
+    ''' Resolves a MODULE:FUNCTION string to a callable '''
+    module_name, _sep, attr = spec.partition(':')
+    if not attr:
+        raise ValueError('Hook must be given as MODULE:FUNCTION, not %r' % spec)
+    return getattr(importlib.import_module(module_name), attr)
+
+
+class Daemon(object):
+    ''' Samples the battery monitor on a fixed interval and dispatches alerts.
+        Each tick mirrors BatteryTaskBarIcon.Update, minus the icon '''
+
+    def __init__(self, batt_mon, sinks=(stdout_sink,), monitor_frequency=2,
+                 full_charge_reminder_frequency=300, clock=time.time, sleep=time.sleep,
+                 observers=(), tick_listeners=(), instrumentation=None, unplug_backstop=60,
+                 resume_listeners=(), suspend_detector=None, alert_repeat=None, monotonic=None):
+        self.batt_mon = batt_mon
+        self.instrumentation = instrumentation or Instrumentation(batt_mon)
+        self.sinks = list(sinks)
+        self.observers = list(observers) # callables given a Snapshot each tick
+        self.tick_listeners = list(tick_listeners) # callables given each tick's duration (secs)
+        self.resume_listeners = list(resume_listeners) # callables given each resume.Gap
+        self.monitor_frequency = monitor_frequency # how often to check levels (secs)
+        self.full_charge_reminder_frequency = full_charge_reminder_frequency # secs
+        self.clock = clock
+        self.sleep = sleep
+        # times the sleep between ticks, so stepping the wall clock does not
+        # stretch or skip it. A substitute clock is used as it is
+        if monotonic is None:
+            monotonic = time.monotonic if clock is time.time else clock
+        self.monotonic = monotonic
+        self.last_full_charge_check = clock()
+        self.suspend_detector = suspend_detector or SuspendDetector.for_clock(monitor_frequency, clock)
+        # while charging, the unplug alert is armed for when the charging curve
+        # predicts UNPLUG_LEVEL, and alerts are not checked before then except
+        # every unplug_backstop secs in case the prediction is too late. The
+        # prediction is also only refreshed every unplug_backstop secs
+        self.unplug_backstop = unplug_backstop
+        self.unplug_due = None
+        self.last_armed = None
+        self.last_alert_check = None
+        # an unplug or plug in alert is raised once when its condition is first
+        # met, then repeated every alert_repeat secs for as long as it holds
+        self.alert_repeat = alert_repeat if alert_repeat is not None else full_charge_reminder_frequency
+        self.last_raised = {}
+        self.plugged_in = None
+
+    def tick(self):
+        ''' Runs one monitoring pass and returns the alerts raised '''
+        logger.debug('Updating')
+        instrumentation = self.instrumentation
+        with instrumentation.tick():
+            gap = self.suspend_detector.check()
+            if gap is not None:
+                self.resumed(gap)
+            with instrumentation.phase('reset_alerts'):
+                plugged_in = self.batt_mon.reset_alerts_based_on_power_status()
+            if plugged_in != self.plugged_in:
+                self.plugged_in = plugged_in
+                self.last_raised.clear()
+            now = self.clock()
+            if not plugged_in:
+                self.unplug_due = self.last_armed = None
+            elif self.arming_due(now):
+                with instrumentation.phase('arm_unplug'):
+                    self.batt_mon.sample_charging()
+                    self.arm_unplug_alert(now)
+            if self.alerts_due(now):
+                self.last_alert_check = now
+                with instrumentation.phase('check_alerts'):
+                    alerts = self.limit_repeats(now, self.batt_mon.check_alerts())
+            else:
+                alerts = []
+            if now - self.last_full_charge_check >= self.full_charge_reminder_frequency:
+                self.last_full_charge_check = now
+                with instrumentation.phase('check_fully_charged'):
+                    alert = self.batt_mon.check_fully_charged()
+                if alert is not None:
+                    alerts.append(alert)
+            with instrumentation.phase('dispatch'):
+                for alert in alerts:
+                    self.dispatch(alert)
+            if self.observers:
+                with instrumentation.phase('observers'):
+                    self.observe(self.batt_mon.snapshot())
+        return alerts
+
+    def resumed(self, gap):
+        ''' Resets the monitor's estimates and the unplug alert arming after a
+            suspend. Missed ticks are not replayed; this tick stands for them.
+            A clock step resets nothing, but is still passed to the listeners '''
+        if gap.suspended:
+            self.batt_mon.resumed(gap)
+            self.unplug_due = self.last_armed = None
+            self.last_alert_check = None
+        for listener in self.resume_listeners:
+            try:
+                listener(gap)
+            except Exception:
+                logger.exception('Resume listener %r failed', listener)
+
+    def arming_due(self, now):
+        ''' The charging estimate is sampled on plugging in, then every
+            unplug_backstop secs '''
+        return self.last_armed is None or now - self.last_armed >= self.unplug_backstop
+
+    def arm_unplug_alert(self, now):
+        ''' Sets unplug_due from the latest charging estimate, or None if there
+            is none '''
+        self.last_armed = now
+        hours = self.batt_mon.time_to_unplug()
+        unplug_due = None if hours is None else now + hours * 3600
+        if unplug_due is not None and self.unplug_due is None:
+            logger.info('Unplug alert armed for %s', time.strftime('%H:%M', time.localtime(unplug_due)))
+        self.unplug_due = unplug_due
+
+    def alerts_due(self, now):
+        ''' On battery, or without a charging estimate, alerts are checked every
+            tick. While charging, once when the unplug alert comes due and then
+            every unplug_backstop secs '''
+        if self.unplug_due is None or self.last_alert_check is None:
+            return True
+        due = self.unplug_due - 2 * self.monitor_frequency
+        return ((now >= due and self.last_alert_check < due) or
+                now - self.last_alert_check >= self.unplug_backstop)
+
+    def limit_repeats(self, now, alerts):
+        ''' Returns the alerts which are new, or have held for alert_repeat secs
+            since they were last raised '''
+        kinds = set(alert.kind for alert in alerts)
+        for kind in list(self.last_raised):
+            if kind not in kinds:
+                del self.last_raised[kind]
+        raised = []
+        for alert in alerts:
+            last = self.last_raised.get(alert.kind)
+            if last is None or now - last >= self.alert_repeat:
+                self.last_raised[alert.kind] = now
+                raised.append(alert)
+        return raised
+
+    def observe(self, snapshot):
+        for observer in self.observers:
+            try:
+                observer(snapshot)
+            except Exception:
+                logger.exception('Snapshot observer %r failed', observer)
+
+    def dispatch(self, alert):
+        for sink in self.sinks:
+            try:
+                sink(alert)
+            except Exception:
+                logger.exception('Alert sink %r failed', sink)
+
+    def run(self, max_ticks=None):
+        ''' Ticks until interrupted, or until max_ticks have run '''
+        ticks = 0
+        while max_ticks is None or ticks < max_ticks:
+            started = self.monotonic()
+            tick_started = time.perf_counter()
+            try:
+                self.tick()
+            except Exception:
+                logger.exception('Monitor tick failed')
+            duration = time.perf_counter() - tick_started
+            for listener in self.tick_listeners:
+                listener(duration)
+            ticks += 1
+            self.sleep(max(0, self.monitor_frequency - (self.monotonic() - started)))
+
+
+def install_exit_handler():
+    ''' Makes SIGTERM exit the way Ctrl+C does, so buffered telemetry and
+        history are written out when a service manager stops the daemon '''
+    import signal
+
+    def terminate(signum, frame):
+        raise SystemExit(128 + signum)
+
+    signal.signal(signal.SIGTERM, terminate)
+
+
+def main(args):
+    ''' Starts the daemon from parsed command line arguments '''
+    logging.getLogger().setLevel(args.log_level.upper())
+    sinks = []
+    for name in args.alert or ['stdout']:
+        sinks.append(stdout_sink if name == 'stdout' else SyslogSink())
+    sinks.extend(load_hook(spec) for spec in args.hook)
+    observers = []
+    resume_listeners = []
+    agent = None
+    if args.telemetry:
+        from lifesaver.telemetry import TelemetryAgent, HTTPTransport
+        agent = TelemetryAgent(args.device_id or platform.node(),
+                               HTTPTransport(args.telemetry), spool_dir=args.spool_dir,
+                               background=True)
+        sinks.append(agent.add_alert)
+        observers.append(agent.add_sample)
+        resume_listeners.append(agent.add_gap)
+    if args.governor:
+        from lifesaver.governor import Governor, default_backend
+        governor = Governor(default_backend())
+        observers.append(governor)
+        resume_listeners.append(governor.resumed)
+    history = None
+    if args.history:
+        from lifesaver.history import HistoryWriter
+        history = HistoryWriter.open(args.history)
+        observers.append(history)
+        resume_listeners.append(history.mark_gap)
+    tick_listeners = []
+    if args.metrics_port:
+        from lifesaver.metrics import MetricsExporter, MetricsServer
+        exporter = MetricsExporter(telemetry=agent.overhead if agent is not None else None)
+        sinks.append(exporter.record_alert)
+        observers.append(exporter.observe)
+        tick_listeners.append(exporter.record_tick)
+        MetricsServer(exporter, args.metrics_host, args.metrics_port).start()
+    with TIMELINE.span('open battery connection'):
+        batt_mon = monitor.BatteryMonitor()
+    TIMELINE.log()
+    instrumentation = Instrumentation(batt_mon, enabled=args.instrument or args.profile)
+    if args.profile:
+        instrumentation.start_profiler()
+    instrumentation.install_signal_handlers(args.instrument_dump)
+    install_exit_handler()
+    daemon = Daemon(batt_mon, sinks, monitor_frequency=args.interval,
+                    observers=observers, tick_listeners=tick_listeners,
+                    instrumentation=instrumentation, resume_listeners=resume_listeners)
+    logger.info('Running headless with %i alert sink(s)', len(sinks))
+    try:
+        daemon.run()
+    except (KeyboardInterrupt, SystemExit):
+        logger.info('Closing application')
+    finally:
+        if agent is not None:
+            try:
+                agent.close(timeout=15) # spools what has not been sent
+            except Exception:
+                logger.exception('Failed to flush telemetry on exit')
+            agent.log_overhead()
+        if history is not None:
+            history.close()
+        if instrumentation.enabled:
+            instrumentation.stop_profiler()
+            instrumentation.dump(args.instrument_dump)
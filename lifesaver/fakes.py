@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# coding=utf-8
+'''
+Scriptable fake battery backend.
+
+FakeProvider answers the same ExecQuery calls as WMI and SysfsProvider, from
+simulated batteries whose state can be advanced in time, plugged in and
+unplugged. Per-query latency and a random failure rate can be configured, and
+every query is counted. FakePowerPlans stands in for the power plans
+namespace. Used by the benchmarks and soak tests so they run without WMI or
+real batteries.
+'''
+import time
+import random
+
+from lifesaver.sysfs import Record
+
+
+class FakeQueryError(IOError):
+    pass
+
+
+class FakeBattery(object):
+    ''' One simulated battery. Capacities are in mWh and rates in mW. If cv_knee
+        is set, charging tapers linearly to zero above that proportion of charge,
+        like the constant voltage phase of a real charger '''
+
+    def __init__(self, capacity=50000, charge=0.5, discharge_rate=10000, charge_rate=25000,
+                 cv_knee=None):
+        self.full_charge_capacity = capacity
+        self.remaining_capacity = capacity * charge
+        self.discharge_rate = discharge_rate
+        self.charge_rate = charge_rate
+        self.cv_knee = cv_knee
+
+    def current_charge_rate(self):
+        charge = self.remaining_capacity / float(self.full_charge_capacity)
+        if self.cv_knee is None or charge <= self.cv_knee:
+            return self.charge_rate
+        return self.charge_rate * max(0.0, 1.0 - charge) / (1.0 - self.cv_knee)
+
+
+class FakeProvider(object):
+    ''' Drop-in replacement for the WMI root/wmi namespace used by BatteryMonitor '''
+
+    def __init__(self, batteries=1, capacity=50000, charge=0.5, plugged_in=False,
+                 discharge_rate=10000, charge_rate=25000, latency=0, failure_rate=0,
+                 seed=0, sleep=time.sleep, cv_knee=None):
+        self.batteries = [FakeBattery(capacity, charge, discharge_rate, charge_rate, cv_knee)
+                          for _i in range(batteries)]
+        self.plugged_in = plugged_in
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.sleep = sleep
+        self.queries = 0
+        self.failures = 0
+
+    def ExecQuery(self, query):
+        self.queries += 1
+        if self.latency:
+            self.sleep(self.latency)
+        if self.failure_rate and self.random.random() < self.failure_rate:
+            self.failures += 1
+            raise FakeQueryError('Simulated failure of %r' % query)
+        if 'BatteryFullChargedCapacity' in query:
+            return [Record(FullChargedCapacity=int(b.full_charge_capacity)) for b in self.batteries]
+        if 'BatteryStatus' in query:
+            return [self._status(b) for b in self.batteries]
+        raise ValueError('Unsupported query: %s' % query)
+
+    def _status(self, battery):
+        charging = self.plugged_in and battery.remaining_capacity < battery.full_charge_capacity
+        return Record(PowerOnline=self.plugged_in,
+                      Charging=charging,
+                      Discharging=not self.plugged_in,
+                      RemainingCapacity=int(battery.remaining_capacity),
+                      DischargeRate=0 if self.plugged_in else battery.discharge_rate,
+                      ChargeRate=int(battery.current_charge_rate()) if charging else 0,
+                      Voltage=12000)
+
+    def plug_in(self):
+        self.plugged_in = True
+
+    def unplug(self):
+        self.plugged_in = False
+
+    def advance(self, seconds):
+        ''' Charges or discharges every battery for the given number of seconds '''
+        hours = seconds / 3600.0
+        for b in self.batteries:
+            if self.plugged_in:
+                b.remaining_capacity = min(b.full_charge_capacity,
+                                           b.remaining_capacity + b.current_charge_rate() * hours)
+            else:
+                b.remaining_capacity = max(0, b.remaining_capacity - b.discharge_rate * hours)
+
+
+class FakePowerPlans(object):
+    ''' Drop-in replacement for the WMI root/cimv2/power namespace. plans are
+        (GUID, name) pairs, Windows' own three by default '''
+
+    PLANS = [('a1841308-3541-4fab-bc81-f71556f20b4a', 'Power saver'),
+             ('381b4222-f694-41f0-9685-ff5bb260df2e', 'Balanced'),
+             ('8c5e7fda-e8bf-4a96-9a85-a6e23a8c635c', 'High performance')]
+
+    def __init__(self, plans=None, active=None):
+        self.plans = list(plans or self.PLANS)
+        self.active = active or self.plans[min(1, len(self.plans) - 1)][0]
+
+    def Win32_PowerPlan(self, IsActive=None):
+        plans = [Record(InstanceID='Microsoft:PowerPlan\\{%s}' % guid, ElementName=name,
+                        IsActive=guid == self.active) for guid, name in self.plans]
+        if IsActive is not None:
+            plans = [p for p in plans if p.IsActive == IsActive]
+        return plans
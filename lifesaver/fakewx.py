@@ -0,0 +1,386 @@
+#!/usr/bin/env python
+# coding=utf-8
+'''
+Stand-in wx and winsound modules.
+
+install(clock) puts them in sys.modules so that lifesaver.ui can be imported
+and the real BatteryTaskBarIcon, LeftClickFrame and TaskBarFrame driven
+without a display, as the soak test and benchmarks do. wx.CallLater and
+wx.CallAfter schedule on clock, which needs call_later(secs, callback)
+returning a timer with restart(secs) and cancel(), such as soak.VirtualClock.
+Like wx, an exception in a timer callback or event handler is logged rather
+than propagated.
+
+Windows and controls are plain objects that only keep what was set on them.
+A destroyed window is falsy, as in wxPython, and live_windows() counts those
+not yet destroyed. Embedded images are base64 decoded when an icon or bitmap
+is asked for, so decoding costs about what it does in wx.
+'''
+import sys
+import types
+import base64
+import logging
+import itertools
+
+logger = logging.getLogger(__name__)
+
+_clock = None
+_ids = itertools.count(1000)
+_live = set()
+failures = 0 # callbacks and event handlers which raised
+
+ID_ANY = -1
+ID_ABOUT = 5014
+ID_EXIT = 5006
+ART_INFORMATION, ART_WARNING, ART_OTHER = 'wxART_INFORMATION', 'wxART_WARNING', 'wxART_OTHER'
+FRAME_NO_TASKBAR, CAPTION, RB_GROUP = 0x2, 0x20000000, 0x4
+VERTICAL, HORIZONTAL = 0x8, 0x4
+LEFT, RIGHT, TOP, BOTTOM, CENTER = 0x10, 0x20, 0x40, 0x80, 0x100
+
+
+def NewId():
+    return next(_ids)
+
+
+def _call(callback, *args, **kwargs):
+    global failures
+    try:
+        callback(*args, **kwargs)
+    except Exception:
+        failures += 1
+        logger.info('Unhandled exception in wx callback %r', callback, exc_info=True)
+
+
+class CallLater(object):
+    ''' One-shot timer on the installed clock, taking milliseconds as wx does '''
+
+    def __init__(self, millis, callback, *args, **kwargs):
+        self.millis = millis
+        self.callback = callback
+        self.args = args
+        self.kwargs = kwargs
+        self.running = False
+        self.timer = _clock.call_later(millis / 1000.0, self._fire)
+        self.running = True
+
+    def _fire(self):
+        self.running = False
+        _call(self.callback, *self.args, **self.kwargs)
+
+    def Restart(self, millis=None, *args, **kwargs):
+        if millis is not None:
+            self.millis = millis
+        if args or kwargs:
+            self.args, self.kwargs = args, kwargs
+        self.timer.restart(self.millis / 1000.0)
+        self.running = True
+
+    def Stop(self):
+        self.timer.cancel()
+        self.running = False
+
+    def IsRunning(self):
+        return self.running
+
+
+def CallAfter(callback, *args, **kwargs):
+    _clock.call_later(0, lambda: _call(callback, *args, **kwargs))
+
+
+class PyEventBinder(object):
+
+    def __init__(self, name):
+        self.name = name
+
+    def __call__(self, window, handler):
+        window.Bind(self, handler)
+
+
+EVT_TASKBAR_LEFT_UP = PyEventBinder('EVT_TASKBAR_LEFT_UP')
+EVT_TASKBAR_RIGHT_UP = PyEventBinder('EVT_TASKBAR_RIGHT_UP')
+EVT_MENU = PyEventBinder('EVT_MENU')
+EVT_ACTIVATE = PyEventBinder('EVT_ACTIVATE')
+EVT_HYPERLINK = PyEventBinder('EVT_HYPERLINK')
+EVT_RADIOBUTTON = PyEventBinder('EVT_RADIOBUTTON')
+EVT_POWER_RESUME = PyEventBinder('EVT_POWER_RESUME')
+
+
+class Event(object):
+
+    def __init__(self, active=True, event_object=None):
+        self.active = active
+        self.EventObject = event_object
+        self.skipped = False
+
+    def GetActive(self):
+        return self.active
+
+    def Skip(self):
+        self.skipped = True
+
+
+class EvtHandler(object):
+
+    def __init__(self):
+        self.handlers = {}
+
+    def Bind(self, event, handler, source=None, id=ID_ANY):
+        self.handlers[(event, id)] = handler
+
+    def ProcessEvent(self, binder, event=None, id=ID_ANY):
+        ''' Calls the handler bound for binder, if any, with event '''
+        handler = self.handlers.get((binder, id))
+        if handler is not None:
+            _call(handler, event if event is not None else Event())
+
+
+class Window(EvtHandler):
+
+    def __init__(self, parent=None, *args, **kwargs):
+        EvtHandler.__init__(self)
+        self.parent = parent
+        self.children = []
+        if parent is not None:
+            parent.children.append(self)
+        self.destroyed = False
+        self.size = (0, 0)
+        self.position = (0, 0)
+        self.sizer = None
+        self.shown = False
+        _live.add(self)
+
+    def __bool__(self):
+        return not self.destroyed
+
+    __nonzero__ = __bool__
+
+    def Destroy(self):
+        ''' Destroys the window and its children, as wx does '''
+        if self.destroyed:
+            raise RuntimeError('wrapped C/C++ object of type %s has been deleted' % type(self).__name__)
+        for child in list(self.children):
+            child.Destroy()
+        if self.parent is not None and not self.parent.destroyed:
+            self.parent.children.remove(self)
+        self.children = []
+        self.destroyed = True
+        _live.discard(self)
+        self.handlers.clear()
+        self.sizer = None
+        return True
+
+    def SetSize(self, size):
+        self.size = tuple(size)
+
+    def GetSize(self):
+        return self.size
+
+    def SetPosition(self, position):
+        self.position = tuple(position)
+
+    def SetSizer(self, sizer):
+        self.sizer = sizer
+
+    def SetBackgroundColour(self, colour):
+        self.background = colour
+
+    def SetForegroundColour(self, colour):
+        self.foreground = colour
+
+    def Show(self, show=True):
+        self.shown = show
+
+    def Raise(self):
+        pass
+
+
+class Frame(Window):
+    pass
+
+
+class Panel(Window):
+    pass
+
+
+class Control(object):
+    ''' A child control, released with its window '''
+
+    def __init__(self, parent, id=ID_ANY, label='', style=0, **kwargs):
+        self.parent = parent
+        self.label = label
+        self.handlers = {}
+
+    def GetLabel(self):
+        return self.label
+
+    def Bind(self, event, handler, *args, **kwargs):
+        self.handlers[event] = handler
+
+    def SetValue(self, value):
+        self.value = value
+
+    def SetBitmap(self, bitmap):
+        self.bitmap = bitmap
+
+    def SetForegroundColour(self, colour):
+        self.foreground = colour
+
+    def Wrap(self, width):
+        self.wrap = width
+
+
+class StaticText(Control):
+    pass
+
+
+class StaticBitmap(Control):
+    pass
+
+
+class HyperlinkCtrl(Control):
+    pass
+
+
+class RadioButton(Control):
+    pass
+
+
+class BoxSizer(object):
+
+    def __init__(self, orient=HORIZONTAL):
+        self.orient = orient
+        self.items = []
+
+    def Add(self, item, *args, **kwargs):
+        self.items.append(item)
+
+
+class Size(tuple):
+
+    def __new__(cls, width, height):
+        return tuple.__new__(cls, (width, height))
+
+
+class Menu(object):
+
+    def __init__(self):
+        self.items = {}
+        self.enabled = {}
+        self.checked = {}
+
+    def Append(self, id, text='', help=''):
+        self.items[id] = text
+
+    def AppendCheckItem(self, id, text='', help=''):
+        self.items[id] = text
+
+    def AppendSeparator(self):
+        pass
+
+    def Enable(self, id, enable=True):
+        self.enabled[id] = enable
+
+    def Check(self, id, check=True):
+        self.checked[id] = check
+
+
+class Icon(object):
+
+    def __init__(self, data=b''):
+        self.data = data
+
+
+class Bitmap(Icon):
+    pass
+
+
+class ArtProvider(object):
+
+    @staticmethod
+    def GetIcon(art, client=ART_OTHER, size=(16, 16)):
+        return Icon(art)
+
+
+class TaskBarIcon(EvtHandler):
+    ''' Keeps the icon and tooltip last set, and counts balloons '''
+
+    def __init__(self):
+        EvtHandler.__init__(self)
+        self.shown_icon = None
+        self.shown_tooltip = None
+        self.icons_set = 0
+        self.balloons = 0
+        self.destroyed = False
+
+    def SetIcon(self, icon, tooltip=''):
+        self.shown_icon = icon
+        self.shown_tooltip = tooltip
+        self.icons_set += 1
+        return True
+
+    def ShowBalloon(self, title, text, msec=0, flags=0):
+        self.balloons += 1
+        return True
+
+    def PopupMenu(self, menu):
+        return True
+
+    def Destroy(self):
+        self.destroyed = True
+
+
+class App(object):
+
+    def __init__(self, redirect=False):
+        pass
+
+    def MainLoop(self):
+        pass
+
+
+def GetMousePosition():
+    return (800, 600)
+
+
+class PyEmbeddedImage(object):
+    ''' Base64 encoded PNG, decoded each time it is converted '''
+
+    def __init__(self, data):
+        self.data = data
+
+    def GetData(self):
+        return base64.b64decode(self.data)
+
+    def GetIcon(self):
+        return Icon(self.GetData())
+
+    def GetBitmap(self):
+        return Bitmap(self.GetData())
+
+
+def live_windows():
+    ''' Number of windows created and not yet destroyed '''
+    return len(_live)
+
+
+def install(clock):
+    ''' Installs the stand-in wx and winsound modules, scheduling timers on
+        clock. Must be called before lifesaver.ui or lifesaver.icons is first
+        imported; later calls only change the clock '''
+    global _clock
+    _clock = clock
+    wx = sys.modules.get('wx')
+    if wx is not None and wx is not sys.modules[__name__]:
+        if 'lifesaver.ui' in sys.modules or 'lifesaver.icons' in sys.modules:
+            raise RuntimeError('lifesaver.ui was imported with the real wx')
+    sys.modules['wx'] = sys.modules[__name__]
+    lib = types.ModuleType('wx.lib')
+    embeddedimage = types.ModuleType('wx.lib.embeddedimage')
+    embeddedimage.PyEmbeddedImage = PyEmbeddedImage
+    lib.embeddedimage = embeddedimage
+    sys.modules.setdefault('wx.lib', lib)
+    sys.modules.setdefault('wx.lib.embeddedimage', embeddedimage)
+    winsound = types.ModuleType('winsound')
+    winsound.MB_ICONASTERISK = 0x40
+    winsound.MessageBeep = lambda kind=0: None
+    sys.modules.setdefault('winsound', winsound)
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# coding=utf-8
+'''
+Telemetry frame format.
+
+A frame carries a batch of samples from one device as fixed-width columns,
+followed by any alert events as JSON, all deflated with zlib. Columns are
+little-endian so they can be loaded straight into arrays on decode without
+building an object per sample.
+'''
+import sys
+import json
+import math
+import zlib
+import struct
+from array import array
+from collections import namedtuple
+
+MAGIC = b'BLF1'
+VERSION = 1
+
+HEADER = struct.Struct('<4sBHI') # magic, version, device id length, sample count
+LENGTH = struct.Struct('<I')
+
+# largest decompressed frame accepted, so a small upload cannot inflate without bound
+MAX_FRAME = 16 * 1024 * 1024
+
+# (column name, array typecode); the order is the order on the wire
+COLUMNS = [('timestamp', 'd'),
+           ('remaining_capacity', 'I'),
+           ('full_charge_capacity', 'I'),
+           ('discharge_rate', 'I'),
+           ('charge_rate', 'I'),
+           ('plugged_in', 'B')]
+
+Frame = namedtuple('Frame', ['device_id', 'count', 'columns', 'events'])
+
+
+class FrameError(ValueError):
+    pass
+
+
+def encode_frame(device_id, columns, events=(), level=6):
+    ''' Returns a compressed frame. columns maps each name in COLUMNS to a
+        sequence of equal length; events is a sequence of (timestamp, kind) '''
+    device = device_id.encode('utf-8')
+    count = len(columns['timestamp'])
+    parts = [HEADER.pack(MAGIC, VERSION, len(device), count), device]
+    for name, typecode in COLUMNS:
+        values = columns[name]
+        if len(values) != count:
+            raise FrameError('Column %s has %i values, expected %i' % (name, len(values), count))
+        column = values if isinstance(values, array) and values.typecode == typecode else array(typecode, values)
+        if sys.byteorder == 'big':
+            column = array(typecode, column)
+            column.byteswap()
+        parts.append(column.tobytes())
+    payload = json.dumps(list(events), separators=(',', ':')).encode('utf-8')
+    parts.append(LENGTH.pack(len(payload)))
+    parts.append(payload)
+    return zlib.compress(b''.join(parts), level)
+
+
+def decode_frame(data, limit=MAX_FRAME):
+    ''' Returns a Frame whose columns are arrays. Raises FrameError for any
+        frame which cannot be decoded, which decompresses to more than limit
+        bytes, or which has a timestamp that is not a finite number '''
+    decompressor = zlib.decompressobj()
+    try:
+        raw = decompressor.decompress(data, limit)
+    except zlib.error as e:
+        raise FrameError('Frame is not valid zlib data: %s' % e)
+    if decompressor.unconsumed_tail:
+        raise FrameError('Frame decompresses to more than %i bytes' % limit)
+    if not decompressor.eof:
+        raise FrameError('Frame is not valid zlib data: incomplete or truncated stream')
+    try:
+        return _decode(raw)
+    except FrameError:
+        raise
+    except (struct.error, ValueError, TypeError, UnicodeDecodeError) as e:
+        raise FrameError('Frame is malformed: %s' % e)
+
+
+def _decode(raw):
+    if len(raw) < HEADER.size:
+        raise FrameError('Frame is truncated')
+    magic, version, device_length, count = HEADER.unpack_from(raw)
+    if magic != MAGIC or version != VERSION:
+        raise FrameError('Unsupported frame %r version %i' % (magic, version))
+    offset = HEADER.size
+    device_id = raw[offset:offset + device_length].decode('utf-8')
+    offset += device_length
+    columns = {}
+    for name, typecode in COLUMNS:
+        column = array(typecode)
+        size = column.itemsize * count
+        if offset + size > len(raw):
+            raise FrameError('Frame is truncated in column %s' % name)
+        column.frombytes(raw[offset:offset + size])
+        if sys.byteorder == 'big':
+            column.byteswap()
+        columns[name] = column
+        offset += size
+    if not all(math.isfinite(t) for t in columns['timestamp']):
+        raise FrameError('Frame has a timestamp which is not finite')
+    (length,) = LENGTH.unpack_from(raw, offset)
+    offset += LENGTH.size
+    events = [tuple(e) for e in json.loads(raw[offset:offset + length].decode('utf-8'))]
+    return Frame(device_id, count, columns, events)
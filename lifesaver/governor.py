@@ -0,0 +1,365 @@
+#!/usr/bin/env python
+# coding=utf-8
+'''
+Automatic power plan governor.
+
+Governor switches between a power saving, a balanced and a performance tier
+from the battery's charge, AC state and predicted time remaining. The
+prediction divides the remaining capacity by the discharge rate averaged over
+several minutes, and the charge is smoothed too, so bursts of load or noisy
+readings do not move them much. Each threshold has separate levels for
+entering and leaving a tier, leaving power saving needs a prediction well
+clear of its threshold, and a tier is kept for at least a minimum dwell time,
+so the governor does not flip back and forth around a threshold. After each
+switch on battery it measures the mean DischargeRate once the new plan has
+settled and logs the change against the rate before the switch.
+
+The tiers map to Win32_PowerPlan plans, activated with powercfg, on Windows
+and to cpufreq governor and energy performance preference (EPP) settings on
+Linux. If the user picks a plan themselves, the governor leaves it alone until
+the laptop is next plugged in or unplugged. On Windows, a plan which is none of
+the tiers, such as one the user created, always counts as their choice.
+'''
+import os
+import re
+import sys
+import math
+import logging
+import subprocess
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+SAVER, BALANCED, PERFORMANCE = 'saver', 'balanced', 'performance'
+TIERS = [SAVER, BALANCED, PERFORMANCE]
+CUSTOM = 'custom' # WindowsPlans.active() of a plan which is none of the tiers
+
+# GUIDs of the plans Windows ships with
+WINDOWS_PLAN_GUIDS = {'a1841308-3541-4fab-bc81-f71556f20b4a': SAVER,
+                      '381b4222-f694-41f0-9685-ff5bb260df2e': BALANCED,
+                      '8c5e7fda-e8bf-4a96-9a85-a6e23a8c635c': PERFORMANCE,
+                      'e9a42b02-d5df-448d-aa00-03f14749eb61': PERFORMANCE}
+WINDOWS_PLAN_NAMES = [('saver', SAVER), ('balanced', BALANCED),
+                      ('performance', PERFORMANCE)]
+
+
+class WindowsPlans(object):
+    ''' Tiers backed by the plans enumerated from Win32_PowerPlan. Plans are
+        matched to tiers by the GUIDs of the built in plans, then by name '''
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.guids = {}
+        for plan in connection.Win32_PowerPlan():
+            guid = re.findall(r'\{(.*?)\}', plan.InstanceID)[0]
+            tier = self.tier_of(guid, plan.ElementName)
+            if tier is not None and tier not in self.guids:
+                self.guids[tier] = guid
+        logger.info('Power plans for governor: %s', self.guids)
+
+    @staticmethod
+    def tier_of(guid, name):
+        tier = WINDOWS_PLAN_GUIDS.get(guid.lower())
+        if tier is None:
+            for word, named_tier in WINDOWS_PLAN_NAMES:
+                if word in (name or '').lower():
+                    return named_tier
+        return tier
+
+    def tiers(self):
+        return [t for t in TIERS if t in self.guids]
+
+    def active(self):
+        ''' Returns the active plan's tier, CUSTOM for any other plan, or None
+            if no plan is active '''
+        for plan in self.connection.Win32_PowerPlan(IsActive=True):
+            guid = re.findall(r'\{(.*?)\}', plan.InstanceID)[0]
+            for tier, tier_guid in self.guids.items():
+                if tier_guid == guid:
+                    return tier
+            return CUSTOM
+        return None
+
+    def activate(self, tier):
+        subprocess.check_call(['powercfg', '-setactive', self.guids[tier]])
+
+
+class LinuxCpuPolicy(object):
+    ''' Tiers backed by cpufreq settings, applied to every CPU policy. Where the
+        driver offers energy performance preferences they are used under the
+        powersave governor; otherwise the scaling governor itself is switched.
+        Writing these needs root '''
+
+    EPP = {SAVER: ['power'],
+           BALANCED: ['balance_power', 'default'],
+           PERFORMANCE: ['balance_performance', 'performance']}
+    GOVERNORS = {SAVER: ['powersave', 'conservative'],
+                 BALANCED: ['schedutil', 'ondemand', 'powersave'],
+                 PERFORMANCE: ['performance']}
+
+    def __init__(self, path='/sys/devices/system/cpu/cpufreq'):
+        self.path = path
+        try:
+            names = sorted(n for n in os.listdir(path) if n.startswith('policy'))
+        except OSError:
+            names = []
+        self.policies = [os.path.join(path, n) for n in names]
+        self.settings = {}
+        if self.policies:
+            first = self.policies[0]
+            preferences = (self._read(first, 'energy_performance_available_preferences') or '').split()
+            governors = (self._read(first, 'scaling_available_governors') or '').split()
+            for tier in TIERS:
+                epp = self._first(self.EPP[tier], preferences)
+                if epp is not None and 'powersave' in governors:
+                    self.settings[tier] = (('scaling_governor', 'powersave'),
+                                           ('energy_performance_preference', epp))
+                else:
+                    governor = self._first(self.GOVERNORS[tier], governors)
+                    if governor is not None:
+                        self.settings[tier] = (('scaling_governor', governor),)
+        logger.info('CPU policy settings for governor: %s', self.settings)
+
+    @staticmethod
+    def _first(wanted, available):
+        for value in wanted:
+            if value in available:
+                return value
+        return None
+
+    def tiers(self):
+        # tiers which would write identical settings are indistinguishable
+        tiers, seen = [], set()
+        for tier in TIERS:
+            if tier in self.settings and self.settings[tier] not in seen:
+                seen.add(self.settings[tier])
+                tiers.append(tier)
+        return tiers
+
+    def active(self):
+        ''' Returns the tier whose settings are in force, or None. Settings which
+            match no tier are usually the distribution's defaults rather than a
+            choice the user made, so the governor may replace them '''
+        if not self.policies:
+            return None
+        first = self.policies[0]
+        for tier in self.tiers():
+            if all(self._read(first, attr) == value for attr, value in self.settings[tier]):
+                return tier
+        return None
+
+    def activate(self, tier):
+        for policy in self.policies:
+            for attr, value in self.settings[tier]:
+                with open(os.path.join(policy, attr), 'w') as f:
+                    f.write(value)
+
+    def _read(self, policy, attr):
+        try:
+            with open(os.path.join(policy, attr)) as f:
+                return f.read().strip()
+        except (IOError, OSError):
+            return None
+
+
+def default_backend(power_plans=None):
+    ''' Returns the plan backend for this platform. power_plans is an open
+        root/cimv2/power WMI connection, if one is already available '''
+    if sys.platform == 'win32':
+        if power_plans is None:
+            from lifesaver.monitor import connect_power_plans
+            power_plans = connect_power_plans()
+        return WindowsPlans(power_plans)
+    return LinuxCpuPolicy()
+
+
+class Switch(object):
+    ''' One plan switch and, once measured, the discharge rates around it '''
+
+    def __init__(self, timestamp, old, new, reason, discharge_before):
+        self.timestamp = timestamp
+        self.old = old
+        self.new = new
+        self.reason = reason
+        self.discharge_before = discharge_before # mean mW before the switch, or None on AC
+        self.discharge_after = None
+        self.samples = 0
+        self.total = 0.0
+
+    def __repr__(self):
+        return 'Switch(%s -> %s, %s, %r -> %r mW)' % (self.old, self.new, self.reason,
+                                                     self.discharge_before, self.discharge_after)
+
+
+class Governor(object):
+    ''' Chooses a tier from each Snapshot. Use update as a Daemon observer, or
+        call it from the tray's update '''
+
+    def __init__(self, backend, ac_tier=BALANCED, saver_level=0.4, saver_hours=1.5,
+                 performance_level=0.8, hysteresis=0.05, hours_margin=0.75, min_dwell=300,
+                 settle=60, measure=120, window=None, charge_window=60, history=64):
+        self.backend = backend
+        self.tiers = backend.tiers()
+        self.ac_tier = ac_tier
+        self.saver_level = saver_level # go to saver at or below this charge...
+        self.saver_hours = saver_hours # ...or this predicted time remaining
+        self.performance_level = performance_level # allow performance on battery above this charge
+        self.hysteresis = hysteresis # extra charge needed to leave a tier
+        self.hours_margin = hours_margin # extra predicted hours needed to leave saver
+        self.min_dwell = min_dwell # secs to keep a tier before switching again
+        self.settle = settle # secs after a switch before measuring its effect
+        self.measure = measure # secs over which the effect is measured
+        self.window = window if window is not None else min_dwell # secs the discharge rate is averaged over
+        self.charge_window = charge_window # secs the charge is averaged over
+        self.switches = deque(maxlen=history)
+        self.tier = backend.active()
+        self.switched_at = None
+        self.plugged_in = None
+        self.overridden = False
+        self.measuring = None
+        self._forget()
+
+    def _forget(self):
+        self.hours = None
+        self.discharge = None
+        self.charge = None
+        self.sampled_at = None
+
+    def update(self, snapshot):
+        ''' Takes one Snapshot and switches tier if needed. Returns the tier '''
+        now = snapshot.timestamp
+        if snapshot.plugged_in != self.plugged_in:
+            self._power_changed(snapshot.plugged_in)
+        charge = snapshot.percentage_charge_remaining
+        if not snapshot.plugged_in:
+            elapsed = now - self.sampled_at if self.sampled_at is not None else None
+            self.sampled_at = now
+            self.discharge = self._smooth(self.discharge, snapshot.discharge_rate or None,
+                                          elapsed, self.window)
+            self.charge = charge = self._smooth(self.charge, charge, elapsed, self.charge_window)
+            self.hours = (snapshot.remaining_capacity / float(self.discharge)
+                          if self.discharge else None)
+        self._measure(now, snapshot)
+        if self.overridden:
+            return self.tier
+        tier, reason = self.decide(snapshot.plugged_in, charge)
+        if tier != self.tier and self._dwelt(now):
+            self._switch(now, tier, reason, snapshot.plugged_in)
+        return self.tier
+
+    __call__ = update
+
+    def decide(self, plugged_in, charge):
+        ''' Returns the tier wanted and the reason, allowing for hysteresis
+            around the current tier. Saver is only left once there is a
+            prediction, and it is hours_margin clear of saver_hours '''
+        if plugged_in:
+            return self._available(self.ac_tier), 'on AC'
+        if charge is None:
+            return self.tier, 'charge unknown'
+        hours = self.hours
+        leaving = self.tier == SAVER
+        saver_level = self.saver_level + (self.hysteresis if leaving else 0)
+        saver_hours = self.saver_hours + (self.hours_margin if leaving else 0)
+        if charge <= saver_level:
+            return self._available(SAVER), 'charge %i%%' % (charge * 100)
+        if hours is not None and hours <= saver_hours:
+            return self._available(SAVER), '%.1f hr remaining' % hours
+        if leaving and hours is None:
+            return SAVER, 'no time remaining prediction yet'
+        staying = self.tier == PERFORMANCE
+        if charge > self.performance_level - (self.hysteresis if staying else 0):
+            return self._available(PERFORMANCE), 'charge %i%%' % (charge * 100)
+        return self._available(BALANCED), 'charge %i%%' % (charge * 100)
+
+    def _available(self, tier):
+        ''' The nearest available tier, preferring balanced '''
+        if tier in self.tiers:
+            return tier
+        for fallback in (BALANCED, SAVER, PERFORMANCE):
+            if fallback in self.tiers:
+                return fallback
+        return None
+
+    def _dwelt(self, now):
+        return self.switched_at is None or now - self.switched_at >= self.min_dwell
+
+    def _power_changed(self, plugged_in):
+        if self.overridden:
+            logger.info('Power status changed; governor resuming after manual plan change')
+        self.plugged_in = plugged_in
+        self.overridden = False
+        self.switched_at = None # a change in power status may switch straight away
+        self._forget()
+        if self.measuring is not None:
+            logger.info('Abandoning measurement of %r: power status changed', self.measuring)
+            self.measuring = None
+
+    def resumed(self, gap=None):
+        ''' Forgets the forecast and any measurement in progress after a
+            suspend. A wall clock step is ignored '''
+        if gap is not None and not gap.suspended:
+            return
+        self._forget()
+        if self.measuring is not None:
+            logger.info('Abandoning measurement of %r: resumed from suspend', self.measuring)
+            self.measuring = None
+
+    def _switch(self, now, tier, reason, plugged_in):
+        if tier is None:
+            return
+        active = self.backend.active()
+        if active == CUSTOM or (self.tier is not None and active != self.tier):
+            logger.info('Power plan changed to %s outside the governor; leaving it alone', active)
+            self.overridden = True
+            self.tier = active
+            return
+        try:
+            self.backend.activate(tier)
+        except Exception:
+            logger.exception('Failed to switch power plan to %s', tier)
+            self.switched_at = now # retry after the dwell time rather than every tick
+            return
+        switch = Switch(now, self.tier, tier, reason, None if plugged_in else self.discharge)
+        logger.info('Power plan %s -> %s (%s)', switch.old, switch.new, reason)
+        self.switches.append(switch)
+        self.tier = tier
+        self.switched_at = now
+        self.measuring = switch if switch.discharge_before else None
+
+    def _measure(self, now, snapshot):
+        switch = self.measuring
+        if switch is None or now - switch.timestamp < self.settle:
+            return
+        if snapshot.discharge_rate:
+            switch.samples += 1
+            switch.total += snapshot.discharge_rate
+        if now - switch.timestamp >= self.settle + self.measure and switch.samples:
+            switch.discharge_after = switch.total / switch.samples
+            change = switch.discharge_after / switch.discharge_before - 1
+            logger.info('Power plan %s -> %s changed discharge rate from %i mW to %i mW (%+.0f%%)',
+                        switch.old, switch.new, switch.discharge_before, switch.discharge_after,
+                        change * 100)
+            self.measuring = None
+
+    @staticmethod
+    def _smooth(old, new, elapsed, window):
+        ''' Exponentially weighted average with a time constant of window secs,
+            so it behaves the same whatever the sampling interval '''
+        if new is None:
+            return old
+        if old is None or elapsed is None or not window:
+            return new
+        return old + (1 - math.exp(-max(elapsed, 0) / float(window))) * (new - old)
+
+
+def main(argv=None):
+    ''' Prints the tiers the governor would use on this machine '''
+    logging.basicConfig(level=logging.INFO)
+    backend = default_backend()
+    print('Tiers: %s' % (', '.join(backend.tiers()) or 'none'))
+    print('Active: %s' % backend.active())
+
+
+if __name__ == '__main__':
+    main()
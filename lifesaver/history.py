@@ -0,0 +1,362 @@
+#!/usr/bin/env python
+# coding=utf-8
+'''
+Compact battery history format.
+
+A history file is a header followed by independent blocks of up to
+block_size samples. Within a block each column is stored as the differences
+between successive values, zigzag encoded so small negative steps stay small,
+as base 128 varints; the block is then deflated with zlib. Timestamps are
+stored as integer multiples of the file's resolution. Capacity, rate and
+timestamp columns change slowly between samples, so most values take one
+byte before compression. The daemon ends a block at each suspend or clock
+change, so jumps in the values only occur between blocks.
+
+HistoryWriter appends samples one at a time and keeps only the current block
+in memory. HistoryWriter.open() cuts off a block left incomplete by a writer
+that was killed before appending, so new blocks never follow a partial one. It needs nothing outside the standard library, so the daemon can
+record with it. HistoryReader yields one block at a time as NumPy arrays,
+decoding the varints with array operations.
+
+    python -m lifesaver --daemon --history battery.blh
+    python -m lifesaver.history info battery.blh
+    python -m lifesaver.history csv battery.blh > battery.csv
+'''
+import os
+import zlib
+import time
+import struct
+import logging
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'BLH1'
+VERSION = 1
+
+HEADER = struct.Struct('<4sBd') # magic, version, timestamp resolution (secs)
+LENGTH = struct.Struct('<I')
+
+# columns in the order they are stored. Capacities in mWh and rates in mW
+COLUMNS = ['timestamp', 'remaining_capacity', 'full_charge_capacity',
+           'discharge_rate', 'charge_rate', 'plugged_in']
+
+
+class HistoryError(ValueError):
+    pass
+
+
+def _encode_column(values, out):
+    ''' Appends values to the bytearray out as zigzag encoded varint deltas '''
+    previous = 0
+    for value in values:
+        delta = value - previous
+        previous = value
+        _encode_varint((delta << 1) if delta >= 0 else ((-delta << 1) - 1), out)
+
+
+def _encode_varint(n, out):
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def _read_varint(data, offset):
+    value = shift = 0
+    while True:
+        if offset >= len(data):
+            raise HistoryError('Block is truncated')
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+
+class HistoryWriter(object):
+    ''' Streams samples to a binary file object. Can be used directly as a
+        Daemon observer, since calling it adds a Snapshot '''
+
+    def __init__(self, f, block_size=4096, resolution=0.001, flush_interval=3600, level=9):
+        self.f = f
+        self.block_size = block_size
+        self.resolution = resolution
+        self.flush_interval = flush_interval # secs before a partial block is written anyway
+        self.level = level
+        self.columns = [[] for _name in COLUMNS]
+        self.block_started = None
+        self.samples = 0
+        self.bytes_written = 0
+        if f.tell() == 0:
+            self._write(HEADER.pack(MAGIC, VERSION, resolution))
+            f.flush()
+
+    @classmethod
+    def open(cls, path, **kwargs):
+        ''' Returns a writer appending to the file at path, creating it if need
+            be. An existing file keeps its own resolution '''
+        f = open(path, 'r+b' if os.path.exists(path) else 'w+b')
+        try:
+            resolution = _truncate_partial_block(f)
+        except Exception:
+            f.close()
+            raise
+        if resolution is not None:
+            kwargs['resolution'] = resolution
+        return cls(f, **kwargs)
+
+    def __call__(self, snapshot):
+        self.add(snapshot)
+
+    def add(self, snapshot):
+        ''' Adds a monitor.Snapshot '''
+        self.add_sample(snapshot.timestamp, snapshot.remaining_capacity,
+                        snapshot.full_charge_capacity, snapshot.discharge_rate,
+                        snapshot.charge_rate, snapshot.plugged_in)
+
+    def add_sample(self, timestamp, remaining_capacity, full_charge_capacity,
+                   discharge_rate, charge_rate, plugged_in):
+        row = (int(round(timestamp / self.resolution)), int(remaining_capacity or 0),
+               int(full_charge_capacity or 0), int(discharge_rate or 0),
+               int(charge_rate or 0), 1 if plugged_in else 0)
+        for column, value in zip(self.columns, row):
+            column.append(value)
+        self.samples += 1
+        if self.block_started is None:
+            self.block_started = timestamp
+        if (len(self.columns[0]) >= self.block_size or
+                timestamp - self.block_started >= self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        ''' Writes any buffered samples as a block '''
+        count = len(self.columns[0])
+        if not count:
+            return
+        payload = bytearray()
+        _encode_varint(count, payload)
+        for column in self.columns:
+            encoded = bytearray()
+            _encode_column(column, encoded)
+            _encode_varint(len(encoded), payload)
+            payload += encoded
+            del column[:]
+        block = zlib.compress(bytes(payload), self.level)
+        self._write(LENGTH.pack(len(block)) + block)
+        self.f.flush()
+        self.block_started = None
+
+    def mark_gap(self, gap=None):
+        ''' Ends the current block at a suspend or clock change, so that no
+            block spans a discontinuity '''
+        self.flush()
+
+    def close(self):
+        self.flush()
+        self.f.close()
+
+    def _write(self, data):
+        self.f.write(data)
+        self.bytes_written += len(data)
+
+
+def _truncate_partial_block(f):
+    ''' Cuts a history file open for update back to the end of its last
+        complete block and leaves it positioned there. Returns the file's
+        resolution, or None if it did not have a whole header '''
+    end = f.seek(0, os.SEEK_END)
+    f.seek(0)
+    header = f.read(HEADER.size)
+    if len(header) < HEADER.size:
+        f.seek(0)
+        f.truncate()
+        return None
+    magic, version, resolution = HEADER.unpack(header)
+    if magic != MAGIC or version != VERSION:
+        raise HistoryError('Unsupported history file %r version %i' % (magic, version))
+    offset = HEADER.size
+    while offset < end:
+        length = f.read(LENGTH.size)
+        size = LENGTH.unpack(length)[0] if len(length) == LENGTH.size else None
+        if size is None or offset + LENGTH.size + size > end:
+            logger.warning('Removing truncated block at the end of the history (%i bytes)', end - offset)
+            f.seek(offset)
+            f.truncate()
+            break
+        offset += LENGTH.size + size
+        f.seek(offset)
+    f.seek(0, os.SEEK_END)
+    return resolution
+
+
+class HistoryReader(object):
+    ''' Reads a history file one block at a time. Needs NumPy '''
+
+    def __init__(self, f):
+        self.f = f
+        header = f.read(HEADER.size)
+        if len(header) < HEADER.size:
+            raise HistoryError('History file is truncated')
+        magic, version, self.resolution = HEADER.unpack(header)
+        if magic != MAGIC or version != VERSION:
+            raise HistoryError('Unsupported history file %r version %i' % (magic, version))
+
+    def __iter__(self):
+        return self.blocks()
+
+    def blocks(self):
+        ''' Yields a dict of column name to NumPy array for each block. Timestamps
+            are float64 seconds; other columns are int64. A block cut short by
+            the writer being killed ends the history with a warning; a complete
+            block which does not decode raises HistoryError '''
+        index = 0
+        while True:
+            length = self.f.read(LENGTH.size)
+            if not length:
+                return
+            size = LENGTH.unpack(length)[0] if len(length) == LENGTH.size else None
+            block = self.f.read(size) if size is not None else b''
+            if size is None or len(block) < size:
+                logger.warning('Ignoring truncated block at the end of the history')
+                return
+            try:
+                payload = zlib.decompress(block)
+            except zlib.error as e:
+                raise HistoryError('Block %i is corrupt: %s' % (index, e))
+            yield self._decode_block(payload)
+            index += 1
+
+    def read(self):
+        ''' Returns the whole history as one dict of arrays '''
+        import numpy as np
+        blocks = list(self.blocks())
+        if not blocks:
+            return dict((name, np.zeros(0, np.float64 if name == 'timestamp' else np.int64))
+                        for name in COLUMNS)
+        return dict((name, np.concatenate([b[name] for b in blocks])) for name in COLUMNS)
+
+    def _decode_block(self, payload):
+        import numpy as np
+        count, offset = _read_varint(payload, 0)
+        columns = {}
+        for name in COLUMNS:
+            size, offset = _read_varint(payload, offset)
+            if offset + size > len(payload):
+                raise HistoryError('Block is truncated in column %s' % name)
+            values = decode_deltas(np.frombuffer(payload, np.uint8, size, offset))
+            if len(values) != count:
+                raise HistoryError('Column %s has %i values, expected %i' % (name, len(values), count))
+            columns[name] = values * self.resolution if name == 'timestamp' else values
+            offset += size
+        return columns
+
+
+def decode_deltas(data):
+    ''' Decodes a uint8 array of zigzag varint deltas to an int64 array '''
+    import numpy as np
+    if not len(data):
+        return np.zeros(0, np.int64)
+    ends = data < 0x80
+    starts = np.flatnonzero(np.concatenate(([True], ends[:-1])))
+    # each byte's position within its varint, giving the shift for its 7 bits
+    group = np.cumsum(np.concatenate(([0], ends[:-1])))
+    position = np.arange(len(data)) - starts[group]
+    parts = (data & 0x7f).astype(np.uint64) << (7 * position).astype(np.uint64)
+    zigzag = np.bitwise_or.reduceat(parts, starts)
+    deltas = (zigzag >> np.uint64(1)).astype(np.int64) ^ -(zigzag & np.uint64(1)).astype(np.int64)
+    return np.cumsum(deltas)
+
+
+def log_equivalent(samples):
+    ''' Returns the number of bytes the monitor's debug log takes to record the
+        same readings, one tick per sample '''
+    total = 0
+    for timestamp, remaining, full, _discharge, _charge, plugged_in in samples:
+        stamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp)) + ',000'
+        charge = int(min(float(remaining) / full, 1.0) * 100) if full else 0
+        lines = ['lifesaver.daemon - DEBUG - Updating',
+                 'root - DEBUG - Power is %sconnected' % ('' if plugged_in else 'not '),
+                 'root - DEBUG - Remaining capacity: %s' % remaining,
+                 'root - DEBUG - Full charge capacity: %s' % full,
+                 'root - DEBUG - Percentage charge remaining: %i%%' % charge]
+        total += sum(len(stamp) + 3 + len(line) + 1 for line in lines)
+    return total
+
+
+def simulated_samples(days=7, interval=2):
+    ''' Samples from a FakeProvider cycling between discharging to 30% and
+        charging to 80%, with a tapering charge '''
+    from lifesaver.fakes import FakeProvider
+    provider = FakeProvider(cv_knee=0.8, charge=0.8)
+    battery = provider.batteries[0]
+    start = time.time()
+    for i in range(int(days * 86400 / interval)):
+        status = provider.ExecQuery('Select * from BatteryStatus where Voltage > 0')[0]
+        yield (start + i * interval, status.RemainingCapacity, battery.full_charge_capacity,
+               status.DischargeRate, status.ChargeRate, status.PowerOnline)
+        charge = battery.remaining_capacity / battery.full_charge_capacity
+        if provider.plugged_in and charge >= 0.8:
+            provider.unplug()
+        elif not provider.plugged_in and charge <= 0.3:
+            provider.plug_in()
+        provider.advance(interval)
+
+
+def main(argv=None):
+    import io
+    import sys
+    import argparse
+    parser = argparse.ArgumentParser(prog='lifesaver.history', description='Battery history files')
+    commands = parser.add_subparsers(dest='command')
+    info = commands.add_parser('info', help='summarise a history file')
+    info.add_argument('file')
+    csv = commands.add_parser('csv', help='write a history file as CSV to stdout')
+    csv.add_argument('file')
+    bench = commands.add_parser('bench', help='compare the size of a simulated history with the debug log')
+    bench.add_argument('--days', type=float, default=7)
+    args = parser.parse_args(argv)
+    if args.command == 'info':
+        import os
+        count, first, last = 0, None, None
+        with open(args.file, 'rb') as f:
+            for block in HistoryReader(f):
+                count += len(block['timestamp'])
+                if len(block['timestamp']):
+                    first = block['timestamp'][0] if first is None else first
+                    last = block['timestamp'][-1]
+        size = os.path.getsize(args.file)
+        print('%i samples, %i bytes (%.2f bytes/sample)' % (count, size, size / float(count or 1)))
+        if count:
+            print('%s to %s' % (time.ctime(first), time.ctime(last)))
+    elif args.command == 'csv':
+        with open(args.file, 'rb') as f:
+            sys.stdout.write(','.join(COLUMNS) + '\n')
+            for block in HistoryReader(f):
+                for row in zip(*[block[name].tolist() for name in COLUMNS]):
+                    sys.stdout.write('%.3f,%i,%i,%i,%i,%i\n' % row)
+    elif args.command == 'bench':
+        buf = io.BytesIO()
+        writer = HistoryWriter(buf)
+        started = time.perf_counter()
+        for sample in simulated_samples(args.days):
+            writer.add_sample(*sample)
+        writer.flush()
+        encode = time.perf_counter() - started
+        log_bytes = log_equivalent(simulated_samples(args.days))
+        buf.seek(0)
+        started = time.perf_counter()
+        count = sum(len(block['timestamp']) for block in HistoryReader(buf))
+        decode = time.perf_counter() - started
+        size = writer.bytes_written
+        print('%i samples over %g days' % (count, args.days))
+        print('history: %10i bytes (%.3f bytes/sample)' % (size, size / float(count)))
+        print('log:     %10i bytes (%.1f bytes/sample), %.0fx larger' % (
+            log_bytes, log_bytes / float(count), log_bytes / float(size)))
+        print('encode %.2f us/sample, decode %.3f us/sample' % (encode / count * 1e6, decode / count * 1e6))
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
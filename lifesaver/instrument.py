@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+# coding=utf-8
+'''
+Tick instrumentation and profiling.
+
+Instrumentation records a latency histogram for each phase of a tick and for
+each backend query, the number of queries made per tick, and the slowest
+recent ticks. While it is disabled, phase() and tick() return a shared no-op
+context manager and the backend is not wrapped, so the cost is one method
+call per phase.
+
+SamplingProfiler periodically samples the monitoring thread's stack from a
+background thread and counts stacks in the collapsed format used by flame
+graph tools.
+'''
+import sys
+import json
+import time
+import logging
+import threading
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class _NullContext(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NULL_CONTEXT = _NullContext()
+
+
+class Histogram(object):
+    ''' Latency histogram with power of two microsecond buckets '''
+
+    BUCKETS = 32
+
+    def __init__(self):
+        self.counts = [0] * self.BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        micros = int(seconds * 1e6)
+        self.counts[min(micros.bit_length(), self.BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p):
+        ''' Returns the upper bound in seconds of the bucket holding the pth percentile '''
+        if not self.count:
+            return 0.0
+        target = p / 100.0 * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= target:
+                return min((1 << i) / 1e6, self.max)
+        return self.max
+
+    def summary(self):
+        return {'count': self.count,
+                'mean_ms': self.total / self.count * 1000 if self.count else 0.0,
+                'p50_ms': self.percentile(50) * 1000,
+                'p90_ms': self.percentile(90) * 1000,
+                'p99_ms': self.percentile(99) * 1000,
+                'max_ms': self.max * 1000}
+
+
+class _Phase(object):
+    __slots__ = ['instrumentation', 'name', 'started']
+
+    def __init__(self, instrumentation, name):
+        self.instrumentation = instrumentation
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.instrumentation.record_phase(self.name, time.perf_counter() - self.started)
+        return False
+
+
+class _Tick(object):
+    __slots__ = ['instrumentation', 'started']
+
+    def __init__(self, instrumentation):
+        self.instrumentation = instrumentation
+
+    def __enter__(self):
+        self.instrumentation.begin_tick()
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.instrumentation.end_tick(time.perf_counter() - self.started)
+        return False
+
+
+class InstrumentedProvider(object):
+    ''' Wraps a backend provider, timing and counting each query '''
+
+    def __init__(self, provider, instrumentation):
+        self.provider = provider
+        self.instrumentation = instrumentation
+
+    def ExecQuery(self, query):
+        started = time.perf_counter()
+        try:
+            return self.provider.ExecQuery(query)
+        finally:
+            self.instrumentation.record_query(query, time.perf_counter() - started)
+
+    def __getattr__(self, name):
+        return getattr(self.provider, name)
+
+
+def query_label(query):
+    ''' Returns the class a WQL query selects from, e.g. BatteryStatus '''
+    words = query.split()
+    lowered = [w.lower() for w in words]
+    if 'from' in lowered and lowered.index('from') + 1 < len(words):
+        return words[lowered.index('from') + 1]
+    return query
+
+
+class Instrumentation(object):
+    ''' Per-phase and per-query latency for a BatteryMonitor's ticks '''
+
+    def __init__(self, batt_mon, recent_ticks=512, enabled=False):
+        self.batt_mon = batt_mon
+        self.enabled = False
+        self.recent = deque(maxlen=recent_ticks)
+        self.profiler = None
+        self.reset()
+        if enabled:
+            self.enable()
+
+    def reset(self):
+        self.phases = {}
+        self.queries = {}
+        self.ticks = Histogram()
+        self.tick_queries = 0
+        self.max_tick_queries = 0
+        self.recent.clear()
+        self.current = None
+
+    def enable(self):
+        if self.enabled:
+            return
+        logger.info('Enabling tick instrumentation')
+        self.enabled = True
+        self.wrap_provider()
+
+    def wrap_provider(self):
+        ''' Times the monitor's provider queries. Call again if the provider is
+            attached after instrumentation was enabled '''
+        t = self.batt_mon.t
+        if self.enabled and t is not None and not isinstance(t, InstrumentedProvider):
+            self.batt_mon.t = InstrumentedProvider(t, self)
+
+    def disable(self):
+        if not self.enabled:
+            return
+        logger.info('Disabling tick instrumentation')
+        if isinstance(self.batt_mon.t, InstrumentedProvider):
+            self.batt_mon.t = self.batt_mon.t.provider
+        self.enabled = False
+
+    def toggle(self):
+        ''' Enables or disables instrumentation. Returns True if now enabled '''
+        if self.enabled:
+            self.disable()
+        else:
+            self.enable()
+        return self.enabled
+
+    def tick(self):
+        ''' Context manager around a whole tick '''
+        if not self.enabled:
+            return NULL_CONTEXT
+        return _Tick(self)
+
+    def phase(self, name):
+        ''' Context manager around one phase of a tick '''
+        if not self.enabled:
+            return NULL_CONTEXT
+        return _Phase(self, name)
+
+    def begin_tick(self):
+        self.current = {'timestamp': time.time(), 'queries': 0, 'phases': {}}
+
+    def end_tick(self, seconds):
+        tick, self.current = self.current, None
+        if tick is None:
+            return
+        tick['duration_ms'] = seconds * 1000
+        self.ticks.add(seconds)
+        self.tick_queries += tick['queries']
+        self.max_tick_queries = max(self.max_tick_queries, tick['queries'])
+        self.recent.append(tick)
+
+    def record_phase(self, name, seconds):
+        histogram = self.phases.get(name)
+        if histogram is None:
+            histogram = self.phases[name] = Histogram()
+        histogram.add(seconds)
+        if self.current is not None:
+            phases = self.current['phases']
+            phases[name] = phases.get(name, 0.0) + seconds * 1000
+
+    def record_query(self, query, seconds):
+        label = query_label(query)
+        histogram = self.queries.get(label)
+        if histogram is None:
+            histogram = self.queries[label] = Histogram()
+        histogram.add(seconds)
+        if self.current is not None:
+            self.current['queries'] += 1
+
+    def slowest(self, n=10):
+        return sorted(self.recent, key=lambda t: t['duration_ms'], reverse=True)[:n]
+
+    def summary(self):
+        ticks = self.ticks.count
+        return {'enabled': self.enabled,
+                'ticks': self.ticks.summary(),
+                'queries_per_tick': {'mean': self.tick_queries / float(ticks) if ticks else 0.0,
+                                     'max': self.max_tick_queries},
+                'phases': dict((k, h.summary()) for k, h in self.phases.items()),
+                'queries': dict((k, h.summary()) for k, h in self.queries.items()),
+                'slowest_ticks': self.slowest()}
+
+    def dump(self, path):
+        ''' Writes the summary, and any profile collected, to a JSON file '''
+        summary = self.summary()
+        if self.profiler is not None:
+            summary['profile'] = self.profiler.collapsed()
+        with open(path, 'w') as f:
+            json.dump(summary, f, indent=2)
+        logger.info('Wrote instrumentation summary to %s', path)
+
+    def start_profiler(self, interval=0.005, thread_id=None):
+        if self.profiler is None or not self.profiler.running:
+            self.profiler = SamplingProfiler(interval, thread_id)
+            self.profiler.start()
+        return self.profiler
+
+    def stop_profiler(self):
+        if self.profiler is not None:
+            self.profiler.stop()
+
+    def toggle_profiler(self, interval=0.005, thread_id=None):
+        ''' Starts or stops the sampling profiler. Returns True if now running '''
+        if self.profiler is not None and self.profiler.running:
+            self.stop_profiler()
+            return False
+        self.start_profiler(interval, thread_id)
+        return True
+
+    def install_signal_handlers(self, dump_path):
+        ''' On Unix, SIGUSR1 toggles instrumentation and profiling and SIGUSR2
+            dumps the summary to dump_path '''
+        import signal
+        if not hasattr(signal, 'SIGUSR1'):
+            return False
+
+        def toggle(signum, frame):
+            if self.toggle():
+                self.start_profiler()
+            else:
+                self.stop_profiler()
+
+        signal.signal(signal.SIGUSR1, toggle)
+        signal.signal(signal.SIGUSR2, lambda signum, frame: self.dump(dump_path))
+        return True
+
+
+class SamplingProfiler(object):
+    ''' Samples one thread's stack on an interval and counts distinct stacks '''
+
+    def __init__(self, interval=0.005, thread_id=None):
+        self.interval = interval
+        self.thread_id = thread_id if thread_id is not None else threading.get_ident()
+        self.stacks = {}
+        self.samples = 0
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name='lifesaver-profiler', daemon=True)
+        self.thread.start()
+        logger.info('Sampling profiler started')
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+        logger.info('Sampling profiler stopped after %i samples', self.samples)
+
+    def _run(self):
+        while self.running:
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('%s (%s:%i)' % (code.co_name, code.co_filename, frame.f_lineno))
+                    frame = frame.f_back
+                key = ';'.join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+                self.samples += 1
+            time.sleep(self.interval)
+
+    def collapsed(self):
+        ''' Returns the samples as "frame;frame;frame count" lines, busiest first '''
+        return ['%s %i' % (stack, count) for stack, count in
+                sorted(self.stacks.items(), key=lambda item: item[1], reverse=True)]
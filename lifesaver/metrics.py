@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# coding=utf-8
+'''
+Prometheus text format metrics.
+
+The exporter is fed the Snapshot taken each tick, the alerts raised and the
+tick latency, and renders them on demand, along with the telemetry agent's own
+overhead when one is given. Scrapes never touch the battery
+backend: they are answered from the last sample, and the rendered payload is
+cached until the next one arrives.
+'''
+import logging
+import threading
+
+from lifesaver.monitor import VERSION_NUMBER
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+TICK_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+GAUGES = [
+    ('lifesaver_charge_ratio', 'Proportion of full charge remaining', 'percentage_charge_remaining', 1),
+    ('lifesaver_remaining_capacity_wh', 'Remaining capacity of all batteries', 'remaining_capacity', 0.001),
+    ('lifesaver_full_charge_capacity_wh', 'Capacity of all batteries when fully charged', 'full_charge_capacity', 0.001),
+    ('lifesaver_discharge_rate_watts', 'Rate the batteries are discharging at', 'discharge_rate', 0.001),
+    ('lifesaver_charge_rate_watts', 'Rate the batteries are charging at', 'charge_rate', 0.001),
+]
+
+# (name, help, key in TelemetryAgent.overhead(), type)
+TELEMETRY = [
+    ('lifesaver_telemetry_samples_total', 'Samples buffered for upload', 'samples', 'counter'),
+    ('lifesaver_telemetry_frames_sent_total', 'Frames delivered to the collector', 'frames_sent', 'counter'),
+    ('lifesaver_telemetry_bytes_sent_total', 'Compressed bytes delivered to the collector', 'bytes_sent', 'counter'),
+    ('lifesaver_telemetry_upload_failures_total', 'Uploads which failed and will be retried', 'upload_failures', 'counter'),
+    ('lifesaver_telemetry_frames_rejected_total', 'Frames the collector refused', 'frames_rejected', 'counter'),
+    ('lifesaver_telemetry_cpu_seconds_total', 'CPU time used by the telemetry agent', 'cpu_seconds', 'counter'),
+    ('lifesaver_telemetry_spooled_frames', 'Frames waiting in the spool', 'spooled_frames', 'gauge'),
+]
+
+
+class MetricsExporter(object):
+    ''' Holds the latest sample and counters, and renders them as Prometheus text '''
+
+    def __init__(self, labels=None, telemetry=None):
+        self.lock = threading.Lock()
+        self.telemetry = telemetry # e.g. TelemetryAgent.overhead, read at each render
+        self.label_values = dict(labels or {})
+        self.labels = self._format_labels(self.label_values)
+        self.snapshot = None
+        self.alerts = {'unplug': 0, 'plugin': 0, 'fully_charged': 0}
+        self.tick_buckets = [0] * len(TICK_BUCKETS)
+        self.tick_count = 0
+        self.tick_sum = 0.0
+        self.last_tick = None
+        self.cache = None
+
+    @staticmethod
+    def _format_labels(labels, extra=None):
+        items = sorted(dict(labels, **(extra or {})).items())
+        if not items:
+            return ''
+        return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                                 for k, v in items)
+
+    def observe(self, snapshot):
+        ''' Records the latest Snapshot. Can be used directly as a daemon observer '''
+        with self.lock:
+            self.snapshot = snapshot
+            self.cache = None
+
+    def record_alert(self, alert):
+        ''' Counts an Alert. Can be used directly as a daemon alert sink '''
+        with self.lock:
+            self.alerts[alert.kind] = self.alerts.get(alert.kind, 0) + 1
+            self.cache = None
+
+    def record_tick(self, seconds):
+        ''' Records how long one monitor tick took '''
+        with self.lock:
+            self.tick_count += 1
+            self.tick_sum += seconds
+            self.last_tick = seconds
+            for i, bound in enumerate(TICK_BUCKETS):
+                if seconds <= bound:
+                    self.tick_buckets[i] += 1
+                    break
+            self.cache = None
+
+    def render(self):
+        ''' Returns the metrics payload as bytes, rendering it only if something
+            has changed since the last call '''
+        with self.lock:
+            if self.cache is None:
+                self.cache = self._render().encode('utf-8')
+            return self.cache
+
+    def _render(self):
+        labels = self.labels
+        lines = ['# HELP lifesaver_info Battery Lifesaver version',
+                 '# TYPE lifesaver_info gauge',
+                 'lifesaver_info%s 1' % self._labelled(version=VERSION_NUMBER)]
+        snap = self.snapshot
+        if snap is not None:
+            for name, help_text, field, scale in GAUGES:
+                if getattr(snap, field) is None:
+                    continue # no battery reporting its capacity
+                lines += ['# HELP %s %s' % (name, help_text), '# TYPE %s gauge' % name,
+                          '%s%s %s' % (name, labels, _number(getattr(snap, field) * scale))]
+            lines += ['# HELP lifesaver_ac_online Whether mains power is connected',
+                      '# TYPE lifesaver_ac_online gauge',
+                      'lifesaver_ac_online%s %i' % (labels, 1 if snap.plugged_in else 0)]
+            if snap.time_remaining is not None:
+                lines += ['# HELP lifesaver_time_remaining_seconds Estimated time until the batteries are empty',
+                          '# TYPE lifesaver_time_remaining_seconds gauge',
+                          'lifesaver_time_remaining_seconds%s %s' % (labels, _number(snap.time_remaining * 3600))]
+            lines += ['# HELP lifesaver_last_sample_timestamp_seconds When the battery was last read',
+                      '# TYPE lifesaver_last_sample_timestamp_seconds gauge',
+                      'lifesaver_last_sample_timestamp_seconds%s %s' % (labels, _number(snap.timestamp))]
+        lines += ['# HELP lifesaver_alerts_total Alerts raised, by kind',
+                  '# TYPE lifesaver_alerts_total counter']
+        for kind, count in sorted(self.alerts.items()):
+            lines.append('lifesaver_alerts_total%s %i' % (self._labelled(kind=kind), count))
+        lines += ['# HELP lifesaver_tick_duration_seconds Time taken by each monitor tick',
+                  '# TYPE lifesaver_tick_duration_seconds histogram']
+        cumulative = 0
+        for bound, count in zip(TICK_BUCKETS, self.tick_buckets):
+            cumulative += count
+            lines.append('lifesaver_tick_duration_seconds_bucket%s %i' % (
+                self._labelled(le=repr(bound)), cumulative))
+        lines.append('lifesaver_tick_duration_seconds_bucket%s %i' % (
+            self._labelled(le='+Inf'), self.tick_count))
+        lines.append('lifesaver_tick_duration_seconds_sum%s %s' % (labels, _number(self.tick_sum)))
+        lines.append('lifesaver_tick_duration_seconds_count%s %i' % (labels, self.tick_count))
+        if self.telemetry is not None:
+            stats = self.telemetry()
+            for name, help_text, key, kind in TELEMETRY:
+                lines += ['# HELP %s %s' % (name, help_text), '# TYPE %s %s' % (name, kind),
+                          '%s%s %s' % (name, labels, _number(stats[key]))]
+        return '\n'.join(lines) + '\n'
+
+    def _labelled(self, **extra):
+        return self._format_labels(self.label_values, extra)
+
+
+def _number(value):
+    return repr(float(value))
+
+
+class MetricsServer(object):
+    ''' Serves an exporter's payload at /metrics from a background thread '''
+
+    def __init__(self, exporter, host='127.0.0.1', port=9470):
+        from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                payload = exporter.render()
+                self.send_response(200)
+                self.send_header('Content-Type', CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       name='lifesaver-metrics', daemon=True)
+        self.thread.start()
+        logger.info('Serving metrics on port %i', self.port)
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -4,17 +4,30 @@ Created on 9 Feb 2014
 @author: Jamie
 '''
 # Logging setup
-import wmi
+import sys
+import time
 import platform
 import logging
+import logging.handlers
+from math import floor
+from collections import namedtuple
+
+from lifesaver.charging import ChargeEstimator
 
 VERSION_NUMBER = '0.0.6-beta'
+LOG_MAX_BYTES = 1024 * 1024 # log files are rotated rather than growing between reboots
+LOG_BACKUP_COUNT = 3
+
+BATTERY_MONIKER = '//./root/wmi'
+POWER_PLANS_MONIKER = '//./root/cimv2/power'
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
-debug_handler = logging.FileHandler('bl_%s.debug.log' % VERSION_NUMBER)
+debug_handler = logging.handlers.RotatingFileHandler('bl_%s.debug.log' % VERSION_NUMBER,
+                                                     maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT)
 debug_handler.setLevel(logging.DEBUG)
-info_handler = logging.FileHandler('bl_%s.info.log' % VERSION_NUMBER)
+info_handler = logging.handlers.RotatingFileHandler('bl_%s.info.log' % VERSION_NUMBER,
+                                                    maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT)
 info_handler.setLevel(logging.INFO)
 formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 debug_handler.setFormatter(formatter)
@@ -22,20 +35,49 @@ info_handler.setFormatter(formatter)
 logger.addHandler(debug_handler)
 logger.addHandler(info_handler)
 
+Alert = namedtuple('Alert', ['kind', 'title', 'message'])
+Snapshot = namedtuple('Snapshot', ['timestamp', 'plugged_in', 'remaining_capacity',
+                                   'full_charge_capacity', 'percentage_charge_remaining',
+                                   'discharge_rate', 'charge_rate', 'time_remaining'])
+
+
+def format_hours(hours):
+    return '%i hr %i min' % (int(hours), 60 * (hours % 1.0))
+
+
+def default_provider():
+    ''' Returns the battery data provider for this platform. WMI is imported
+        here rather than at module level so that headless use never pays for it '''
+    if sys.platform == 'win32':
+        import wmi
+        logging.info('Initialising wmi.WMI(moniker = "%s")' % BATTERY_MONIKER)
+        return wmi.WMI(moniker = BATTERY_MONIKER)
+    from lifesaver.sysfs import SysfsProvider
+    logging.info('Initialising sysfs power supply provider')
+    return SysfsProvider()
+
+
+def connect_power_plans():
+    ''' Returns a WMI connection to the namespace holding Win32_PowerPlan '''
+    import wmi
+    logging.info('Initialising wmi.WMI(moniker = "%s")' % POWER_PLANS_MONIKER)
+    return wmi.WMI(moniker = POWER_PLANS_MONIKER)
+
 
 class BatteryMonitor:
     ''' Class containing methods for testing power supply and battery
         charge levels, and suggesting action to be taken to extend battery life'''
     
-    def __init__(self):
+    def __init__(self, provider=None, defer=False):
         logging.info('\r\r')
         logging.info('Starting laptop battery monitor application')
         logging.info('Initialising laptop battery monitor')
-        self.record_system_info()
-        logging.info('Initialising wmi.WMI()')        
-        self.c = wmi.WMI()
-        logging.info('Initialising wmi.WMI(moniker = "//./root/wmi)')
-        self.t = wmi.WMI(moniker = "//./root/wmi")
+        if defer:
+            # the caller opens the provider, and records system info, in the background
+            self.t = None
+        else:
+            self.record_system_info()
+            self.t = provider if provider is not None else default_provider()
         logging.info('Enabling alerts')
         self.unplug_alert_enabled = True # Initialise to True
         self.plugin_alert_enabled = True # Initialise to True
@@ -43,7 +85,17 @@ class BatteryMonitor:
         self.PLUGIN_LEVEL = 0.3
         self.UNPLUG_LEVEL = 0.8
         self.reset_time_remaining_queue()
+        self.charge_estimator = ChargeEstimator()
+        self._hub = None
     
+    def attach(self, provider):
+        ''' Sets the provider of a monitor created with defer=True '''
+        self.t = provider
+
+    @property
+    def connected(self):
+        return self.t is not None
+
     def record_system_info(self):
         logging.info('Battery Lifesaver version: %s' % VERSION_NUMBER)
         logging.info('System details: %s' % str(platform.uname()))
@@ -65,8 +117,11 @@ class BatteryMonitor:
     @property
     def is_fully_charged(self):
         ''' Returns True if laptop is fully charged '''        
-        logging.debug('Battery %i%% charged' % (self.percentage_charge_remaining * 100))
-        if self.percentage_charge_remaining >= 1.0:
+        charge = self.percentage_charge_remaining
+        if charge is None:
+            return False
+        logging.debug('Battery %i%% charged' % (charge * 100))
+        if charge >= 1.0:
             return True
         else:
             return False            
@@ -78,11 +133,12 @@ class BatteryMonitor:
         batts_details = self.t.ExecQuery('Select * from BatteryStatus where Voltage > 0')
         batts_charge = self.t.ExecQuery('Select * from BatteryFullChargedCapacity')
         for i, b in enumerate(batts_details):
-            if b.RemainingCapacity:
-                perc_charge = (b.RemainingCapacity or 0)/float(batts_charge[i].FullChargedCapacity)
+            full = batts_charge[i].FullChargedCapacity if i < len(batts_charge) else 0
+            if b.RemainingCapacity and full:
+                perc_charge = (b.RemainingCapacity or 0)/float(full)
                 statuses.append('Battery #%i: %i%% available' % (i+1, (perc_charge * 100)))
             else:
-                statuses.append('Battery #%i: Not present' % i+1)
+                statuses.append('Battery #%i: Not present' % (i+1))
         return statuses
             
     @property
@@ -107,8 +163,13 @@ class BatteryMonitor:
     
     @property
     def percentage_charge_remaining(self):    
-        ''' Returns proportion of charge remaining as a float between 0.0 and 1.0 '''
-        charge = float(self.remaining_capacity) / float(self.full_charge_capacity)
+        ''' Returns proportion of charge remaining as a float between 0.0 and 1.0,
+            or None if there is no battery reporting its capacity '''
+        full = self.full_charge_capacity
+        if not full:
+            logging.debug('Percentage charge remaining: unknown, no battery capacity reported')
+            return None
+        charge = float(self.remaining_capacity) / float(full)
         logging.debug('Percentage charge remaining: %i%%' % (min(charge, 1.0) * 100))
         return min(charge, 1.0)        
         
@@ -118,36 +179,293 @@ class BatteryMonitor:
         a value for remaining battery life by dividing the remaining battery capacity 
         by the current battery draining rate as described in the ACPI specification 
         (chapter 3.9.3 'Battery Gas Gauge'). This is then averaged over a number of periods '''
+        if self.stale_samples:
+            # straight after resume DischargeRate may still be from before the suspend
+            self.stale_samples -= 1
+            logging.debug('Discarding time remaining sample taken on resume')
+            return None
         time_left = 0
+        discharging = False
         batts = self.t.ExecQuery('Select * from BatteryStatus where Voltage > 0')
         for _i, b in enumerate(batts):
-            time_left += float(b.RemainingCapacity) / float(b.DischargeRate)
+            if b.DischargeRate:
+                time_left += float(b.RemainingCapacity or 0) / float(b.DischargeRate)
+                discharging = True
+        if not discharging:
+            return None
             
         self.time_remaining_queue += [time_left]
         self.time_remaining_queue = self.time_remaining_queue[1:]
         
-        if not float('-inf') in self.time_remaining_queue:
-            average_time_remaining = sum(self.time_remaining_queue)/len(self.time_remaining_queue)
-            hours = int(average_time_remaining)
-            mins = 60 * (average_time_remaining % 1.0)
-            return '%i hr %i min' % (hours, mins)
+        queue = self.time_remaining_queue
+        self.time_remaining_samples = samples = min(self.time_remaining_samples + 1, len(queue))
+        if samples >= self.time_remaining_min_samples:
+            average_time_remaining = sum(queue[-samples:])/samples
+            return format_hours(average_time_remaining)
+
+    @property
+    def tooltip(self):
+        ''' Returns tooltip text which replicates the Windows Battery Monitor.
+            While charging it shows the estimate last sampled with
+            sample_charging(), rather than taking a sample itself '''
+        charge = self.percentage_charge_remaining
+        if charge is None:
+            if self.is_plugged_in:
+                return "No battery information (plugged in)"
+            return "No battery information"
+        charge *= 100
+        if self.is_plugged_in:
+            if self.is_fully_charged:
+                tooltip = "Fully charged (100%)"
+            else:
+                tooltip = "%i%% available (plugged in, %s)" % (charge, self.charging_status())
+        else:
+            time_remaining = self.time_remaining
+            if not time_remaining is None:
+                tooltip = "%s (%i%%) remaining" % (time_remaining, charge)
+            else:
+                tooltip = "%i%% remaining" % (charge)
+        return tooltip
+
+    @property
+    def icon_name(self):
+        ''' Returns the name of the icon for the current charge level, rounded down
+            to the nearest 20%, and whether the laptop is connected to a power supply.
+            Without battery information it shows full on AC and empty otherwise '''
+        charge = self.percentage_charge_remaining
+        plugged_in = self.is_plugged_in
+        if charge is None:
+            charge = 100 if plugged_in else 0
+        else:
+            charge = int(floor(charge*100/20)*20) # round down to nearest multiple of 20
+        if plugged_in:
+            return "%s%03d" % ("battery_charging_", charge)
+        return "%s%03d" % ("battery_discharging_", charge)
+
+    def snapshot(self, provider=None):
+        ''' Reads every battery value in a single pass and returns a Snapshot.
+            time_remaining is the instantaneous estimate in hours, or None if not
+            discharging. provider, if given, is read instead of the monitor's own
+            connection, e.g. one opened for another thread '''
+        t = provider if provider is not None else self.t
+        batts = t.ExecQuery('Select * from BatteryStatus where Voltage > 0')
+        capacities = t.ExecQuery('Select * from BatteryFullChargedCapacity')
+        plugged_in = False
+        remaining = discharge_rate = charge_rate = 0
+        for b in batts:
+            plugged_in = plugged_in or bool(b.PowerOnline)
+            remaining += (b.RemainingCapacity or 0)
+            discharge_rate += (b.DischargeRate or 0)
+            charge_rate += (b.ChargeRate or 0)
+        full = sum((b.FullChargedCapacity or 0) for b in capacities)
+        charge = min(float(remaining) / full, 1.0) if full else None
+        time_left = float(remaining) / discharge_rate if discharge_rate > 0 else None
+        return Snapshot(time.time(), plugged_in, remaining, full, charge,
+                        discharge_rate, charge_rate, time_left)
+
+    def sample_charging(self):
+        ''' Feeds one sample to the charging curve estimator and returns it. The
+            tray and daemon call this once per tick while plugged in '''
+        batts = self.t.ExecQuery('Select * from BatteryStatus where Voltage > 0')
+        capacities = self.t.ExecQuery('Select * from BatteryFullChargedCapacity')
+        remaining = sum((b.RemainingCapacity or 0) for b in batts)
+        charge_rate = sum((b.ChargeRate or 0) for b in batts)
+        full = sum((b.FullChargedCapacity or 0) for b in capacities)
+        self.charge_estimator.update(time.time(), remaining, full, charge_rate)
+        return self.charge_estimator
+
+    def time_to_unplug(self):
+        ''' Returns the predicted hours until charge reaches UNPLUG_LEVEL, or None '''
+        return self.charge_estimator.time_to(self.UNPLUG_LEVEL)
+
+    def charging_status(self):
+        ''' Returns e.g. "1 hr 5 min until 80%", or "charging" until there is an estimate '''
+        estimator = self.charge_estimator
+        if estimator.charge is not None and estimator.charge < self.UNPLUG_LEVEL:
+            hours, target = estimator.time_to(self.UNPLUG_LEVEL), '%i%%' % (self.UNPLUG_LEVEL * 100)
+        else:
+            hours, target = estimator.time_to_full(), 'full'
+        if hours is None:
+            return 'charging'
+        return '%s until %s' % (format_hours(hours), target)
+
+    def power_sources(self):
+        ''' Reads every power source into a PowerSourceTable and returns its
+            vectorised sources.Aggregate. Needs NumPy. On Linux this also picks up
+            UPS units and HID device batteries individually. The alerts, tooltip
+            and icon do not use it, so the monitor itself never needs NumPy '''
+        from lifesaver import sources
+        from lifesaver.sysfs import SysfsProvider
+        provider = getattr(self.t, 'provider', self.t) # unwrap instrumentation
+        if isinstance(provider, SysfsProvider):
+            table = sources.PowerSourceTable.from_sysfs(provider.path)
+        else:
+            table = sources.PowerSourceTable.from_provider(self.t)
+        return sources.aggregate(table, self.PLUGIN_LEVEL, self.UNPLUG_LEVEL, self.plugin_alert_enabled,
+                                 self.unplug_alert_enabled and self.fully_charged_alert_enabled)
+
+    @property
+    def hub(self):
+        ''' The asyncio SnapshotHub shared by all streams and event subscribers '''
+        if self._hub is None:
+            from lifesaver.streaming import SnapshotHub
+            self._hub = SnapshotHub(self)
+        return self._hub
+
+    def stream(self, interval=2.0, maxsize=16):
+        ''' Returns an async iterator of Snapshots taken at least interval secs apart.
+            All streams share one sampler; slow consumers lose their oldest snapshots '''
+        return self.hub.stream(interval, maxsize)
+
+    def events(self, maxsize=64):
+        ''' Returns an async iterator of power change and alert Events '''
+        return self.hub.events(maxsize)
 
     def reset_time_remaining_queue(self):
         self.time_remaining_queue = [float('-inf')] * 20
+        self.time_remaining_min_samples = len(self.time_remaining_queue)
+        self.time_remaining_samples = 0
+        self.stale_samples = 0
 
-    def should_unplug(self):
-        ''' Tests whether conditions are met for unplugging the laptop '''
-        unplug = (self.percentage_charge_remaining > self.UNPLUG_LEVEL and
-                  self.is_plugged_in and
+    def resumed(self, gap):
+        ''' Resets the estimators after a resume.Gap. The next time remaining
+            sample is discarded and estimates start again from the one after,
+            rather than once the queue has filled '''
+        logging.info('Resetting estimates after %s of %i secs' % (gap.kind, gap.seconds))
+        self.reset_time_remaining_queue()
+        self.time_remaining_min_samples = 1
+        self.stale_samples = 1
+        self.charge_estimator.reset()
+
+    def should_unplug(self, snapshot=None):
+        ''' Tests whether conditions are met for unplugging the laptop, from
+            snapshot if given rather than fresh queries '''
+        charge = self._charge(snapshot)
+        unplug = (charge is not None and charge > self.UNPLUG_LEVEL and
+                  self._plugged_in(snapshot) and
                   self.unplug_alert_enabled and
                   self.fully_charged_alert_enabled)
         if unplug: logging.info('Alerting to unplug')
         return unplug
         
-    def should_plug_in(self):
-        ''' Tests whether conditions are met for plugging in the laptop '''
-        plugin = (self.percentage_charge_remaining < self.PLUGIN_LEVEL and
-                  not self.is_plugged_in and
+    def should_plug_in(self, snapshot=None):
+        ''' Tests whether conditions are met for plugging in the laptop, from
+            snapshot if given rather than fresh queries '''
+        charge = self._charge(snapshot)
+        plugin = (charge is not None and charge < self.PLUGIN_LEVEL and
+                  not self._plugged_in(snapshot) and
                   self.plugin_alert_enabled)
         if plugin: logging.info('Alerting to plug in')
         return plugin
+
+    def _charge(self, snapshot):
+        if snapshot is None:
+            return self.percentage_charge_remaining
+        return snapshot.percentage_charge_remaining
+
+    def _plugged_in(self, snapshot):
+        return self.is_plugged_in if snapshot is None else snapshot.plugged_in
+
+    def reset_alerts_based_on_power_status(self):
+        ''' Tests if plugged in and resets alerts if required. Returns the power status '''
+        plugged_in = self.is_plugged_in
+        if plugged_in:
+            logging.info('Plugged in. Resetting stored battery time-remaining values')
+            self.reset_time_remaining_queue()
+            if not self.plugin_alert_enabled:
+                logging.info('Plugged in. Resetting plugin alert')
+                self.plugin_alert_enabled = True
+        else:
+            if self.charge_estimator.samples:
+                self.charge_estimator.reset()
+            if not self.unplug_alert_enabled:
+                logging.info('Not plugged in. Resetting unplug alert')
+                self.unplug_alert_enabled = True
+            if not self.fully_charged_alert_enabled:
+                logging.info('Not plugged in. Resetting fully charged alert')
+                self.fully_charged_alert_enabled = True
+        return plugged_in
+
+    def check_alerts(self, snapshot=None):
+        ''' Returns a list of Alerts for the unplug and plug in conditions currently
+            met, or met by snapshot if given. None are raised while the charge is
+            unknown '''
+        alerts = []
+        charge = self._charge(snapshot)
+        if charge is None:
+            return alerts
+        if self.should_unplug(snapshot):
+            alerts.append(Alert('unplug', "Unplug charger",
+                                "Battery charge is at %i%%. Unplug your charger now to maintain battery life." % (charge * 100)))
+        if self.should_plug_in(snapshot):
+            alerts.append(Alert('plugin', "Plug in charger",
+                                "Battery charge is at %i%%. Plug in your charger now to maintain battery life." % (charge * 100)))
+        return alerts
+
+    def check_fully_charged(self, snapshot=None):
+        ''' Returns an Alert if fully charged, or if snapshot is, and the alert
+            is required, otherwise None '''
+        if snapshot is None:
+            fully_charged = self.is_fully_charged
+        else:
+            fully_charged = (snapshot.percentage_charge_remaining or 0) >= 1.0
+        if (fully_charged and
+            self._plugged_in(snapshot) and
+            self.fully_charged_alert_enabled):
+            logging.info('Alerting fully charged')
+            return Alert('fully_charged', "Fully charged",
+                         "Your battery is now charged to 100%.")
+
+
+def main(argv=None):
+    ''' Command line entry point. Runs the notification area application, or the
+        headless daemon when --daemon is given '''
+    from lifesaver.startup import TIMELINE
+    TIMELINE.mark('main')
+    import argparse
+    parser = argparse.ArgumentParser(prog='lifesaver',
+                                     description='Battery Lifesaver %s' % VERSION_NUMBER)
+    parser.add_argument('--daemon', action='store_true',
+                        help='run headless, without the notification area icon')
+    parser.add_argument('--alert', action='append', choices=['stdout', 'syslog'],
+                        help='where to send alerts in daemon mode (default: stdout)')
+    parser.add_argument('--hook', action='append', default=[], metavar='MODULE:FUNCTION',
+                        help='callable to receive each alert in daemon mode')
+    parser.add_argument('--interval', type=float, default=2,
+                        help='how often to check levels (secs)')
+    parser.add_argument('--log-level', default='INFO',
+                        help='console logging level in daemon mode')
+    parser.add_argument('--telemetry', metavar='URL',
+                        help='upload samples and alerts to a fleet collector in daemon mode')
+    parser.add_argument('--device-id', help='name to report to the collector (default: hostname)')
+    parser.add_argument('--spool-dir', default='bl_spool',
+                        help='where to keep telemetry that could not be uploaded')
+    parser.add_argument('--governor', action='store_true',
+                        help='switch power plans automatically from charge and predicted time remaining')
+    parser.add_argument('--history', metavar='FILE',
+                        help='append every sample to a compact history file in daemon mode')
+    parser.add_argument('--metrics-port', type=int, metavar='PORT',
+                        help='serve Prometheus metrics on this port in daemon mode')
+    parser.add_argument('--metrics-host', default='127.0.0.1',
+                        help='address to serve metrics on (default: 127.0.0.1)')
+    parser.add_argument('--instrument', action='store_true',
+                        help='record per-phase tick latency from startup')
+    parser.add_argument('--profile', action='store_true',
+                        help='run the sampling profiler from startup (implies --instrument)')
+    parser.add_argument('--instrument-dump', default='bl_instrument.json', metavar='FILE',
+                        help='where to write the instrumentation summary')
+    args = parser.parse_args(argv)
+    if not args.daemon:
+        # the tray has no alert sinks, telemetry, history or metrics server
+        daemon_only = [option for option, value in [('--alert', args.alert), ('--hook', args.hook),
+                                                    ('--telemetry', args.telemetry),
+                                                    ('--history', args.history),
+                                                    ('--metrics-port', args.metrics_port)]
+                       if value]
+        if daemon_only:
+            parser.error('%s can only be used with --daemon' % ', '.join(daemon_only))
+        with TIMELINE.span('import ui'):
+            from lifesaver import ui
+        return ui.main(args)
+    from lifesaver import daemon
+    return daemon.main(args)
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# coding=utf-8
+'''
+Suspend and resume detection.
+
+SuspendDetector is checked once per tick and reports a Gap when the time since
+the previous check could not have been spent sampling normally. On Linux the
+monotonic clock stops during suspend while CLOCK_BOOTTIME keeps counting, so a
+suspend shows up as the two diverging. Elsewhere a monotonic interval much
+longer than the tick shows the same thing, and the tray also reports resumes
+from OS power events with notify().
+
+After a suspend the battery's previous samples say nothing about its current
+drain, so the monitor's estimators are reset rather than averaged across it.
+The wall clock moving on its own, as when NTP corrects it, is reported as a
+clock step: the samples still hold, so nothing is reset, but history and
+telemetry mark the jump in timestamps.
+'''
+import time
+import logging
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+class Gap(namedtuple('Gap', ['kind', 'seconds', 'timestamp'])):
+    ''' kind is 'suspend', 'gap' (a long interval that could be either a suspend
+        or the process being stopped) or 'clock_step' (only the wall clock
+        changed, by seconds) '''
+    __slots__ = ()
+
+    @property
+    def suspended(self):
+        ''' True if sampling stopped, so estimates from before are stale '''
+        return self.kind != 'clock_step'
+
+
+if hasattr(time, 'CLOCK_BOOTTIME'):
+    def _boottime():
+        return time.clock_gettime(time.CLOCK_BOOTTIME)
+else:
+    _boottime = None
+
+
+class SuspendDetector(object):
+    ''' Compares clocks between successive check() calls. boottime is a clock
+        which keeps counting through suspend, or None where there is none '''
+
+    def __init__(self, interval=2, threshold=None, wall=time.time,
+                 monotonic=time.monotonic, boottime=_boottime):
+        self.interval = interval # expected secs between checks
+        self.threshold = threshold if threshold is not None else max(10, 5 * interval)
+        self.wall = wall
+        self.monotonic = monotonic
+        self.boottime = boottime
+        self.last = None
+        self.notified = False
+
+    @classmethod
+    def for_clock(cls, interval, clock):
+        ''' Returns a detector for a caller using clock as its wall clock. A
+            substitute clock, such as a simulation's, is used for every reading
+            so that the clocks stay consistent with each other '''
+        if clock is time.time:
+            return cls(interval)
+        return cls(interval, wall=clock, monotonic=clock, boottime=None)
+
+    def _read(self):
+        return (self.wall(), self.monotonic(),
+                self.boottime() if self.boottime is not None else None)
+
+    def notify(self):
+        ''' Records a resume reported by the OS, for the next check to return '''
+        self.notified = True
+
+    def check(self):
+        ''' Returns a Gap if the machine appears to have been suspended, or the
+            clock changed, since the last check, otherwise None '''
+        now = self._read()
+        last, self.last = self.last, now
+        notified, self.notified = self.notified, False
+        if last is None:
+            return None
+        wall = now[0] - last[0]
+        monotonic = now[1] - last[1]
+        boot = monotonic
+        gap = None
+        if now[2] is not None:
+            boot = now[2] - last[2]
+            if boot - monotonic > self.threshold:
+                gap = Gap('suspend', boot - monotonic, now[0])
+        if gap is None and monotonic > self.threshold:
+            gap = Gap('gap', monotonic, now[0])
+        if gap is None and notified:
+            gap = Gap('suspend', max(wall, monotonic), now[0])
+        if gap is None and abs(wall - boot) > self.threshold:
+            # without a suspend behind it the wall clock was set, which says
+            # nothing about the battery
+            gap = Gap('clock_step', wall - boot, now[0])
+            logger.info('Wall clock stepped by %+.0f secs', gap.seconds)
+        elif gap is not None:
+            logger.info('Detected %s of %.0f secs', gap.kind, gap.seconds)
+        return gap
@@ -0,0 +1,372 @@
+#!/usr/bin/env python
+# coding=utf-8
+'''
+Long-run soak test.
+
+Simulates weeks of operation under a virtual clock against a FakeProvider: the
+headless daemon tick with telemetry and metrics attached, the real tray icon
+with its update and reminder timers, popup opens and menu, and a simulated
+user who plugs in and unplugs when alerted. The tray runs against the stand-in
+wx module in lifesaver.fakewx, whose timers fire on the virtual clock. Logging
+goes to the app's own rotating log files, at the app's own level. Memory is
+traced with tracemalloc after a warm-up, and object counts, file handles,
+threads, pending timers, open windows and log file sizes are checked at
+regular checkpoints. The run fails unless they have all levelled off and the
+logs were written, and the report lists the allocation sites that grew.
+
+    python -m lifesaver.soak --ticks 2000000
+'''
+import gc
+import os
+import sys
+import heapq
+import random
+import shutil
+import logging
+import tempfile
+import threading
+import tracemalloc
+
+from lifesaver import fakewx
+from lifesaver import monitor
+from lifesaver.daemon import Daemon
+from lifesaver.fakes import FakePowerPlans, FakeProvider
+from lifesaver.instrument import Instrumentation
+from lifesaver.metrics import MetricsExporter
+from lifesaver.telemetry import TelemetryAgent
+
+logger = logging.getLogger(__name__)
+
+
+class VirtualClock(object):
+    ''' Clock whose time only moves when advanced, firing timers as it goes.
+        sleep() advances it, so it can be given to Daemon directly '''
+
+    def __init__(self, start=1.0e9):
+        self.now = start
+        self.timers = []
+        self.sequence = 0
+        self.listeners = [] # callables given each elapsed interval
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.advance(seconds)
+
+    def advance(self, seconds):
+        target = self.now + seconds
+        while self.timers and self.timers[0][0] <= target:
+            due, _seq, timer = heapq.heappop(self.timers)
+            if timer.due != due:
+                continue # restarted or cancelled since it was queued
+            self._elapse(due - self.now)
+            timer.due = None
+            timer.callback()
+        self._elapse(target - self.now)
+
+    def _elapse(self, seconds):
+        self.now += seconds
+        for listener in self.listeners:
+            listener(seconds)
+
+    def call_later(self, delay, callback):
+        timer = Timer(self, callback)
+        timer.restart(delay)
+        return timer
+
+    def _push(self, timer):
+        self.sequence += 1
+        heapq.heappush(self.timers, (timer.due, self.sequence, timer))
+
+    @property
+    def pending(self):
+        ''' Number of timers waiting to fire '''
+        return sum(1 for due, _seq, timer in self.timers if timer.due == due)
+
+
+class Timer(object):
+    ''' One-shot timer which can be restarted, like wx.CallLater '''
+
+    def __init__(self, clock, callback):
+        self.clock = clock
+        self.callback = callback
+        self.due = None
+
+    def restart(self, delay):
+        self.due = self.clock.now + delay
+        self.clock._push(self)
+
+    def cancel(self):
+        self.due = None
+
+
+class SimulatedUser(object):
+    ''' Alert sink which plugs in or unplugs a while after being told to, and
+        sometimes silences the alert instead '''
+
+    def __init__(self, clock, provider, batt_mon, rng):
+        self.clock = clock
+        self.provider = provider
+        self.batt_mon = batt_mon
+        self.rng = rng
+        self.pending = None
+        self.cycles = 0
+
+    def __call__(self, alert):
+        if self.pending is not None:
+            return
+        if self.rng.random() < 0.1:
+            if alert.kind == 'unplug':
+                self.batt_mon.unplug_alert_enabled = False
+            elif alert.kind == 'plugin':
+                self.batt_mon.plugin_alert_enabled = False
+            return
+        if alert.kind == 'plugin':
+            action = self.provider.plug_in
+        elif alert.kind in ('unplug', 'fully_charged'):
+            action = self.provider.unplug
+        else:
+            return
+        self.pending = self.clock.call_later(self.rng.uniform(5, 600), lambda: self._act(action))
+
+    def _act(self, action):
+        action()
+        self.pending = None
+        self.cycles += 1
+
+
+class FlakyTransport(object):
+    ''' In-memory telemetry transport which goes offline for a while now and then '''
+
+    def __init__(self, clock, rng, offline_fraction=0.2):
+        self.clock = clock
+        self.rng = rng
+        self.offline_fraction = offline_fraction
+        self.offline_until = 0
+        self.frames = 0
+        self.bytes = 0
+
+    def __call__(self, frame):
+        if self.clock.now < self.offline_until:
+            raise IOError('Simulated network outage')
+        if self.rng.random() < self.offline_fraction * 0.01:
+            self.offline_until = self.clock.now + self.rng.uniform(600, 6 * 3600)
+            raise IOError('Simulated network outage')
+        self.frames += 1
+        self.bytes += len(frame)
+
+
+def open_file_handles():
+    for path in ('/proc/self/fd', '/dev/fd'):
+        if os.path.isdir(path):
+            return len(os.listdir(path))
+    return None
+
+
+def log_file_handlers():
+    ''' Returns the file handlers attached to the root and lifesaver loggers '''
+    loggers = [logging.getLogger()] + [logging.getLogger(n) for n in list(logging.root.manager.loggerDict)
+                                       if n.startswith('lifesaver')]
+    handlers = []
+    for lg in loggers:
+        handlers.extend(h for h in lg.handlers if isinstance(h, logging.FileHandler) and h not in handlers)
+    return handlers
+
+
+def log_file_bytes():
+    ''' Total size of the log files, including rotated backups '''
+    paths = set()
+    for handler in log_file_handlers():
+        paths.add(handler.baseFilename)
+        paths.update('%s.%i' % (handler.baseFilename, i)
+                     for i in range(1, getattr(handler, 'backupCount', 0) + 1))
+    return sum(os.path.getsize(p) for p in paths if os.path.exists(p))
+
+
+def log_bytes_bound():
+    ''' The most the log files can hold, or None if any of them never rotates '''
+    total = 0
+    for handler in log_file_handlers():
+        if not getattr(handler, 'maxBytes', 0):
+            return None
+        total += handler.maxBytes * (handler.backupCount + 1)
+    return total
+
+
+class Soak(object):
+
+    def __init__(self, ticks=200000, checkpoints=20, warmup=0.2, seed=0, trace_frames=1):
+        self.ticks = ticks
+        self.checkpoints = checkpoints
+        self.warmup = warmup
+        self.trace_frames = trace_frames
+        self.rng = random.Random(seed)
+        self.clock = VirtualClock()
+        self.spool_dir = tempfile.mkdtemp(prefix='lifesaver-soak-')
+        self.provider = FakeProvider(batteries=2, charge=0.6, discharge_rate=12000,
+                                     charge_rate=30000, seed=seed, failure_rate=0.001)
+        self.clock.listeners.append(self.provider.advance)
+        self.batt_mon = monitor.BatteryMonitor(self.provider)
+        self.instrumentation = Instrumentation(self.batt_mon)
+        self.exporter = MetricsExporter()
+        self.transport = FlakyTransport(self.clock, self.rng)
+        self.agent = TelemetryAgent('soak', self.transport, spool_dir=self.spool_dir,
+                                    max_backoff=1800, clock=self.clock.time)
+        self.agent.spool.max_bytes = 256 * 1024
+        self.user = SimulatedUser(self.clock, self.provider, self.batt_mon, self.rng)
+        self.daemon = Daemon(self.batt_mon, sinks=[self.user, self.exporter.record_alert, self.agent.add_alert],
+                             clock=self.clock.time, sleep=self.clock.sleep,
+                             observers=[self.agent.add_sample, self.exporter.observe],
+                             tick_listeners=[self.exporter.record_tick],
+                             instrumentation=self.instrumentation)
+        fakewx.install(self.clock)
+        from lifesaver import ui # imported once the stand-in wx is installed
+        self.frame = ui.TaskBarFrame(None, 'TaskBarFrame',
+                                     connections={'battery': lambda: self.provider,
+                                                  'power plans': FakePowerPlans})
+        self.tray = self.frame.tbicon
+        for thread in self.tray.connector.threads:
+            thread.join() # so startup finishes on the first tick, whatever the thread scheduling
+        self.popups = 0
+        self.initial_log_bytes = None
+        self.samples = []
+
+    def step(self, ticks):
+        for _i in range(ticks):
+            if self.rng.random() < 0.002:
+                self.open_popup()
+            if self.rng.random() < 0.0002:
+                self.tray.ProcessEvent(fakewx.EVT_TASKBAR_RIGHT_UP)
+            if self.rng.random() < 0.0005:
+                # instrumentation switched on and off, as from the tray menu
+                self.instrumentation.toggle()
+                self.exporter.render()
+            self.daemon.run(max_ticks=1)
+
+    def open_popup(self):
+        ''' Left clicks the icon. The popup is dismissed by clicking elsewhere
+            about half the time, otherwise the next click replaces it '''
+        self.tray.ProcessEvent(fakewx.EVT_TASKBAR_LEFT_UP)
+        window = self.tray.options_window
+        if window and self.rng.random() < 0.5:
+            window.ProcessEvent(fakewx.EVT_ACTIVATE, fakewx.Event(active=False))
+        self.popups += 1
+
+    def measure(self, tick):
+        gc.collect()
+        return {'tick': tick,
+                'virtual_days': (self.clock.now - 1.0e9) / 86400,
+                'traced_bytes': tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else None,
+                'objects': len(gc.get_objects()),
+                'file_handles': open_file_handles(),
+                'threads': threading.active_count(),
+                'timers': self.clock.pending,
+                'windows': fakewx.live_windows(),
+                'log_bytes': log_file_bytes(),
+                'spool_frames': len(self.agent.spool)}
+
+    def run(self):
+        warmup_ticks = int(self.ticks * self.warmup)
+        self.initial_log_bytes = log_file_bytes()
+        self.step(warmup_ticks)
+        gc.collect()
+        tracemalloc.start(self.trace_frames)
+        baseline = tracemalloc.take_snapshot()
+        self.samples.append(self.measure(warmup_ticks))
+        remaining = self.ticks - warmup_ticks
+        chunk = max(1, remaining // self.checkpoints)
+        done = warmup_ticks
+        while done < self.ticks:
+            n = min(chunk, self.ticks - done)
+            self.step(n)
+            done += n
+            self.samples.append(self.measure(done))
+            logger.info('Soak checkpoint %s', self.samples[-1])
+        final = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        self.growth = [s for s in final.compare_to(baseline, 'lineno') if s.size_diff > 0]
+        return self.samples
+
+    def verdict(self, max_growth=256 * 1024, max_object_growth=2000):
+        ''' Returns a list of failures. Growth is measured over the second half of
+            the measured run, by which point everything should have levelled off '''
+        failures = []
+        middle, last = self.samples[len(self.samples) // 2], self.samples[-1]
+        if last['traced_bytes'] - middle['traced_bytes'] > max_growth:
+            failures.append('traced memory grew by %i bytes' % (last['traced_bytes'] - middle['traced_bytes']))
+        if last['objects'] - middle['objects'] > max_object_growth:
+            failures.append('live objects grew by %i' % (last['objects'] - middle['objects']))
+        for key in ('file_handles', 'threads', 'timers', 'windows'):
+            if middle[key] is not None and last[key] > max(s[key] for s in self.samples[:len(self.samples) // 2 + 1]):
+                failures.append('%s grew from %s to %s' % (key, middle[key], last[key]))
+        bound = log_bytes_bound()
+        if bound is None:
+            failures.append('a log file handler never rotates')
+        elif last['log_bytes'] > bound:
+            failures.append('log files reached %i bytes, over the %i byte limit' % (last['log_bytes'], bound))
+        elif last['log_bytes'] <= self.initial_log_bytes:
+            failures.append('nothing was written to the log files')
+        return failures
+
+    def report(self, top=15):
+        lines = ['%10s %8s %14s %9s %6s %7s %6s %7s %10s %6s' % (
+            'tick', 'days', 'traced bytes', 'objects', 'fds', 'threads', 'timers', 'windows',
+            'log bytes', 'spool')]
+        for s in self.samples:
+            lines.append('%10i %8.1f %14i %9i %6s %7i %6i %7i %10i %6i' % (
+                s['tick'], s['virtual_days'], s['traced_bytes'], s['objects'], s['file_handles'],
+                s['threads'], s['timers'], s['windows'], s['log_bytes'], s['spool_frames']))
+        lines.append('')
+        lines.append('Plug cycles: %i  popups: %i  tray icon changes: %i  balloons: %i  backend queries: %i' % (
+            self.user.cycles, self.popups, self.tray.icons_set, self.tray.balloons, self.provider.queries))
+        lines.append('Top allocation sites by growth since warm-up:')
+        for stat in self.growth[:top]:
+            lines.append('  %+9i B %+7i blocks  %s' % (stat.size_diff, stat.count_diff, stat.traceback))
+        return lines
+
+    def close(self):
+        shutil.rmtree(self.spool_dir, ignore_errors=True)
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(prog='lifesaver.soak',
+                                     description='Check that memory and handles level off over a long run')
+    parser.add_argument('--ticks', type=int, default=200000)
+    parser.add_argument('--checkpoints', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--max-growth', type=int, default=256 * 1024,
+                        help='bytes of traced memory growth allowed over the second half')
+    parser.add_argument('--trace-frames', type=int, default=1,
+                        help='stack depth recorded per allocation')
+    parser.add_argument('--log-level', default='CRITICAL',
+                        help='console logging level (default hides the simulated backend failures); '
+                             'the log files get everything, as in the app')
+    args = parser.parse_args(argv)
+    console = logging.StreamHandler()
+    console.setLevel(args.log_level.upper())
+    logging.getLogger().addHandler(console)
+    logging.getLogger().setLevel(logging.DEBUG)
+    # the app writes its logs to the working directory, so start with none
+    cwd = os.getcwd()
+    log_dir = tempfile.mkdtemp(prefix='lifesaver-soak-logs-')
+    os.chdir(log_dir)
+    soak = Soak(args.ticks, args.checkpoints, seed=args.seed, trace_frames=args.trace_frames)
+    try:
+        soak.run()
+    finally:
+        soak.close()
+        logging.shutdown()
+        os.chdir(cwd)
+        shutil.rmtree(log_dir, ignore_errors=True)
+    print('\n'.join(soak.report()))
+    failures = soak.verdict(args.max_growth)
+    if failures:
+        print('\nFAILED:\n  ' + '\n  '.join(failures))
+        return 1
+    print('\nPASSED: memory, objects, handles, threads, timers and windows reached a steady state')
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# coding=utf-8
+'''
+Vectorised power source aggregation.
+
+PowerSourceTable holds every power source (laptop and dock batteries, UPS
+units, HID devices) as struct-of-arrays NumPy columns, one element per source.
+aggregate() computes totals, per-source percentages, weighted time remaining
+and alert conditions in one pass of array operations, so its cost barely
+changes between one source and hundreds. Reading sources from a backend still
+visits each result object once; everything after that is vectorised.
+
+Requires NumPy, which the rest of Battery Lifesaver does not.
+'''
+from collections import namedtuple
+
+import numpy as np
+
+from lifesaver.sysfs import POWER_SUPPLY_PATH, SysfsProvider
+
+# source kinds; SYSTEM_KINDS power the machine itself and make up its totals
+BATTERY, UPS, DEVICE = 0, 1, 2
+KIND_NAMES = ['battery', 'ups', 'device']
+SYSTEM_KINDS = (BATTERY, UPS)
+
+# columns, their dtypes and the value of sources which don't give one. Capacities
+# in mWh and rates in mW, as WMI reports them. reported_charge is the proportion
+# of full charge for sources which report only that, such as many HID devices
+COLUMNS = [('kind', np.int8, 0),
+           ('remaining_capacity', np.float64, 0),
+           ('full_charge_capacity', np.float64, 0),
+           ('discharge_rate', np.float64, 0),
+           ('charge_rate', np.float64, 0),
+           ('power_online', np.bool_, False),
+           ('reported_charge', np.float64, np.nan)]
+
+Aggregate = namedtuple('Aggregate', [
+    'count', 'percentages', 'time_remaining', 'remaining_capacity', 'full_charge_capacity',
+    'percentage_charge_remaining', 'discharge_rate', 'charge_rate', 'plugged_in',
+    'weighted_time_remaining', 'remaining_by_kind', 'full_by_kind',
+    'low', 'high', 'should_plug_in', 'should_unplug'])
+
+
+class PowerSourceTable(object):
+    ''' Power sources as parallel arrays, plus a list of their names '''
+
+    def __init__(self, names, **columns):
+        self.names = list(names)
+        n = len(self.names)
+        for name, dtype, missing in COLUMNS:
+            values = columns.get(name)
+            column = np.full(n, missing, dtype) if values is None else np.asarray(values, dtype)
+            if column.shape != (n,):
+                raise ValueError('Column %s has shape %s, expected (%i,)' % (name, column.shape, n))
+            setattr(self, name, column)
+
+    def __len__(self):
+        return len(self.names)
+
+    @classmethod
+    def concatenate(cls, tables):
+        ''' Joins tables read from several backends into one '''
+        tables = list(tables)
+        names = [n for t in tables for n in t.names]
+        columns = dict((name, np.concatenate([getattr(t, name) for t in tables]) if tables
+                        else np.zeros(0, dtype)) for name, dtype, _missing in COLUMNS)
+        return cls(names, **columns)
+
+    @classmethod
+    def from_provider(cls, provider, kind=BATTERY, prefix='Battery'):
+        ''' Reads the BatteryStatus and BatteryFullChargedCapacity queries of a WMI
+            style provider. Batteries with no BatteryFullChargedCapacity row are
+            given a full charge capacity of 0 '''
+        statuses = list(provider.ExecQuery('Select * from BatteryStatus where Voltage > 0'))
+        capacities = list(provider.ExecQuery('Select * from BatteryFullChargedCapacity'))
+        n = len(statuses)
+        full = np.zeros(n, np.float64)
+        m = min(n, len(capacities))
+        full[:m] = np.fromiter(((c.FullChargedCapacity or 0) for c in capacities[:m]), np.float64, m)
+        return cls(['%s #%i' % (prefix, i + 1) for i in range(n)],
+                   kind=np.full(n, kind, np.int8),
+                   remaining_capacity=np.fromiter(((b.RemainingCapacity or 0) for b in statuses), np.float64, n),
+                   full_charge_capacity=full,
+                   discharge_rate=np.fromiter(((b.DischargeRate or 0) for b in statuses), np.float64, n),
+                   charge_rate=np.fromiter(((getattr(b, 'ChargeRate', 0) or 0) for b in statuses), np.float64, n),
+                   power_online=np.fromiter((bool(b.PowerOnline) for b in statuses), np.bool_, n))
+
+    @classmethod
+    def from_sysfs(cls, path=POWER_SUPPLY_PATH):
+        ''' Reads batteries, UPS units and HID device batteries from sysfs. Devices
+            with scope "Device" (mice, keyboards, headsets) are kept apart from the
+            batteries powering the machine. Those which only report a capacity
+            percentage have it in reported_charge, and no capacities '''
+        records = SysfsProvider(path).supply_records()
+        n = len(records)
+        return cls([r.Name for r in records],
+                   kind=[DEVICE if r.Scope == 'Device' else UPS if r.Type == 'UPS' else BATTERY
+                         for r in records],
+                   remaining_capacity=np.fromiter((r.RemainingCapacity for r in records), np.float64, n),
+                   full_charge_capacity=np.fromiter((r.FullChargedCapacity for r in records), np.float64, n),
+                   discharge_rate=np.fromiter((r.DischargeRate for r in records), np.float64, n),
+                   charge_rate=np.fromiter((r.ChargeRate for r in records), np.float64, n),
+                   power_online=np.fromiter((r.PowerOnline for r in records), np.bool_, n),
+                   reported_charge=np.fromiter((r.Capacity / 100.0
+                                                if not r.FullChargedCapacity and r.Capacity is not None
+                                                else np.nan for r in records), np.float64, n))
+
+
+def aggregate(table, plugin_level=0.3, unplug_level=0.8, plugin_alert_enabled=True,
+              unplug_alert_enabled=True):
+    ''' Computes everything the monitor needs from a PowerSourceTable in one
+        vectorised pass. Totals, time remaining and the plug/unplug conditions
+        cover the system's own batteries and UPSes; percentages and the low/high
+        flags are per source, HID devices included, taken from reported_charge
+        where a source has no capacities. The charge is None if no
+        system battery reports its capacity. should_plug_in and should_unplug
+        are only set while the matching alert is enabled '''
+    kind = table.kind
+    remaining = table.remaining_capacity
+    full = table.full_charge_capacity
+    discharge = table.discharge_rate
+    system = np.isin(kind, SYSTEM_KINDS)
+
+    reported = table.reported_charge
+    has_reported = reported == reported # False only for NaN
+    percentages = np.where(has_reported, reported, 0.0)
+    np.divide(remaining, full, out=percentages, where=full > 0)
+    np.minimum(percentages, 1.0, out=percentages)
+    time_remaining = np.divide(remaining, discharge, out=np.full_like(remaining, np.inf), where=discharge > 0)
+
+    total_remaining = remaining[system].sum()
+    total_full = full[system].sum()
+    total_discharge = discharge[system].sum()
+    charge = min(total_remaining / total_full, 1.0) if total_full > 0 else None
+    # remaining capacity over total drain weights each source by what it can
+    # still supply, rather than averaging each source's own estimate
+    weighted = total_remaining / total_discharge if total_discharge > 0 else None
+    plugged_in = bool(table.power_online[system].any())
+
+    known = (full > 0) | has_reported
+    low = known & (percentages < plugin_level) & ~table.power_online
+    high = known & (percentages > unplug_level) & table.power_online
+    kinds = len(KIND_NAMES)
+    return Aggregate(len(table), percentages, time_remaining, total_remaining, total_full, charge,
+                     total_discharge, table.charge_rate[system].sum(), plugged_in, weighted,
+                     np.bincount(kind, weights=remaining, minlength=kinds).astype(np.float64),
+                     np.bincount(kind, weights=full, minlength=kinds).astype(np.float64),
+                     low, high,
+                     bool(plugin_alert_enabled and charge is not None and
+                          charge < plugin_level and not plugged_in),
+                     bool(unplug_alert_enabled and charge is not None and
+                          charge > unplug_level and plugged_in))
+
+
+def benchmark(counts=(1, 10, 100, 1000), repeat=1000):
+    ''' Returns microseconds per aggregate() call for tables of each size '''
+    import time
+    rng = np.random.default_rng(0)
+    results = {}
+    for n in counts:
+        full = rng.uniform(20000, 1000000, n)
+        table = PowerSourceTable(['source %i' % i for i in range(n)],
+                                 kind=rng.integers(0, len(KIND_NAMES), n),
+                                 remaining_capacity=full * rng.uniform(0, 1, n),
+                                 full_charge_capacity=full,
+                                 discharge_rate=rng.uniform(0, 50000, n),
+                                 power_online=rng.uniform(0, 1, n) < 0.5)
+        started = time.perf_counter()
+        for _i in range(repeat):
+            aggregate(table)
+        results[n] = (time.perf_counter() - started) / repeat * 1e6
+    return results
+
+
+if __name__ == '__main__':
+    for n, micros in sorted(benchmark().items()):
+        print('%5i sources: %7.1f us per aggregate' % (n, micros))
@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+# coding=utf-8
+'''
+Startup helpers.
+
+StartupTimeline records how long each startup step takes, from the moment the
+process started, and logs the result once startup is finished.
+BackgroundConnector opens backend connections concurrently on worker threads
+so the tray icon can be shown before any of them are ready.
+'''
+import os
+import sys
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+def process_age():
+    ''' Returns the secs since this process was created, or None if the
+        platform does not say '''
+    try:
+        if sys.platform == 'win32':
+            return _windows_process_age()
+        if os.path.exists('/proc/self/stat'):
+            return _proc_process_age()
+    except Exception:
+        logger.debug('Could not read the process start time', exc_info=True)
+    return None
+
+
+def _proc_process_age():
+    with open('/proc/self/stat') as f:
+        # the command name is in parentheses and may contain spaces
+        fields = f.read().rpartition(')')[2].split()
+    started = int(fields[19]) / float(os.sysconf('SC_CLK_TCK')) # field 22, starttime
+    with open('/proc/uptime') as f:
+        uptime = float(f.read().split()[0])
+    return uptime - started
+
+
+def _windows_process_age():
+    import ctypes
+    from ctypes import wintypes
+    kernel32 = ctypes.windll.kernel32
+    creation, exited, kernel, user, now = [wintypes.FILETIME() for _i in range(5)]
+    if not kernel32.GetProcessTimes(kernel32.GetCurrentProcess(), ctypes.byref(creation),
+                                    ctypes.byref(exited), ctypes.byref(kernel), ctypes.byref(user)):
+        return None
+    kernel32.GetSystemTimeAsFileTime(ctypes.byref(now))
+
+    def ticks(filetime): # 100 ns units
+        return (filetime.dwHighDateTime << 32) | filetime.dwLowDateTime
+    return (ticks(now) - ticks(creation)) / 1e7
+
+
+class StartupTimeline(object):
+    ''' Named marks and spans, in milliseconds since the process started, or
+        since the timeline was created where the process start time is unknown '''
+
+    def __init__(self):
+        created = time.perf_counter()
+        age = process_age()
+        self.t0 = created - age if age is not None and age >= 0 else created
+        self.lock = threading.Lock()
+        self.events = [] # (start ms, end ms, name, thread name)
+        self.logged = False
+        if self.t0 != created:
+            self._add(0.0, self.now(), 'interpreter startup and imports')
+
+    def now(self):
+        return (time.perf_counter() - self.t0) * 1000
+
+    def mark(self, name):
+        at = self.now()
+        self._add(at, at, name)
+
+    @contextmanager
+    def span(self, name):
+        started = self.now()
+        try:
+            yield
+        finally:
+            self._add(started, self.now(), name)
+
+    def _add(self, start, end, name):
+        with self.lock:
+            self.events.append((start, end, name, threading.current_thread().name))
+
+    def lines(self):
+        with self.lock:
+            events = sorted(self.events)
+        return ['%8.1f ms %8.1f ms  %-36s [%s]' % (start, end - start, name, thread)
+                for start, end, name, thread in events]
+
+    def log(self, title='Startup timeline'):
+        ''' Logs the timeline once; later calls do nothing '''
+        if self.logged:
+            return
+        self.logged = True
+        logger.info('%s (start, duration, step, thread):\n%s', title, '\n'.join(self.lines()))
+
+
+TIMELINE = StartupTimeline()
+
+
+class _Marshalled(object):
+    __slots__ = ['stream']
+
+    def __init__(self, stream):
+        self.stream = stream
+
+
+class WMIConnection(object):
+    ''' Factory for a connection to the WMI namespace at moniker, which
+        BackgroundConnector opens on a worker thread and hands over to the
+        thread that uses it. Without COM, such as on Linux, fallback is called
+        instead '''
+
+    def __init__(self, moniker, fallback):
+        self.moniker = moniker
+        self.fallback = fallback
+
+    def __call__(self):
+        return self.fallback()
+
+    def open_com(self):
+        ''' Returns the SWbemServices object, as wmi.WMI(moniker=...) would connect '''
+        import win32com.client
+        logger.info('Connecting to WMI namespace %s', self.moniker)
+        return win32com.client.GetObject('winmgmts:' + self.moniker)
+
+
+def _initialise_com():
+    ''' Joins the worker thread to the multithreaded COM apartment, if COM is
+        available. The apartment is left initialised so that connections created
+        in it stay usable after the worker exits '''
+    if sys.platform != 'win32':
+        return False
+    try:
+        import pythoncom
+    except ImportError:
+        return False
+    pythoncom.CoInitializeEx(pythoncom.COINIT_MULTITHREADED)
+    return True
+
+
+def _marshal(services):
+    ''' Marshals a COM SWbemServices object so another thread can use it '''
+    import pythoncom
+    return _Marshalled(pythoncom.CoMarshalInterThreadInterfaceInStream(
+        pythoncom.IID_IDispatch, services._oleobj_))
+
+
+def _unmarshal(value):
+    ''' Returns a wmi namespace for a marshalled SWbemServices object, on the
+        calling thread. Other values are returned as they are '''
+    if not isinstance(value, _Marshalled):
+        return value
+    import pythoncom
+    import win32com.client
+    import wmi
+    dispatch = pythoncom.CoGetInterfaceAndReleaseStream(value.stream, pythoncom.IID_IDispatch)
+    return wmi.WMI(wmi=win32com.client.Dispatch(dispatch), find_classes=False)
+
+
+class BackgroundConnector(object):
+    ''' Calls each connection factory on its own worker thread. The results are
+        collected with result(name) on the thread that will use them. Where COM
+        is available, WMIConnection factories are opened as COM objects and
+        marshalled to that thread '''
+
+    def __init__(self, factories, timeline=TIMELINE):
+        self.timeline = timeline
+        self.factories = dict(factories)
+        self.results = {}
+        self.errors = {}
+        self.threads = []
+        for name in self.factories:
+            self._start(name)
+
+    def _start(self, name):
+        thread = threading.Thread(target=self._open, args=(name, self.factories[name]),
+                                  name='lifesaver-connect-%s' % name, daemon=True)
+        thread.start()
+        self.threads.append(thread)
+
+    def retry(self, name):
+        ''' Discards a failed connection attempt and starts another '''
+        self.errors.pop(name, None)
+        self.results.pop(name, None)
+        self.threads = [t for t in self.threads if t.is_alive()]
+        self._start(name)
+
+    def _open(self, name, factory):
+        with self.timeline.span('open %s' % name):
+            try:
+                com = _initialise_com()
+                if com and isinstance(factory, WMIConnection):
+                    self.results[name] = _marshal(factory.open_com())
+                else:
+                    self.results[name] = factory()
+            except Exception as e:
+                logger.exception('Failed to open %s connection', name)
+                self.errors[name] = e
+
+    def done(self, name=None):
+        if name is not None:
+            return name in self.results or name in self.errors
+        return not any(t.is_alive() for t in self.threads)
+
+    def result(self, name):
+        ''' Returns a connection, waiting for it if necessary. Raises the error
+            from the worker if it could not be opened '''
+        for thread in self.threads:
+            if thread.name == 'lifesaver-connect-%s' % name:
+                thread.join()
+        if name in self.errors:
+            raise self.errors[name]
+        value = self.results[name] = _unmarshal(self.results[name])
+        return value
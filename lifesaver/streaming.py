@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# coding=utf-8
+'''
+asyncio interface to BatteryMonitor.
+
+A single sampler task reads a Snapshot in an executor thread and fans it out to
+every subscriber. Each subscriber has a bounded queue; when a consumer falls
+behind, its oldest undelivered items are dropped so the sampler never blocks.
+A WMI connection belongs to the thread that opened it, so the monitor's is
+marshalled to the sampler thread rather than used from it directly.
+'''
+import sys
+import asyncio
+import logging
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+Event = namedtuple('Event', ['kind', 'timestamp', 'snapshot'])
+
+
+def _marshal_provider(provider):
+    ''' Returns provider's WMI connection marshalled for another thread, or None
+        if it is not a COM object, as with sysfs and fake providers '''
+    # a wmi.WMI namespace's SWbemServices, which instrumentation passes through
+    namespace = getattr(provider, '_namespace', None)
+    if sys.platform != 'win32' or namespace is None:
+        return None
+    from lifesaver.startup import _marshal
+    return _marshal(namespace)
+
+
+class Subscription(object):
+    ''' Bounded, drop-oldest queue belonging to one consumer '''
+
+    def __init__(self, maxsize, interval=0):
+        self.queue = asyncio.Queue(maxsize)
+        self.interval = interval
+        self.last_delivered = None
+        self.dropped = 0
+
+    def offer(self, item, timestamp=None):
+        if timestamp is not None and self.last_delivered is not None:
+            # allow a little jitter so a subscriber at the sampling interval isn't skipped
+            if timestamp - self.last_delivered < self.interval * 0.9:
+                return
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(item)
+        if timestamp is not None:
+            self.last_delivered = timestamp
+
+
+class SnapshotHub(object):
+    ''' Shares one sampler between any number of snapshot streams and event
+        subscribers. The sampler runs at the shortest interval any stream has
+        asked for, and stops when the last subscriber leaves '''
+
+    def __init__(self, batt_mon, interval=2.0, executor=None):
+        self.batt_mon = batt_mon
+        self.interval = interval # used when only events are subscribed to
+        self.provider = None # the sampler thread's own connection, if the monitor's is COM
+        # one worker thread keeps backend reads serialised
+        self.executor = executor or ThreadPoolExecutor(1, 'lifesaver-sampler', self._init_worker,
+                                                       (_marshal_provider(batt_mon.t),))
+        self.streams = set()
+        self.subscribers = set()
+        self.task = None
+        self.latest = None
+
+    async def stream(self, interval=2.0, maxsize=16):
+        subscription = Subscription(maxsize, interval)
+        self._attach(self.streams, subscription)
+        try:
+            while True:
+                yield await subscription.queue.get()
+        finally:
+            self._detach(self.streams, subscription)
+
+    async def events(self, maxsize=64):
+        subscription = Subscription(maxsize)
+        self._attach(self.subscribers, subscription)
+        try:
+            while True:
+                yield await subscription.queue.get()
+        finally:
+            self._detach(self.subscribers, subscription)
+
+    def _init_worker(self, marshalled):
+        ''' WMI needs COM initialised on the thread that queries it '''
+        try:
+            import pythoncom
+        except ImportError:
+            return
+        pythoncom.CoInitialize()
+        if marshalled is not None:
+            from lifesaver.startup import _unmarshal
+            self.provider = _unmarshal(marshalled)
+
+    def _sample(self):
+        return self.batt_mon.snapshot(self.provider)
+
+    @property
+    def sampling_interval(self):
+        if self.streams:
+            return min(s.interval for s in self.streams)
+        return self.interval
+
+    def _attach(self, group, subscription):
+        group.add(subscription)
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self._run())
+
+    def _detach(self, group, subscription):
+        group.discard(subscription)
+        if not self.streams and not self.subscribers and self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            try:
+                snapshot = await loop.run_in_executor(self.executor, self._sample)
+            except Exception:
+                logger.exception('Failed to read battery snapshot')
+            else:
+                self.publish(snapshot)
+            await asyncio.sleep(max(0, self.sampling_interval - (loop.time() - started)))
+
+    def publish(self, snapshot):
+        ''' Delivers a snapshot to every stream, and any events it implies to every
+            event subscriber '''
+        previous, self.latest = self.latest, snapshot
+        for subscription in self.streams:
+            subscription.offer(snapshot, snapshot.timestamp)
+        for event in self.detect_events(previous, snapshot):
+            for subscription in self.subscribers:
+                subscription.offer(event)
+
+    def detect_events(self, previous, snapshot):
+        ''' Returns Events for power changes, and for alert conditions that have
+            become true since the previous snapshot '''
+        events = []
+        if previous is not None and previous.plugged_in != snapshot.plugged_in:
+            kind = 'plugged_in' if snapshot.plugged_in else 'unplugged'
+            events.append(Event(kind, snapshot.timestamp, snapshot))
+        alerting = self._alerting(previous) if previous is not None else set()
+        for kind in sorted(self._alerting(snapshot) - alerting):
+            events.append(Event(kind, snapshot.timestamp, snapshot))
+        return events
+
+    def _alerting(self, snapshot):
+        ''' The kinds of alert the monitor would raise for snapshot, evaluated
+            without fresh backend queries '''
+        mon = self.batt_mon
+        kinds = set(alert.kind for alert in mon.check_alerts(snapshot))
+        if mon.check_fully_charged(snapshot) is not None:
+            kinds.add('fully_charged')
+        return kinds
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# coding=utf-8
+'''
+Linux power supply provider.
+
+Reads battery state from the sysfs power_supply class and presents it through
+the same ExecQuery interface as the WMI root/wmi namespace, so BatteryMonitor
+works unchanged on machines without WMI.
+'''
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+POWER_SUPPLY_PATH = '/sys/class/power_supply'
+
+
+class Record(object):
+    ''' Minimal stand-in for a WMI result object '''
+
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+    def __repr__(self):
+        return 'Record(%s)' % ', '.join('%s=%r' % kv for kv in sorted(self.__dict__.items()))
+
+
+class SysfsProvider(object):
+    ''' Answers the BatteryStatus and BatteryFullChargedCapacity queries used by
+        BatteryMonitor from /sys/class/power_supply. Capacities are reported in
+        mWh and rates in mW, matching the units WMI uses '''
+
+    def __init__(self, path=POWER_SUPPLY_PATH):
+        self.path = path
+
+    def ExecQuery(self, query):
+        if 'BatteryFullChargedCapacity' in query:
+            return [Record(FullChargedCapacity=self._energy(b, 'full'))
+                    for b in self.batteries()]
+        if 'BatteryStatus' in query:
+            online = self.power_online()
+            return [self._status(b, online) for b in self.batteries()]
+        raise ValueError('Unsupported query: %s' % query)
+
+    def supplies(self):
+        try:
+            names = sorted(os.listdir(self.path))
+        except OSError:
+            return []
+        return [os.path.join(self.path, n) for n in names]
+
+    def batteries(self):
+        ''' Returns the sysfs directories of all present system batteries, including
+            UPSes. Batteries in peripherals, such as HID mice and headsets, have
+            scope Device and are left out '''
+        return [s for s in self.supplies()
+                if self._read(s, 'type') in ('Battery', 'UPS') and self._read(s, 'present') != '0'
+                and self._read(s, 'scope') != 'Device']
+
+    def supply_records(self):
+        ''' Returns a Record for each present battery and UPS, peripherals
+            included. Each has the BatteryStatus fields, FullChargedCapacity,
+            the supply's Name, Type and Scope, and Capacity, the percentage
+            charge reported by the driver or None '''
+        online = self.power_online()
+        records = []
+        for s in self.supplies():
+            supply_type = self._read(s, 'type')
+            if supply_type not in ('Battery', 'UPS') or self._read(s, 'present') == '0':
+                continue
+            record = self._status(s, online)
+            record.Name = os.path.basename(s)
+            record.Type = supply_type
+            record.Scope = self._read(s, 'scope')
+            record.FullChargedCapacity = self._energy(s, 'full')
+            capacity = self._read(s, 'capacity')
+            record.Capacity = int(capacity) if capacity and capacity.isdigit() else None
+            records.append(record)
+        return records
+
+    def power_online(self):
+        ''' Returns True if any mains or USB supply is online, or a UPS is running
+            from the mains. A UPS reports this with online, or failing that by
+            not discharging '''
+        for s in self.supplies():
+            supply_type = self._read(s, 'type')
+            if supply_type in ('Mains', 'USB') and self._read(s, 'online') == '1':
+                return True
+            if supply_type == 'UPS' and self._ups_online(s):
+                return True
+        return False
+
+    def _ups_online(self, ups):
+        online = self._read(ups, 'online')
+        if online is not None:
+            return online == '1'
+        return self._read(ups, 'status') in ('Charging', 'Full', 'Not charging')
+
+    def _status(self, battery, online):
+        rate = self._power(battery)
+        status = self._read(battery, 'status')
+        return Record(PowerOnline=online,
+                      Charging=status == 'Charging',
+                      Discharging=status == 'Discharging',
+                      RemainingCapacity=self._energy(battery, 'now'),
+                      DischargeRate=rate if status == 'Discharging' else 0,
+                      ChargeRate=rate if status == 'Charging' else 0,
+                      Voltage=self._int(battery, 'voltage_now') // 1000)
+
+    def _energy(self, battery, which):
+        ''' Returns energy_<which> in mWh, deriving it from charge_<which> if the
+            driver only reports charge '''
+        energy = self._int(battery, 'energy_%s' % which)
+        if energy:
+            return energy // 1000
+        charge = self._int(battery, 'charge_%s' % which)
+        return charge * self._int(battery, 'voltage_now') // 10 ** 9
+
+    def _power(self, battery):
+        ''' Returns power_now in mW, deriving it from current_now if required '''
+        power = self._int(battery, 'power_now')
+        if power:
+            return abs(power) // 1000
+        current = self._int(battery, 'current_now')
+        return abs(current) * self._int(battery, 'voltage_now') // 10 ** 9
+
+    def _int(self, supply, attr):
+        value = self._read(supply, attr)
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return 0
+
+    def _read(self, supply, attr):
+        try:
+            with open(os.path.join(supply, attr)) as f:
+                return f.read().strip()
+        except (IOError, OSError):
+            return None
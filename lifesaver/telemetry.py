@@ -0,0 +1,434 @@
+#!/usr/bin/env python
+# coding=utf-8
+'''
+Fleet telemetry agent.
+
+Buffers BatteryMonitor snapshots and alerts locally and uploads them to a
+collector in compressed, batched frames (see lifesaver.frames). Uploads are
+spaced out while nothing interesting is happening so that the network radio
+is not woken for every sample. Frames that cannot be delivered are spooled to
+disk and retried with exponential backoff. With background=True uploads run on
+a worker thread, so a slow or unreachable collector never holds up the caller.
+'''
+import os
+import time
+import queue
+import random
+import logging
+import threading
+from array import array
+
+from lifesaver.frames import COLUMNS, FrameError, encode_frame, decode_frame
+
+logger = logging.getLogger(__name__)
+
+try:
+    _cpu_clock = time.thread_time
+except AttributeError:
+    _cpu_clock = time.process_time
+
+
+class FrameRejected(IOError):
+    ''' The collector refused a frame, so sending it again will not help '''
+
+
+class HTTPTransport(object):
+    ''' POSTs frames to a collector URL. A 4xx response, other than a timeout
+        or rate limit, raises FrameRejected '''
+
+    def __init__(self, url, timeout=10):
+        self.url = url
+        self.timeout = timeout
+
+    def __call__(self, frame):
+        from urllib.error import HTTPError
+        from urllib.request import Request, urlopen
+        request = Request(self.url, data=frame, method='POST',
+                          headers={'Content-Type': 'application/x-lifesaver-frame'})
+        try:
+            with urlopen(request, timeout=self.timeout) as response:
+                if response.status >= 300:
+                    raise IOError('Collector returned HTTP %i' % response.status)
+        except HTTPError as e:
+            if 400 <= e.code < 500 and e.code not in (408, 429):
+                raise FrameRejected('Collector rejected frame with HTTP %i' % e.code)
+            raise
+
+
+class Spool(object):
+    ''' Directory of undelivered frames, oldest first. Once max_bytes is reached
+        the oldest frames are discarded. Frames which cannot be decoded, or which
+        the collector rejects, are set aside as .bad files, keeping the newest
+        max_quarantined, so they do not hold up the frames behind them '''
+
+    def __init__(self, path, max_bytes=16 * 1024 * 1024, max_quarantined=8):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_quarantined = max_quarantined
+        self.lock = threading.RLock() # frames are pushed and sent from different threads
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        names = sorted(n for n in os.listdir(path) if n.endswith(('.frame', '.frame.bad')))
+        self.sequence = int(names[-1].split('.')[0]) + 1 if names else 0
+
+    def _names(self):
+        return sorted(n for n in os.listdir(self.path) if n.endswith('.frame'))
+
+    def __len__(self):
+        return len(self._names())
+
+    def push(self, frame):
+        with self.lock:
+            name = os.path.join(self.path, '%012d.frame' % self.sequence)
+            self.sequence += 1
+            with open(name + '.tmp', 'wb') as f:
+                f.write(frame)
+            os.replace(name + '.tmp', name)
+            self._trim()
+
+    def peek(self):
+        ''' Returns (name, frame) for the oldest spooled frame, or None '''
+        with self.lock:
+            names = self._names()
+            if not names:
+                return None
+            with open(os.path.join(self.path, names[0]), 'rb') as f:
+                return names[0], f.read()
+
+    def remove(self, name):
+        ''' Removes a frame, if it has not already been trimmed '''
+        with self.lock:
+            try:
+                os.remove(os.path.join(self.path, name))
+            except FileNotFoundError:
+                pass
+
+    def quarantine(self, name):
+        with self.lock:
+            try:
+                os.replace(os.path.join(self.path, name), os.path.join(self.path, name + '.bad'))
+            except FileNotFoundError:
+                return
+            bad = sorted(n for n in os.listdir(self.path) if n.endswith('.frame.bad'))
+            for old in bad[:max(0, len(bad) - self.max_quarantined)]:
+                self.remove(old)
+
+    def _trim(self):
+        names = self._names()
+        sizes = [os.path.getsize(os.path.join(self.path, n)) for n in names]
+        total = sum(sizes)
+        for name, size in zip(names, sizes):
+            if total <= self.max_bytes:
+                break
+            logger.warning('Telemetry spool full, discarding %s', name)
+            self.remove(name)
+            total -= size
+
+
+class TelemetryAgent(object):
+    ''' Buffers samples and alert events and uploads them in batches.
+
+        The upload interval starts at min_interval and doubles after each quiet
+        upload, up to max_interval. Buffering an alert or power change resets it
+        to min_interval. A batch is also sent once max_batch samples are held.
+        Failed uploads back off exponentially, up to max_backoff secs. Each
+        upload sends at most max_frames spooled frames, so a long backlog is
+        worked through over several uploads rather than all at once.
+
+        With background=True, batches that come due are handed to a worker
+        thread through a queue of max_queued frames, and spooled if it is
+        full. close() stops the worker '''
+
+    def __init__(self, device_id, transport, spool_dir=None, min_interval=60,
+                 max_interval=900, max_batch=512, max_backoff=3600, clock=time.time,
+                 report_interval=3600, max_frames=8, background=False, max_queued=16):
+        self.device_id = device_id
+        self.transport = transport
+        self.spool = Spool(spool_dir) if spool_dir else None
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.max_batch = max_batch
+        self.max_backoff = max_backoff
+        self.clock = clock
+        self.report_interval = report_interval # secs between logging overhead()
+        self.max_frames = max_frames # spooled frames sent per upload
+        self.interval = min_interval
+        self.failures = 0
+        self.next_attempt = 0
+        self.last_plugged_in = None
+        self.eventful = False
+        self.stats = {'samples': 0, 'events': 0, 'frames_sent': 0, 'frames_spooled': 0,
+                      'frames_rejected': 0, 'upload_failures': 0, 'raw_bytes': 0,
+                      'bytes_sent': 0, 'cpu_seconds': 0.0}
+        self.stats_lock = threading.Lock()
+        self.upload_lock = threading.Lock()
+        self._reset_buffer()
+        self.last_flush = self.last_report = clock()
+        self.queue = self.worker = None
+        if background:
+            self.queue = queue.Queue(max_queued)
+            self.worker = threading.Thread(target=self._work, name='lifesaver-telemetry', daemon=True)
+            self.worker.start()
+
+    def _reset_buffer(self):
+        self.columns = dict((name, array(typecode)) for name, typecode in COLUMNS)
+        self.events = []
+
+    def add_sample(self, snapshot):
+        ''' Buffers a Snapshot, then uploads if a batch is due '''
+        started = _cpu_clock()
+        c = self.columns
+        c['timestamp'].append(snapshot.timestamp)
+        c['remaining_capacity'].append(int(snapshot.remaining_capacity))
+        c['full_charge_capacity'].append(int(snapshot.full_charge_capacity))
+        c['discharge_rate'].append(int(snapshot.discharge_rate))
+        c['charge_rate'].append(int(snapshot.charge_rate))
+        c['plugged_in'].append(1 if snapshot.plugged_in else 0)
+        self._count('samples')
+        if self.last_plugged_in is not None and snapshot.plugged_in != self.last_plugged_in:
+            self._add_event(snapshot.timestamp, 'plugged_in' if snapshot.plugged_in else 'unplugged')
+        self.last_plugged_in = snapshot.plugged_in
+        self._count('cpu_seconds', _cpu_clock() - started)
+        self.maybe_flush()
+
+    def add_alert(self, alert):
+        ''' Buffers an Alert. Can be used directly as a daemon alert sink '''
+        self._add_event(self.clock(), alert.kind)
+
+    def add_gap(self, gap):
+        ''' Records a suspend or clock change as an event, so a jump in the
+            samples is not mistaken for a change in the battery '''
+        self._add_event(gap.timestamp, gap.kind)
+
+    def _add_event(self, timestamp, kind):
+        self.events.append((timestamp, kind))
+        self._count('events')
+        self.eventful = True
+        self.interval = self.min_interval
+
+    @property
+    def pending(self):
+        return len(self.columns['timestamp'])
+
+    def due(self):
+        now = self.clock()
+        if now < self.next_attempt:
+            return False
+        if self.pending >= self.max_batch:
+            return True
+        has_data = self.pending or self.events or (self.spool and len(self.spool))
+        return bool(has_data) and now - self.last_flush >= self.interval
+
+    def maybe_flush(self):
+        if not self.due():
+            return
+        if self.queue is None:
+            self.flush()
+            return
+        frame = self._take_frame()
+        try:
+            self.queue.put_nowait(frame)
+        except queue.Full:
+            if frame:
+                self._keep(frame)
+
+    def flush(self):
+        ''' Encodes the buffer into a frame and uploads it, along with up to
+            max_frames spooled frames, on the calling thread. Returns True if
+            everything sent was delivered '''
+        return self._upload(self._take_frame())
+
+    def close(self, timeout=None):
+        ''' Stops the background worker, waiting up to timeout secs for the
+            upload in progress, and spools whatever has not been sent. Without
+            a spool the remaining samples are sent once on the calling thread '''
+        if self.worker is not None:
+            frames = []
+            while True:
+                try:
+                    frames.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            self.queue.put(None)
+            self.worker.join(timeout)
+            if self.worker.is_alive():
+                logger.warning('Telemetry upload still in progress at exit')
+            self.worker = self.queue = None
+            for frame in frames:
+                if frame:
+                    self._keep(frame)
+        frame = self._take_frame()
+        if frame and self.spool is not None:
+            self._keep(frame)
+        elif frame:
+            self._send(frame)
+
+    def _work(self):
+        while True:
+            frame = self.queue.get()
+            if frame is None:
+                return
+            try:
+                self._upload(frame)
+            except Exception:
+                logger.exception('Telemetry upload failed')
+
+    def _take_frame(self):
+        ''' Encodes and clears the buffer. Returns the frame, or b'' if there
+            was nothing buffered '''
+        started = _cpu_clock()
+        frame = b''
+        if self.pending or self.events:
+            frame = encode_frame(self.device_id, self.columns, self.events)
+            self._count('raw_bytes', sum(len(c) * c.itemsize for c in self.columns.values()))
+            self._reset_buffer()
+        self.last_flush = self.clock()
+        self._count('cpu_seconds', _cpu_clock() - started)
+        if self.last_flush - self.last_report >= self.report_interval:
+            self.last_report = self.last_flush
+            self.log_overhead()
+        return frame
+
+    def _upload(self, frame):
+        started = _cpu_clock()
+        try:
+            with self.upload_lock:
+                delivered = self._deliver_spooled() and (not frame or self._send(frame) is not False)
+                if not delivered and frame:
+                    self._keep(frame)
+                self._schedule(delivered)
+                return delivered
+        finally:
+            self._count('cpu_seconds', _cpu_clock() - started)
+
+    def _count(self, key, n=1):
+        with self.stats_lock:
+            self.stats[key] += n
+
+    def _deliver_spooled(self):
+        for _i in range(self.max_frames if self.spool is not None else 0):
+            item = self.spool.peek()
+            if item is None:
+                break
+            name, frame = item
+            try:
+                decode_frame(frame)
+            except FrameError as e:
+                logger.warning('Quarantining undecodable spooled frame %s: %s', name, e)
+                self.spool.quarantine(name)
+                continue
+            sent = self._send(frame)
+            if sent is False:
+                return False
+            if sent is None:
+                self.spool.quarantine(name)
+            else:
+                self.spool.remove(name)
+        return True
+
+    def _send(self, frame):
+        ''' Returns True if the frame was delivered, False if it should be sent
+            again later, or None if the collector rejected it '''
+        try:
+            self.transport(frame)
+        except FrameRejected as e:
+            self._count('frames_rejected')
+            logger.warning('Telemetry frame of %i bytes rejected: %s', len(frame), e)
+            return None
+        except Exception as e:
+            self._count('upload_failures')
+            logger.info('Telemetry upload failed: %s', e)
+            return False
+        self._count('frames_sent')
+        self._count('bytes_sent', len(frame))
+        return True
+
+    def _keep(self, frame):
+        if self.spool is None:
+            logger.warning('Telemetry upload failed with no spool, dropping %i bytes', len(frame))
+            return
+        self.spool.push(frame)
+        self._count('frames_spooled')
+
+    def _schedule(self, delivered):
+        if delivered:
+            self.failures = 0
+            self.next_attempt = 0
+            # a backlog left by max_frames keeps the interval short until it is sent
+            if not self.eventful and not (self.spool and len(self.spool)):
+                self.interval = min(self.interval * 2, self.max_interval)
+            self.eventful = False
+        else:
+            self.failures += 1
+            backoff = min(self.max_backoff, self.min_interval * 2 ** (self.failures - 1))
+            self.next_attempt = self.clock() + backoff * random.uniform(0.5, 1.0)
+            logger.info('Retrying telemetry upload in up to %i secs', backoff)
+
+    def overhead(self):
+        ''' Returns a summary of the agent's own bandwidth and CPU use '''
+        with self.stats_lock:
+            stats = dict(self.stats)
+        raw = stats['raw_bytes']
+        stats['compression_ratio'] = raw / float(stats['bytes_sent']) if stats['bytes_sent'] else None
+        stats['bytes_per_sample'] = stats['bytes_sent'] / float(stats['samples']) if stats['samples'] else None
+        stats['spooled_frames'] = len(self.spool) if self.spool is not None else 0
+        return stats
+
+    def log_overhead(self):
+        stats = self.overhead()
+        logger.info('Telemetry overhead: %i samples, %i frames sent in %i bytes (%.1fx compression), '
+                    '%i upload failures, %i frames rejected, %i spooled, %.3f CPU secs',
+                    stats['samples'], stats['frames_sent'], stats['bytes_sent'],
+                    stats['compression_ratio'] or 0, stats['upload_failures'],
+                    stats['frames_rejected'], stats['spooled_frames'], stats['cpu_seconds'])
+
+
+class StandInCollector(object):
+    ''' Minimal local collector for exercising an agent. Decodes and keeps every
+        frame it receives; set failing to simulate the collector being offline.
+
+            with StandInCollector() as collector:
+                agent = TelemetryAgent('test', HTTPTransport(collector.url))
+    '''
+
+    def __init__(self, host='127.0.0.1', port=0):
+        from http.server import HTTPServer, BaseHTTPRequestHandler
+        stand_in = self
+        self.frames = []
+        self.failing = False
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if stand_in.failing:
+                    self.send_response(503)
+                else:
+                    try:
+                        stand_in.frames.append(decode_frame(body))
+                    except FrameError:
+                        self.send_response(400)
+                    else:
+                        self.send_response(204)
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self.server = HTTPServer((host, port), Handler)
+        self.url = 'http://%s:%i/ingest' % self.server.server_address
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
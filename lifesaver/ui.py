@@ -9,22 +9,26 @@ Created on 4 Feb 2014
 import os
 import re
 import webbrowser
-import wmi
 import winsound
-from math import floor
-import monitor
-
 import wx
 
-import icons
+from lifesaver import governor
+from lifesaver import icons
+from lifesaver import monitor
+from lifesaver.instrument import Instrumentation
+from lifesaver.resume import SuspendDetector
+from lifesaver.startup import TIMELINE, BackgroundConnector, WMIConnection
 
 # Logging setup
 import logging
+import logging.handlers
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
-debug_handler = logging.FileHandler('bl.debug.log')
+debug_handler = logging.handlers.RotatingFileHandler('bl.debug.log', maxBytes=monitor.LOG_MAX_BYTES,
+                                                     backupCount=monitor.LOG_BACKUP_COUNT)
 debug_handler.setLevel(logging.DEBUG)
-info_handler = logging.FileHandler('bl.info.log')
+info_handler = logging.handlers.RotatingFileHandler('bl.info.log', maxBytes=monitor.LOG_MAX_BYTES,
+                                                    backupCount=monitor.LOG_BACKUP_COUNT)
 info_handler.setLevel(logging.INFO)
 formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 debug_handler.setFormatter(formatter)
@@ -40,37 +44,86 @@ ID_SCREEN_BRIGHTNESS = wx.NewId()
 ID_POWER_OPTIONS = wx.NewId()
 ID_MOBILITY_CENTER = wx.NewId()
 ID_NOTIFICATION_ICONS = wx.NewId()
+ID_PROFILE = wx.NewId()
+ID_GOVERNOR = wx.NewId()
 
 class BatteryTaskBarIcon(wx.TaskBarIcon):
     ''' Notification area (system tray) icon for output to user about their
-        battery status '''
-    def __init__(self, frame):
+        battery status. connections replaces any of the connection factories
+        opened at startup, as the soak test does with a fake backend '''
+    def __init__(self, frame, connections=None):
         wx.TaskBarIcon.__init__(self)
         self.frame = frame
         self.monitor_frequency = 2 # how often to check levels (secs)
         self.full_charge_reminder_frequency = 300 # how often to remind that battery is full (secs)
-        self.batt_mon = monitor.BatteryMonitor()
-        self.icon = self.ChooseIcon.GetIcon()
-        self.SetIcon(self.icon, self.Tooltip)
+        self.batt_mon = monitor.BatteryMonitor(defer=True)
+        self.instrumentation = Instrumentation(self.batt_mon)
+        self.instrumentation_dump = 'bl_instrument.json'
+        self.icon_cache = {} # decoded wx.Icons, keyed by embedded image
+        self.displayed = None # (embedded image, tooltip) currently shown
+        self.options_window = None
+        self.update_timer = None
+        self.full_charge_timer = None
+        self.menu = None # built on first right click
+        self.plugged_in = None
+        self.power_plans = None
+        self.governor = None
+        self.suspend_detector = SuspendDetector(self.monitor_frequency)
+        self.start_governor = False # set before startup finishes to start the governor
+        self.connect_retry_delay = 1 # secs before retrying a failed battery connection
+        self.SetIcon(wx.ArtProvider.GetIcon(wx.ART_INFORMATION, wx.ART_OTHER, (16, 16)),
+                     "Battery Lifesaver is starting")
+        TIMELINE.mark('placeholder icon shown')
+        factories = {'battery': WMIConnection(monitor.BATTERY_MONIKER, monitor.default_provider),
+                     'power plans': WMIConnection(monitor.POWER_PLANS_MONIKER, monitor.connect_power_plans),
+                     'system info': self.batt_mon.record_system_info}
+        factories.update(connections or {})
+        self.connector = BackgroundConnector(factories)
         self.BindEvents()
-        self.CreateMenu()
-        self.Update()
+        wx.CallAfter(self.FinishStartup)
+
+    def FinishStartup(self):
+        ''' Starts monitoring once the battery connection has been opened in the
+            background, checking back until it is ready. If it fails, it is
+            retried with the delay doubling each time, up to a minute '''
+        if not self.connector.done('battery'):
+            wx.CallLater(50, self.FinishStartup)
+            return
+        try:
+            self.batt_mon.attach(self.connector.result('battery'))
+        except Exception:
+            logger.exception("Battery information unavailable; retrying in %i secs" % self.connect_retry_delay)
+            self.SetIcon(wx.ArtProvider.GetIcon(wx.ART_WARNING, wx.ART_OTHER, (16, 16)),
+                         "Battery information unavailable")
+            wx.CallLater(self.connect_retry_delay * 1000, self.RetryBatteryConnection)
+            self.connect_retry_delay = min(self.connect_retry_delay * 2, 60)
+            return
+        self.instrumentation.wrap_provider()
+        if self.start_governor:
+            self.StartGovernor()
+        with TIMELINE.span('first update'):
+            self.Update()
+        self.full_charge_timer = wx.CallLater(self.full_charge_reminder_frequency * 1000,
+                                              self.CheckFullyChargedBalloon)
+        TIMELINE.log()
+
+    def RetryBatteryConnection(self):
+        self.connector.retry('battery')
+        self.FinishStartup()
+
+    def PowerPlansConnection(self):
+        ''' Returns the power plans WMI connection opened at startup '''
+        if self.power_plans is None:
+            try:
+                self.power_plans = self.connector.result('power plans')
+            except Exception:
+                self.power_plans = monitor.connect_power_plans()
+        return self.power_plans
     
     @property
     def Tooltip(self):
         ''' Generates a tooltip which replicates the Windows Battery Monitor '''
-        charge = self.batt_mon.percentage_charge_remaining * 100
-        if self.batt_mon.is_plugged_in:
-            if self.batt_mon.is_fully_charged:
-                tooltip = "Fully charged (100%)"
-            else:
-                tooltip = "%i%% available (plugged in, charging)" % (charge)
-        elif not self.batt_mon.is_plugged_in:
-            time_remaining = self.batt_mon.time_remaining
-            if not time_remaining is None:
-                tooltip = "%s (%i%%) remaining" % (time_remaining, charge)
-            else:
-                tooltip = "%i%% remaining" % (charge)
+        tooltip = self.batt_mon.tooltip
         logger.debug("Tooltip is %s" % tooltip)
         return tooltip
     
@@ -78,12 +131,7 @@ class BatteryTaskBarIcon(wx.TaskBarIcon):
     def ChooseIcon(self):
         ''' Returns the appropriate icon for the current charge level and whether
             the laptop is connected to a power supply '''
-        charge = self.batt_mon.percentage_charge_remaining * 100
-        charge = int(floor(charge/20)*20) # round down to nearest multiple of 20
-        if self.batt_mon.is_plugged_in:
-            ico = icons.icons["%s%03d" % ("battery_charging_", charge)]
-        else:
-            ico = icons.icons["%s%03d" % ("battery_discharging_", charge)]
+        ico = icons.icons[self.batt_mon.icon_name]
         logger.debug("Icon is %s" % ico)
         self.current_icon = ico
         return ico
@@ -91,67 +139,111 @@ class BatteryTaskBarIcon(wx.TaskBarIcon):
     def Update(self):
         logger.info('')        
         logger.info('Updating')        
-        self.RefreshIcon()
-        self.ResetAlertsBasedOnPowerStatus()
-        self.CheckAlertBalloons()
-        wx.CallLater(self.full_charge_reminder_frequency * 1000,
-                     self.CheckFullyChargedBalloon)
-        wx.CallLater(self.monitor_frequency * 1000,
-                     self.Update)
+        instrumentation = self.instrumentation
+        try:
+            with instrumentation.tick():
+                gap = self.suspend_detector.check()
+                if gap is not None:
+                    self.Resumed(gap)
+                if self.plugged_in:
+                    # once per update, for the tooltip to read
+                    with instrumentation.phase('SampleCharging'):
+                        self.batt_mon.sample_charging()
+                with instrumentation.phase('RefreshIcon'):
+                    self.RefreshIcon()
+                with instrumentation.phase('ResetAlertsBasedOnPowerStatus'):
+                    self.ResetAlertsBasedOnPowerStatus()
+                with instrumentation.phase('CheckAlertBalloons'):
+                    self.CheckAlertBalloons()
+                if self.governor is not None:
+                    with instrumentation.phase('Governor'):
+                        self.governor.update(self.batt_mon.snapshot())
+        finally:
+            # a failed query must not stop the updates
+            self.ScheduleUpdate()
+
+    def Resumed(self, gap):
+        ''' Resets estimates after a suspend. The overdue full charge reminder
+            is checked now and its timer restarted, rather than firing
+            separately. A wall clock step leaves them alone '''
+        if not gap.suspended:
+            return
+        self.batt_mon.resumed(gap)
+        if self.governor is not None:
+            self.governor.resumed(gap)
+        if self.full_charge_timer is not None:
+            self.CheckFullyChargedBalloon()
+
+    def OnPowerResume(self, event):
+        ''' Updates straight away on resume, through the usual update timer so
+            only one update runs '''
+        logger.info("Resumed from suspend")
+        self.suspend_detector.notify()
+        if self.update_timer is not None:
+            self.update_timer.Restart(1)
+        event.Skip()
+
+    def ScheduleUpdate(self):
+        ''' Schedules the next Update, reusing one timer rather than creating
+            a new one every tick '''
+        if self.update_timer is None:
+            self.update_timer = wx.CallLater(self.monitor_frequency * 1000, self.Update)
+        else:
+            self.update_timer.Restart(self.monitor_frequency * 1000)
     
     def CheckFullyChargedBalloon(self):
         ''' Tests if fully charged and fires alert if required '''
-        if (self.batt_mon.is_fully_charged and
-            self.batt_mon.is_plugged_in and
-            self.batt_mon.fully_charged_alert_enabled):
-            logger.info("Showing fully charged balloon notification")
-            self.ShowBalloon("Fully charged",
-                             "Your battery is now charged to 100%.")
+        try:
+            alert = self.batt_mon.check_fully_charged()
+            if alert is not None:
+                logger.info("Showing fully charged balloon notification")
+                self.ShowBalloon(alert.title, alert.message)
+        finally:
+            self.full_charge_timer.Restart(self.full_charge_reminder_frequency * 1000)
     
     def ResetAlertsBasedOnPowerStatus(self):
         ''' Tests if plugged in and resets alerts if required'''
-        if self.batt_mon.is_plugged_in:
-            logger.info('Plugged in. Resetting stored battery time-remaining values')
-            self.batt_mon.reset_time_remaining_queue
-            if not self.batt_mon.plugin_alert_enabled:
-                logger.info('Plugged in. Resetting plugin alert')
-                self.batt_mon.plugin_alert_enabled = True
-        elif not self.batt_mon.is_plugged_in:
-            if not self.batt_mon.unplug_alert_enabled:            
-                logger.info('Not plugged in. Resetting unplug alert')            
-                self.batt_mon.unplug_alert_enabled = True
-            if not self.batt_mon.fully_charged_alert_enabled:
-                logger.info('Not plugged in. Resetting fully charged alert')            
-                self.batt_mon.fully_charged_alert_enabled = True
-            
+        self.plugged_in = self.batt_mon.reset_alerts_based_on_power_status()
+        self.UpdateMenuState()
+
+    def UpdateMenuState(self):
+        ''' Enables only the silence options relevant to the power status. Does
+            nothing until the menu has been built '''
+        if self.menu is None or self.plugged_in is None:
+            return
+        plugged_in = self.plugged_in
         self.menu.Enable(id=ID_SILENCE_FULLY_CHARGED_ALERT,
                          enable=(self.batt_mon.fully_charged_alert_enabled and
-                                 self.batt_mon.is_plugged_in)) 
+                                 plugged_in)) 
         self.menu.Enable(id=ID_SILENCE_PLUGIN_ALERT,
                          enable=(self.batt_mon.plugin_alert_enabled and
-                                 not self.batt_mon.is_plugged_in))
+                                 not plugged_in))
         self.menu.Enable(id=ID_SILENCE_UNPLUG_ALERT,
                          enable=(self.batt_mon.unplug_alert_enabled and
-                                 self.batt_mon.is_plugged_in)) 
+                                 plugged_in)) 
     
     def CheckAlertBalloons(self):
-        charge = self.batt_mon.percentage_charge_remaining
-        if self.batt_mon.should_unplug():
-            self.ShowBalloon("Unplug charger",
-                             "Battery charge is at %i%%. Unplug your charger now to maintain battery life." % (charge * 100))
-            logger.info("Showing unplug balloon notification")
-            winsound.MessageBeep(winsound.MB_ICONASTERISK)
-        if self.batt_mon.should_plug_in():
-            self.ShowBalloon("Plug in charger",
-                             "Battery charge is at %i%%. Plug in your charger now to maintain battery life." % (charge * 100))
-            logger.info("Showing plug in balloon notification")
+        for alert in self.batt_mon.check_alerts():
+            self.ShowBalloon(alert.title, alert.message)
+            logger.info("Showing %s balloon notification" % alert.kind)
             winsound.MessageBeep(winsound.MB_ICONASTERISK)
     
     def RefreshIcon(self):
         ''' Sets the appropriate icon depending on power state '''
         logger.debug('Refreshing icon')
-        self.icon = self.ChooseIcon.GetIcon()
-        self.SetIcon(self.icon, self.Tooltip)        
+        ico = self.ChooseIcon
+        tooltip = self.Tooltip
+        if (ico, tooltip) != self.displayed:
+            self.icon = self.DecodedIcon(ico)
+            self.SetIcon(self.icon, tooltip)
+            self.displayed = (ico, tooltip)
+
+    def DecodedIcon(self, ico):
+        ''' Returns the wx.Icon for an embedded image, decoding each image only once '''
+        icon = self.icon_cache.get(ico)
+        if icon is None:
+            icon = self.icon_cache[ico] = ico.GetIcon()
+        return icon
     
     def BindEvents(self):
         ''' Binds the taskbar click events to their event handlers '''
@@ -183,6 +275,12 @@ class BatteryTaskBarIcon(wx.TaskBarIcon):
         self.menu.AppendSeparator()
         self.menu.Append(ID_NOTIFICATION_ICONS, 'Turn system icons on or off', 'Launch Windows Notification Area Icons Options dialogue')
         self.Bind(wx.EVT_MENU, self.LaunchNotificationAreaIconsOptions, id=ID_NOTIFICATION_ICONS)
+        self.menu.AppendCheckItem(ID_PROFILE, 'Record CPU &profile', 'Record where update time is spent')
+        self.menu.Check(ID_PROFILE, self.instrumentation.enabled)
+        self.Bind(wx.EVT_MENU, self.ToggleProfiling, id=ID_PROFILE)
+        self.menu.AppendCheckItem(ID_GOVERNOR, '&Automatic power plan', 'Switch power plans to stretch battery life')
+        self.menu.Check(ID_GOVERNOR, self.governor is not None)
+        self.Bind(wx.EVT_MENU, self.ToggleGovernor, id=ID_GOVERNOR)
         # About and Exit options
         self.menu.AppendSeparator()
         self.menu.Append(wx.ID_ABOUT, '&Website', 'About this program')
@@ -208,6 +306,34 @@ class BatteryTaskBarIcon(wx.TaskBarIcon):
         self.menu.Enable(id=ID_SILENCE_PLUGIN_ALERT, enable=False) 
         logger.info("Silencing plug in alert")
     
+    def ToggleProfiling(self, e):
+        ''' Starts or stops instrumentation and the sampling profiler, writing a
+            summary when stopped '''
+        if self.instrumentation.toggle():
+            self.instrumentation.start_profiler()
+        else:
+            self.instrumentation.stop_profiler()
+            self.instrumentation.dump(self.instrumentation_dump)
+        self.menu.Check(ID_PROFILE, self.instrumentation.enabled)
+
+    def StartGovernor(self):
+        ''' Starts switching power plans automatically, using the plans from
+            the connection opened at startup '''
+        try:
+            self.governor = governor.Governor(governor.default_backend(self.PowerPlansConnection()))
+        except Exception:
+            logger.exception("Power plans unavailable to the governor")
+
+    def ToggleGovernor(self, e):
+        ''' Starts or stops switching power plans automatically '''
+        if self.governor is None:
+            logger.info("Starting power plan governor")
+            self.StartGovernor()
+        else:
+            logger.info("Stopping power plan governor")
+            self.governor = None
+        self.menu.Check(ID_GOVERNOR, self.governor is not None)
+
     def LaunchPowerOptions(self, e):
         ''' Opens the Control Panel Power Options dialogue '''
         try:
@@ -225,13 +351,26 @@ class BatteryTaskBarIcon(wx.TaskBarIcon):
         os.system(os.path.join(windir, 'Sysnative\mblctr.exe'))
         
     def OnPopup(self, event):
-        ''' Generates the right click menu '''
+        ''' Generates the right click menu, building it the first time '''
+        if self.menu is None:
+            with TIMELINE.span('create menu'):
+                self.CreateMenu()
+                self.UpdateMenuState()
         self.PopupMenu(self.menu)
 
     def OnLeftClick(self, event):
         ''' Generates the left click ui '''
-        print "fired"
-        self.options_window = LeftClickFrame(self.GetParent())
+        logger.debug("Left click fired")
+        self.ShowOptionsWindow()
+
+    def ShowOptionsWindow(self):
+        ''' Opens the left click ui, first closing any that is still open so that
+            repeated clicks never leave windows behind '''
+        if not self.batt_mon.connected:
+            return
+        if self.options_window:
+            self.options_window.Destroy()
+        self.options_window = LeftClickFrame(self.frame)
 
     def OnExit(self, e):
         ''' Removes the icon from the notification area and closes the program '''
@@ -356,7 +495,7 @@ class LeftClickFrame(wx.Frame):
         txt = wx.StaticText(self.panel, wx.ID_ANY, 'Select a power plan:')
         txt.SetForegroundColour('gray')
         plans_vbox.Add(txt, flag=wx.LEFT)
-        plans = wmi.WMI(moniker = "//./root/cimv2/power").Win32_PowerPlan()
+        plans = self.tbicon.PowerPlansConnection().Win32_PowerPlan()
         self.names = [p.ElementName for p in plans]
         self.guids = [re.findall('\{(.*?)\}', p.InstanceID)[0] for p in plans]
         self.plan_is_active = [-1 if p.IsActive else 1 for p in plans]
@@ -386,20 +525,33 @@ class LeftClickFrame(wx.Frame):
      
 
 class TaskBarFrame(wx.Frame):
-    def __init__(self, parent, title):
+    def __init__(self, parent, title, connections=None):
         wx.Frame.__init__(self, parent, style=wx.FRAME_NO_TASKBAR)
-        self.tbicon = BatteryTaskBarIcon(self)
+        self.tbicon = BatteryTaskBarIcon(self, connections)
         wx.EVT_TASKBAR_LEFT_UP(self.tbicon, self.OnTaskBarLeftClick)
+        if hasattr(wx, 'EVT_POWER_RESUME'): # power events are only sent on Windows
+            self.Bind(wx.EVT_POWER_RESUME, self.tbicon.OnPowerResume)
 
     def OnTaskBarLeftClick(self, evt):
         ''' Creates/destroys left click menu '''
-        self.left_frame = LeftClickFrame(self)
+        self.tbicon.ShowOptionsWindow()
 
 
-def main():
+def main(args=None):
 
-    app = wx.App(False)
-    TaskBarFrame(None, "TaskBarFrame")
+    with TIMELINE.span('create wx.App'):
+        app = wx.App(False)
+    with TIMELINE.span('create tray icon'):
+        frame = TaskBarFrame(None, "TaskBarFrame")
+    if args is not None and (args.instrument or args.profile):
+        tbicon = frame.tbicon
+        tbicon.instrumentation_dump = args.instrument_dump
+        tbicon.instrumentation.enable()
+        if args.profile:
+            tbicon.instrumentation.start_profiler()
+        tbicon.instrumentation.install_signal_handlers(args.instrument_dump)
+    if args is not None and args.governor:
+        frame.tbicon.start_governor = True
     app.MainLoop()
     
 if __name__ == '__main__':
@@ -0,0 +1,25 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def pytest_configure(config):
+    # lifesaver.monitor opens its log files in the working directory on import
+    os.chdir(tempfile.mkdtemp(prefix='lifesaver-tests-'))
+
+
+@pytest.fixture
+def supply(tmp_path):
+    ''' Returns a function which adds a device to a fake /sys/class/power_supply
+        at tmp_path, with a file for each attribute '''
+    def add(name, **attrs):
+        path = tmp_path / name
+        path.mkdir()
+        for attr, value in attrs.items():
+            (path / attr).write_text('%s\n' % value)
+        return str(path)
+    return add
@@ -0,0 +1,36 @@
+import json
+
+from lifesaver import bench
+
+ARGS = ['--ticks', '20', '--batteries', '1', '--failure-rate', '0']
+
+
+def flagged(output, metric):
+    return [line for line in output.splitlines() if metric in line and line.endswith('REGRESSION')]
+
+
+def test_compare_detects_regression(tmp_path, capsys):
+    saved = str(tmp_path / 'before.json')
+    assert bench.main(ARGS + ['--save', saved]) is None
+    with open(saved) as f:
+        data = json.load(f)
+    assert [(r['kind'], r['plugged_in']) for r in data['results']] == [
+        ('tray', False), ('tray', True), ('daemon', False), ('daemon', True)]
+    for r in data['results']:
+        assert r['queries_per_tick'] > 0
+        assert r['failed_ticks'] == 0
+    # the real tray update reads the battery at least as often as a daemon tick
+    assert data['results'][0]['queries_per_tick'] >= data['results'][2]['queries_per_tick']
+    capsys.readouterr()
+
+    # query counts are deterministic, so an unchanged run never flags them
+    bench.main(ARGS + ['--compare', saved])
+    assert flagged(capsys.readouterr().out, 'queries_per_tick') == []
+
+    # as though the code being compared made twice as many queries as before
+    for r in data['results']:
+        r['queries_per_tick'] /= 2
+    with open(saved, 'w') as f:
+        json.dump(data, f)
+    assert bench.main(ARGS + ['--compare', saved]) == 1
+    assert len(flagged(capsys.readouterr().out, 'queries_per_tick')) == 4
@@ -0,0 +1,71 @@
+import pytest
+
+from lifesaver.charging import ChargeEstimator, backtest, noisy_samples, history_samples
+from lifesaver.fakes import FakeProvider
+from lifesaver.monitor import BatteryMonitor
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_backtest_on_noisy_sessions(seed):
+    result = backtest(noisy_samples(seed=seed), 0.8)
+    assert result['sessions_skipped'] == 0
+    assert result['predictions'] > 5000
+    assert result['mean_abs_error_min'] < 10
+    assert abs(result['bias_min']) < 5
+
+
+def test_single_low_rate_is_not_the_taper():
+    estimator = ChargeEstimator()
+    for i in range(10):
+        estimator.update(i * 10, 10000 + i * 50, 50000, 20000)
+    estimator.update(100, 10500, 50000, 15000)
+    assert not estimator.knee_observed
+    assert estimator.knee == ChargeEstimator.KNEE
+
+
+def test_backtest_from_history_file(tmp_path):
+    pytest.importorskip('numpy')
+    from lifesaver.history import HistoryWriter
+    path = str(tmp_path / 'battery.blh')
+    samples = list(noisy_samples(sessions=5))
+    with open(path, 'wb') as f:
+        writer = HistoryWriter(f)
+        for timestamp, remaining, full, charge_rate, plugged_in in samples:
+            writer.add_sample(timestamp, remaining, full, 0, round(charge_rate), plugged_in)
+        writer.flush()
+    recorded = backtest(history_samples([path]), 0.8)
+    direct = backtest(samples, 0.8)
+    assert recorded['predictions'] == direct['predictions']
+    assert recorded['mean_abs_error_min'] == pytest.approx(direct['mean_abs_error_min'], abs=0.5)
+
+
+def counting(monkeypatch, obj, name):
+    calls = []
+    method = getattr(obj, name)
+    monkeypatch.setattr(obj, name, lambda *args: calls.append(args) or method(*args))
+    return calls
+
+
+def test_tooltip_reads_estimate_without_sampling(monkeypatch):
+    provider = FakeProvider(plugged_in=True, charge=0.5)
+    batt_mon = BatteryMonitor(provider)
+    updates = counting(monkeypatch, batt_mon.charge_estimator, 'update')
+    assert batt_mon.tooltip == '50% available (plugged in, charging)'
+    assert batt_mon.time_to_unplug() is None
+    assert updates == []
+    batt_mon.sample_charging()
+    assert len(updates) == 1
+    batt_mon.tooltip
+    batt_mon.tooltip
+    assert len(updates) == 1
+
+
+def test_tray_samples_once_per_update(monkeypatch):
+    from lifesaver.bench import make_tray
+    provider = FakeProvider(plugged_in=True, charge=0.5)
+    tray, clock = make_tray(provider)
+    samples = counting(monkeypatch, tray.batt_mon, 'sample_charging')
+    for _i in range(5):
+        clock.advance(tray.monitor_frequency)
+        tray.ShowOptionsWindow() # the popup reads the tooltip too
+    assert len(samples) == 5
@@ -0,0 +1,115 @@
+import json
+import zlib
+import asyncio
+from array import array
+
+import pytest
+
+from lifesaver.collector import Collector, TimeSeriesIndex, synthetic_frames
+from lifesaver.frames import COLUMNS, encode_frame, decode_frame
+
+
+@pytest.fixture
+def collector():
+    collector = Collector()
+    for frames in synthetic_frames(5, 2, 10):
+        for frame in frames:
+            assert collector.route('POST', '/ingest', frame) == (204, b'')
+    return collector
+
+
+def test_queries(collector):
+    status, payload = collector.route('GET', '/query/charge?bins=4', b'')
+    assert status == 200 and sum(json.loads(payload)) == 5
+    status, payload = collector.route('GET', '/query/fade?threshold=0.1', b'')
+    assert status == 200
+    status, payload = collector.route('GET', '/stats', b'')
+    assert json.loads(payload)['frames'] == 10
+
+
+@pytest.mark.parametrize('target', ['/query/fade?threshold=abc', '/query/charge?max_age=soon',
+                                    '/query/charge?bins=x', '/query/charge?bins=0',
+                                    '/query/charge?bins=100000'])
+def test_bad_query_parameters(collector, target):
+    status, payload = collector.route('GET', target, b'')
+    assert status == 400
+    assert 'error' in json.loads(payload)
+
+
+@pytest.mark.parametrize('body', [b'', b'not zlib', encode_frame('x', dict(
+    (name, array(typecode)) for name, typecode in COLUMNS))[:-2]])
+def test_bad_frames(collector, body):
+    status, _payload = collector.route('POST', '/ingest', body)
+    assert status == 400
+    assert collector.rejected == 1
+
+
+def test_unknown_routes(collector):
+    assert collector.route('GET', '/nowhere', b'')[0] == 404
+    assert collector.route('PUT', '/ingest', b'')[0] == 405
+
+
+async def request(port, data):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(data)
+    response = await reader.read()
+    writer.close()
+    return response
+
+
+def test_bad_content_length():
+    async def run():
+        collector = await Collector(host='127.0.0.1', port=0).start()
+        try:
+            return await asyncio.wait_for(request(collector.port, b'POST /ingest HTTP/1.1\r\n'
+                                                  b'Content-Length: lots\r\n\r\n'), 5)
+        finally:
+            await collector.stop()
+    assert asyncio.run(run()).startswith(b'HTTP/1.1 400')
+
+
+def test_partitions_expire():
+    async def run():
+        index = TimeSeriesIndex(partition_secs=60, retention_secs=600)
+        for frames in synthetic_frames(2, 3, 50, start=1000.0):
+            for frame in frames:
+                index.ingest(decode_frame(frame))
+        collector = await Collector(index, host='127.0.0.1', port=0, expire_interval=0.01).start()
+        try:
+            await asyncio.sleep(0.1)
+        finally:
+            await collector.stop()
+        return index
+    index = asyncio.run(run())
+    assert all(not d.partitions for d in index.devices.values())
+
+
+def frame(timestamps, device_id='x'):
+    columns = dict((name, array(typecode, [0] * len(timestamps))) for name, typecode in COLUMNS)
+    columns['timestamp'] = array('d', timestamps)
+    columns['full_charge_capacity'] = array('I', [50000] * len(timestamps))
+    return encode_frame(device_id, columns)
+
+
+@pytest.mark.parametrize('bad', [float('nan'), float('inf'), float('-inf')])
+def test_non_finite_timestamps_rejected(collector, bad):
+    status, payload = collector.route('POST', '/ingest', frame([1000.0, bad, 1004.0]))
+    assert status == 400
+    assert b'finite' in payload
+    assert 'x' not in collector.index.devices
+
+
+def test_out_of_order_samples_are_sorted():
+    index = TimeSeriesIndex(partition_secs=60)
+    index.ingest(decode_frame(frame([100.0, 10.0, 70.0, 5.0, 130.0])))
+    assert list(index.series('x', 'timestamp')) == [5.0, 10.0, 70.0, 100.0, 130.0]
+    assert list(index.series('x', 'timestamp', 8.0, 100.0)) == [10.0, 70.0]
+    assert index.devices['x'].last_seen == 130.0
+
+
+def test_decompression_is_limited(collector):
+    bomb = zlib.compress(b'\0' * (64 * 1024 * 1024), 9)
+    assert len(bomb) < Collector.MAX_BODY
+    status, payload = collector.route('POST', '/ingest', bomb)
+    assert status == 400
+    assert b'more than' in payload
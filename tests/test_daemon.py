@@ -0,0 +1,74 @@
+from lifesaver.daemon import Daemon
+from lifesaver.fakes import FakeProvider
+from lifesaver.monitor import BatteryMonitor
+from lifesaver.resume import Gap
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_alert_repeats_are_rate_limited():
+    provider = FakeProvider(charge=0.2)
+    clock = Clock()
+    raised = []
+    daemon = Daemon(BatteryMonitor(provider), sinks=[raised.append], clock=clock,
+                    full_charge_reminder_frequency=300)
+    for _tick in range(151):
+        daemon.tick()
+        clock.now += 2
+    assert [a.kind for a in raised] == ['plugin', 'plugin']
+    # once the condition clears, the next time it is met alerts straight away
+    provider.plug_in()
+    daemon.tick()
+    provider.unplug()
+    clock.now += 2
+    daemon.tick()
+    assert [a.kind for a in raised] == ['plugin'] * 3
+
+
+def test_charging_ticks_query_once():
+    provider = FakeProvider(charge=0.3, plugged_in=True, cv_knee=0.8)
+    clock = Clock()
+    daemon = Daemon(BatteryMonitor(provider), sinks=[], clock=clock)
+    for tick in range(1000):
+        if tick == 100:
+            queries = provider.queries
+        daemon.tick()
+        provider.advance(2)
+        clock.now += 2
+    # reading the power status each tick, plus re-arming and a backstop check each minute
+    assert (provider.queries - queries) / 900.0 < 1.5
+
+
+def test_run_sleeps_by_the_monotonic_clock():
+    clock = Clock()
+    monotonic = Clock()
+    sleeps = []
+    daemon = Daemon(BatteryMonitor(FakeProvider()), sinks=[], clock=clock, sleep=sleeps.append,
+                    observers=[lambda snapshot: setattr(clock, 'now', clock.now - 3600)],
+                    monotonic=monotonic)
+    daemon.run(max_ticks=2)
+    # the wall clock stepping back an hour each tick does not lengthen the sleep
+    assert sleeps == [2, 2]
+
+
+def test_clock_step_keeps_estimates():
+    clock = Clock()
+    batt_mon = BatteryMonitor(FakeProvider(plugged_in=True))
+    resets, gaps = [], []
+    batt_mon.resumed = resets.append
+    daemon = Daemon(batt_mon, sinks=[], clock=clock, resume_listeners=[gaps.append])
+    daemon.tick()
+    armed = daemon.last_armed
+    daemon.resumed(Gap('clock_step', -3600, clock.now))
+    assert resets == [] and daemon.last_armed == armed
+    daemon.resumed(Gap('suspend', 3600, clock.now))
+    assert [g.kind for g in resets] == ['suspend'] and daemon.last_armed is None
+    # history and telemetry still mark both
+    assert [g.kind for g in gaps] == ['clock_step', 'suspend']
@@ -0,0 +1,187 @@
+import time
+import zlib
+import struct
+import threading
+
+import pytest
+
+from lifesaver.frames import FrameError, encode_frame, decode_frame
+from lifesaver.telemetry import FrameRejected, Spool, TelemetryAgent
+
+
+def columns(count=10):
+    return {'timestamp': [1000.0 + 2 * i for i in range(count)],
+            'remaining_capacity': [40000 - i for i in range(count)],
+            'full_charge_capacity': [50000] * count,
+            'discharge_rate': [9000] * count,
+            'charge_rate': [0] * count,
+            'plugged_in': [0] * count}
+
+
+def test_round_trip():
+    frame = decode_frame(encode_frame('laptop', columns(), [(1002.0, 'plugin')]))
+    assert frame.device_id == 'laptop'
+    assert frame.count == 10
+    for name, values in columns().items():
+        assert list(frame.columns[name]) == values
+    assert frame.events == [(1002.0, 'plugin')]
+
+
+def test_empty_frame():
+    frame = decode_frame(encode_frame('laptop', columns(0)))
+    assert frame.count == 0 and frame.events == []
+
+
+@pytest.mark.parametrize('cut', [0, 5, 12, 40, -3, -1])
+def test_truncated(cut):
+    raw = zlib.decompress(encode_frame('laptop', columns(), [(1002.0, 'plugin')]))
+    with pytest.raises(FrameError):
+        decode_frame(zlib.compress(raw[:cut]))
+
+
+def test_truncated_zlib():
+    with pytest.raises(FrameError):
+        decode_frame(encode_frame('laptop', columns())[:-4])
+
+
+@pytest.mark.parametrize('corrupt', [
+    lambda raw: b'XXXX' + raw[4:],
+    lambda raw: raw[:11] + b'\xff\xfe' + raw[13:], # device id is not UTF-8
+    lambda raw: raw[:-2] + b'{]', # events are not JSON
+    lambda raw: raw[:-struct.calcsize('<I') - 2] + struct.pack('<I', 2) + b'[1', # events not a list of pairs
+])
+def test_corrupt(corrupt):
+    raw = zlib.decompress(encode_frame('laptop', columns(1), []))
+    with pytest.raises(FrameError):
+        decode_frame(zlib.compress(corrupt(raw)))
+
+
+class Transport(object):
+
+    def __init__(self):
+        self.frames = []
+        self.failing = False
+        self.rejecting = False
+
+    def __call__(self, frame):
+        if self.failing:
+            raise IOError('offline')
+        if self.rejecting:
+            raise FrameRejected('HTTP 400')
+        self.frames.append(frame)
+
+
+class Snapshot(object):
+    plugged_in = False
+    remaining_capacity = 40000
+    full_charge_capacity = 50000
+    discharge_rate = 9000
+    charge_rate = 0
+
+    def __init__(self, timestamp):
+        self.timestamp = timestamp
+
+
+def test_spool_quarantines_undecodable_frames(tmp_path):
+    transport = Transport()
+    spool = Spool(str(tmp_path))
+    spool.push(encode_frame('laptop', columns())[:-4])
+    spool.push(encode_frame('laptop', columns()))
+    agent = TelemetryAgent('laptop', transport, spool_dir=str(tmp_path))
+    assert agent.flush()
+    assert len(transport.frames) == 1
+    assert len(spool) == 0
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['000000000000.frame.bad']
+
+
+def test_rejected_frames_are_not_retried(tmp_path):
+    transport = Transport()
+    agent = TelemetryAgent('laptop', transport, spool_dir=str(tmp_path))
+    transport.failing = True
+    agent.add_sample(Snapshot(1000.0))
+    assert not agent.flush()
+    assert len(agent.spool) == 1
+    transport.failing, transport.rejecting = False, True
+    assert agent.flush()
+    assert len(agent.spool) == 0
+    assert agent.overhead()['frames_rejected'] == 1
+    transport.rejecting = False
+    agent.add_sample(Snapshot(1002.0))
+    assert agent.flush()
+    assert len(transport.frames) == 1
+
+
+def test_quarantine_is_bounded(tmp_path):
+    spool = Spool(str(tmp_path), max_quarantined=2)
+    for _i in range(4):
+        spool.push(b'bad')
+        spool.quarantine(spool.peek()[0])
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['000000000002.frame.bad',
+                                                          '000000000003.frame.bad']
+
+
+def test_http_transport_rejection():
+    from lifesaver.telemetry import HTTPTransport, StandInCollector
+    with StandInCollector() as collector:
+        transport = HTTPTransport(collector.url)
+        transport(encode_frame('laptop', columns()))
+        with pytest.raises(FrameRejected):
+            transport(b'not a frame')
+        collector.failing = True
+        with pytest.raises(IOError) as raised:
+            transport(encode_frame('laptop', columns()))
+        assert not isinstance(raised.value, FrameRejected)
+    assert len(collector.frames) == 1
+
+
+def test_spool_backlog_sent_a_few_frames_at_a_time(tmp_path):
+    spool = Spool(str(tmp_path))
+    for _i in range(20):
+        spool.push(encode_frame('laptop', columns()))
+    transport = Transport()
+    agent = TelemetryAgent('laptop', transport, spool_dir=str(tmp_path), max_frames=8)
+    assert agent.flush()
+    assert len(transport.frames) == 8
+    assert len(spool) == 12
+    # the backlog keeps the upload interval short
+    assert agent.interval == agent.min_interval
+    agent.flush()
+    agent.flush()
+    assert len(transport.frames) == 20 and len(spool) == 0
+
+
+class SlowTransport(Transport):
+
+    def __init__(self):
+        Transport.__init__(self)
+        self.release = threading.Event()
+
+    def __call__(self, frame):
+        self.release.wait(10)
+        Transport.__call__(self, frame)
+
+
+def test_background_uploads_do_not_block(tmp_path):
+    transport = SlowTransport()
+    agent = TelemetryAgent('laptop', transport, spool_dir=str(tmp_path), max_batch=1,
+                           background=True, max_queued=2)
+    started = time.perf_counter()
+    for i in range(5):
+        agent.add_sample(Snapshot(1000.0 + 2 * i))
+    # the first upload is stuck in the transport; the queue holds two more and
+    # the rest are spooled rather than waited for
+    assert time.perf_counter() - started < 1
+    assert agent.overhead()['frames_spooled'] >= 2
+    transport.release.set()
+    agent.close(timeout=5)
+    assert agent.worker is None
+    delivered = sum(decode_frame(f).count for f in transport.frames)
+    assert delivered + len(Spool(str(tmp_path))) == 5
+
+
+def test_close_spools_unsent_samples(tmp_path):
+    transport = Transport()
+    agent = TelemetryAgent('laptop', transport, spool_dir=str(tmp_path), background=True)
+    agent.add_sample(Snapshot(1000.0))
+    agent.close(timeout=5)
+    assert len(agent.spool) == 1 and not transport.frames
@@ -0,0 +1,152 @@
+import random
+
+from lifesaver.governor import Governor, SAVER, BALANCED, PERFORMANCE, TIERS
+from lifesaver.monitor import Snapshot
+
+
+class Backend(object):
+
+    def __init__(self, tier=BALANCED):
+        self.tier = tier
+
+    def tiers(self):
+        return list(TIERS)
+
+    def active(self):
+        return self.tier
+
+    def activate(self, tier):
+        self.tier = tier
+
+
+def snapshot(t, charge, rate=10000, full=50000.0, plugged_in=False):
+    remaining = charge * full
+    return Snapshot(t, plugged_in, remaining, full, charge, rate, 0, remaining / rate if rate else None)
+
+
+def discharge(seed, noise=0.0, full=50000.0):
+    ''' Runs a governor from full to 10% with a discharge rate that varies
+        between half and two and a half times 10 W every minute or two '''
+    rng = random.Random(seed)
+    governor = Governor(Backend())
+    remaining, t, factor, next_change = full, 0.0, 1.0, 0
+    while remaining > 0.1 * full:
+        if t >= next_change:
+            factor = rng.uniform(0.5, 2.5)
+            next_change = t + rng.uniform(30, 120)
+        rate = 10000 * factor
+        governor.update(snapshot(t, remaining / full + rng.uniform(-noise, noise), rate, full))
+        remaining -= rate * 2 / 3600.0
+        t += 2
+    return governor
+
+
+def test_varying_load_does_not_flap():
+    for seed in range(5):
+        for noise in (0, 0.03):
+            governor = discharge(seed, noise)
+            tiers = [s.new for s in governor.switches]
+            # performance while charged, then balanced, then saver for good
+            assert len(tiers) <= 5, (seed, noise, tiers)
+            assert tiers[-1] == SAVER
+            assert tiers.count(SAVER) <= 2
+
+
+def test_tier_kept_for_min_dwell():
+    governor = Governor(Backend(), min_dwell=300)
+    governor.update(snapshot(0, 0.9))
+    assert governor.tier == PERFORMANCE
+    # a drop below the performance level has to wait out the dwell time
+    t = 2
+    while t < 300:
+        governor.update(snapshot(t, 0.7))
+        assert governor.tier == PERFORMANCE
+        t += 2
+    governor.update(snapshot(t, 0.7))
+    assert governor.tier == BALANCED
+
+
+def test_charge_hysteresis():
+    governor = Governor(Backend(), min_dwell=0, charge_window=1, hours_margin=0)
+    governor.update(snapshot(0, 0.4, rate=1000))
+    assert governor.tier == SAVER
+    governor.update(snapshot(2, 0.43, rate=1000))
+    assert governor.tier == SAVER
+    for t in range(4, 30, 2):
+        governor.update(snapshot(t, 0.46, rate=1000))
+    assert governor.tier == BALANCED
+
+
+def test_saver_left_only_once_forecast_recovers():
+    governor = Governor(Backend(), min_dwell=0, window=60)
+    # 50% charge at 20 W is 1.25 hours
+    for t in range(0, 600, 2):
+        governor.update(snapshot(t, 0.5, rate=20000))
+    assert governor.tier == SAVER
+    # at 15 W the forecast of 1.7 hours is clear of 1.5 hours but within the margin
+    for t in range(600, 1200, 2):
+        governor.update(snapshot(t, 0.5, rate=15000))
+    assert governor.tier == SAVER
+    # at 10 W, 2.5 hours is enough
+    for t in range(1200, 1800, 2):
+        governor.update(snapshot(t, 0.5, rate=10000))
+    assert governor.tier == BALANCED
+
+
+def test_saver_held_until_forecast_after_resume():
+    governor = Governor(Backend(), min_dwell=0)
+    for t in range(0, 600, 2):
+        governor.update(snapshot(t, 0.5, rate=20000))
+    assert governor.tier == SAVER
+    governor.resumed()
+    governor.update(snapshot(600, 0.5, rate=0))
+    assert governor.tier == SAVER
+
+
+def test_clock_step_keeps_forecast():
+    from lifesaver.resume import Gap
+    governor = Governor(Backend(), min_dwell=0)
+    for t in range(0, 600, 2):
+        governor.update(snapshot(t, 0.5, rate=20000))
+    hours = governor.hours
+    assert hours is not None
+    governor.resumed(Gap('clock_step', 3600, 600))
+    assert governor.hours == hours
+
+
+def plans_backend(active):
+    from lifesaver.fakes import FakePowerPlans
+    from lifesaver.governor import WindowsPlans
+    plans = FakePowerPlans(FakePowerPlans.PLANS + [('0b4a12c4-9d7e-4bd1-b3ba-0a8f9c2f3a77', 'Gaming')],
+                           active=active)
+    backend = WindowsPlans(plans)
+    backend.activate = lambda tier: setattr(plans, 'active', backend.guids[tier])
+    return plans, backend
+
+
+def test_custom_plan_is_left_alone():
+    from lifesaver.governor import CUSTOM
+    plans, backend = plans_backend('0b4a12c4-9d7e-4bd1-b3ba-0a8f9c2f3a77')
+    assert backend.tiers() == TIERS
+    assert backend.active() == CUSTOM
+    governor = Governor(backend, min_dwell=0)
+    for t in range(0, 600, 2):
+        governor.update(snapshot(t, 0.2))
+    governor.update(snapshot(600, 0.9, plugged_in=True))
+    assert plans.active == '0b4a12c4-9d7e-4bd1-b3ba-0a8f9c2f3a77'
+    assert governor.overridden
+    assert not governor.switches
+
+
+def test_switching_to_custom_plan_is_a_manual_choice():
+    plans, backend = plans_backend('381b4222-f694-41f0-9685-ff5bb260df2e')
+    governor = Governor(backend, min_dwell=0)
+    governor.update(snapshot(0, 0.9))
+    assert governor.tier == PERFORMANCE
+    plans.active = '0b4a12c4-9d7e-4bd1-b3ba-0a8f9c2f3a77'
+    governor.update(snapshot(2, 0.2))
+    assert governor.overridden
+    assert plans.active == '0b4a12c4-9d7e-4bd1-b3ba-0a8f9c2f3a77'
+    # still the user's choice after the next change in power status
+    governor.update(snapshot(4, 0.2, plugged_in=True))
+    assert plans.active == '0b4a12c4-9d7e-4bd1-b3ba-0a8f9c2f3a77'
@@ -0,0 +1,137 @@
+import io
+import struct
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from lifesaver.history import (HEADER, LENGTH, HistoryError, HistoryReader, HistoryWriter,
+                               decode_deltas, _encode_column)
+
+
+def samples(count=1000, start=1.0e9):
+    for i in range(count):
+        plugged_in = (i // 300) % 2
+        yield (start + i * 2.0 + (0.001 if i % 7 == 0 else 0), 40000 + (i if plugged_in else -i),
+               50000, 0 if plugged_in else 9000 + i % 13, 25000 if plugged_in else 0, plugged_in)
+
+
+def write(rows, block_size=256):
+    buf = io.BytesIO()
+    writer = HistoryWriter(buf, block_size=block_size)
+    for row in rows:
+        writer.add_sample(*row)
+    writer.flush()
+    return buf.getvalue()
+
+
+def read(data):
+    return HistoryReader(io.BytesIO(data)).read()
+
+
+def test_round_trip():
+    rows = list(samples())
+    history = read(write(rows))
+    assert len(history['timestamp']) == len(rows)
+    assert np.allclose(history['timestamp'], [r[0] for r in rows], atol=0.0005)
+    for i, name in enumerate(['remaining_capacity', 'full_charge_capacity', 'discharge_rate',
+                              'charge_rate', 'plugged_in'], 1):
+        assert history[name].tolist() == [r[i] for r in rows]
+
+
+def test_empty_history():
+    history = read(write([]))
+    assert len(history['timestamp']) == 0
+
+
+def test_gap_ends_block():
+    buf = io.BytesIO()
+    writer = HistoryWriter(buf)
+    rows = list(samples(10))
+    for row in rows[:5]:
+        writer.add_sample(*row)
+    writer.mark_gap()
+    for row in rows[5:]:
+        writer.add_sample(*row)
+    writer.flush()
+    buf.seek(0)
+    assert [len(b['timestamp']) for b in HistoryReader(buf)] == [5, 5]
+
+
+@pytest.mark.parametrize('values', [[0], [5, -5, 1 << 40, -(1 << 40), 0], list(range(-300, 300, 7))])
+def test_decode_deltas(values):
+    encoded = bytearray()
+    _encode_column(values, encoded)
+    assert decode_deltas(np.frombuffer(bytes(encoded), np.uint8)).tolist() == values
+
+
+@pytest.mark.parametrize('cut', [1, 3, LENGTH.size, LENGTH.size + 10])
+def test_truncated_last_block(cut):
+    data = write(samples(), block_size=256)
+    history = read(data[:-cut])
+    # the complete blocks before it are kept
+    assert len(history['timestamp']) == 768
+
+
+def test_truncated_header():
+    with pytest.raises(HistoryError):
+        read(write(samples(10))[:HEADER.size - 1])
+
+
+def test_wrong_magic():
+    data = write(samples(10))
+    with pytest.raises(HistoryError):
+        read(b'XXXX' + data[4:])
+
+
+def test_corrupt_block():
+    data = bytearray(write(samples(), block_size=256))
+    # flip bits in the middle of the first block's deflate stream
+    data[HEADER.size + LENGTH.size + 20] ^= 0xff
+    with pytest.raises(HistoryError):
+        read(bytes(data))
+
+
+def test_block_with_wrong_count():
+    import zlib
+    payload = zlib.decompress(write(samples(10))[HEADER.size + LENGTH.size:])
+    block = zlib.compress(b'\x0b' + payload[1:]) # claims 11 samples
+    data = write([]) + struct.pack('<I', len(block)) + block
+    with pytest.raises(HistoryError):
+        read(data)
+
+
+@pytest.mark.parametrize('cut', [1, LENGTH.size + 10])
+def test_append_after_truncated_block(tmp_path, cut):
+    path = str(tmp_path / 'battery.blh')
+    rows = list(samples())
+    with open(path, 'wb') as f:
+        f.write(write(rows[:900], block_size=256)[:-cut])
+    writer = HistoryWriter.open(path, block_size=256)
+    for row in rows[900:]:
+        writer.add_sample(*row)
+    writer.close()
+    with open(path, 'rb') as f:
+        history = HistoryReader(f).read()
+    # the three complete blocks, then everything appended
+    assert len(history['timestamp']) == 768 + 100
+    assert history['remaining_capacity'].tolist()[768:] == [r[1] for r in rows[900:]]
+
+
+def test_open_keeps_resolution_and_creates(tmp_path):
+    path = str(tmp_path / 'battery.blh')
+    writer = HistoryWriter.open(path, resolution=0.5)
+    writer.close()
+    writer = HistoryWriter.open(path)
+    assert writer.resolution == 0.5
+    writer.close()
+    with open(path, 'rb') as f:
+        assert HistoryReader(f).resolution == 0.5
+
+
+def test_open_refuses_other_files(tmp_path):
+    path = tmp_path / 'other.txt'
+    path.write_bytes(b'not a history file at all')
+    with pytest.raises(HistoryError):
+        HistoryWriter.open(str(path))
+    assert path.read_bytes() == b'not a history file at all'
@@ -0,0 +1,183 @@
+import os
+import json
+import time
+import signal
+import timeit
+import tracemalloc
+
+import pytest
+
+from lifesaver.fakes import FakeProvider
+from lifesaver.instrument import (Histogram, Instrumentation, InstrumentedProvider, NULL_CONTEXT,
+                                  SamplingProfiler, query_label)
+from lifesaver.monitor import BatteryMonitor
+
+
+def instrumented(**kwargs):
+    provider = FakeProvider()
+    return provider, Instrumentation(BatteryMonitor(provider), **kwargs)
+
+
+def test_histogram_percentiles():
+    histogram = Histogram()
+    assert histogram.percentile(50) == 0.0
+    for _i in range(90):
+        histogram.add(100e-6)
+    for _i in range(10):
+        histogram.add(0.01)
+    # the upper bound of the power of two bucket, but never more than the maximum
+    assert histogram.percentile(50) == 128e-6
+    assert histogram.percentile(90) == 128e-6
+    assert histogram.percentile(99) == 0.01
+    assert histogram.percentile(100) == 0.01
+    summary = histogram.summary()
+    assert summary['count'] == 100
+    assert summary['mean_ms'] == pytest.approx(1.09)
+    assert summary['max_ms'] == 10
+
+
+def test_query_label():
+    assert query_label('Select * from BatteryStatus where Voltage > 0') == 'BatteryStatus'
+    assert query_label('SELECT DischargeRate FROM BatteryStatus') == 'BatteryStatus'
+    assert query_label('Select * from') == 'Select * from'
+    assert query_label('BatteryStatus') == 'BatteryStatus'
+
+
+def test_provider_wrapped_only_while_enabled():
+    provider, instrumentation = instrumented()
+    batt_mon = instrumentation.batt_mon
+    assert batt_mon.t is provider
+    instrumentation.enable()
+    instrumentation.enable()
+    assert isinstance(batt_mon.t, InstrumentedProvider)
+    assert batt_mon.t.provider is provider
+    # anything other than queries passes through to the provider
+    assert batt_mon.t.plug_in == provider.plug_in
+    instrumentation.disable()
+    assert batt_mon.t is provider
+
+
+def test_provider_attached_later_is_wrapped():
+    batt_mon = BatteryMonitor(defer=True)
+    instrumentation = Instrumentation(batt_mon, enabled=True)
+    batt_mon.attach(FakeProvider())
+    instrumentation.wrap_provider()
+    assert isinstance(batt_mon.t, InstrumentedProvider)
+
+
+def test_queries_and_phases_recorded_per_tick():
+    provider, instrumentation = instrumented(enabled=True)
+    batt_mon = instrumentation.batt_mon
+    for _i in range(3):
+        with instrumentation.tick():
+            with instrumentation.phase('PluggedIn'):
+                batt_mon.is_plugged_in
+            with instrumentation.phase('Tooltip'):
+                batt_mon.tooltip
+        provider.advance(2)
+    summary = instrumentation.summary()
+    assert summary['ticks']['count'] == 3
+    assert set(summary['phases']) == {'PluggedIn', 'Tooltip'}
+    assert summary['phases']['PluggedIn']['count'] == 3
+    assert summary['queries']['BatteryStatus']['count'] > 3
+    per_tick = summary['queries_per_tick']
+    assert per_tick['mean'] * 3 == sum(h['count'] for h in summary['queries'].values())
+    assert per_tick['max'] == summary['slowest_ticks'][0]['queries']
+    slowest = summary['slowest_ticks']
+    assert [t['duration_ms'] for t in slowest] == sorted((t['duration_ms'] for t in slowest), reverse=True)
+    assert set(slowest[0]['phases']) == {'PluggedIn', 'Tooltip'}
+
+
+def test_disabled_overhead_near_zero():
+    provider, instrumentation = instrumented()
+    assert instrumentation.tick() is NULL_CONTEXT
+    assert instrumentation.phase('RefreshIcon') is NULL_CONTEXT
+
+    def tick():
+        with instrumentation.tick():
+            with instrumentation.phase('RefreshIcon'):
+                pass
+            with instrumentation.phase('CheckAlertBalloons'):
+                pass
+    tick()
+    # nothing is kept, and nothing allocated beyond the loop itself
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    tracemalloc.reset_peak()
+    for _i in range(1000):
+        tick()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert current - before < 256
+    assert peak - before < 1024
+    assert instrumentation.summary()['ticks']['count'] == 0
+    assert instrumentation.batt_mon.t is provider
+
+    # and each phase costs about what entering an empty context does
+    def bare():
+        with NULL_CONTEXT:
+            pass
+
+    def phase():
+        with instrumentation.phase('RefreshIcon'):
+            pass
+    baseline = min(timeit.repeat(bare, number=20000, repeat=7))
+    disabled = min(timeit.repeat(phase, number=20000, repeat=7))
+    assert disabled < 3 * baseline
+
+
+def busy(seconds):
+    until = time.perf_counter() + seconds
+    while time.perf_counter() < until:
+        pass
+
+
+def test_profiler_samples_this_thread():
+    profiler = SamplingProfiler(interval=0.001)
+    profiler.start()
+    busy(0.2)
+    profiler.stop()
+    assert not profiler.thread.is_alive()
+    assert profiler.samples > 10
+    lines = profiler.collapsed()
+    assert sum(int(line.rsplit(' ', 1)[1]) for line in lines) == profiler.samples
+    counts = [int(line.rsplit(' ', 1)[1]) for line in lines]
+    assert counts == sorted(counts, reverse=True)
+    assert any('busy (' in line for line in lines)
+
+
+def test_profiler_toggle():
+    _provider, instrumentation = instrumented()
+    assert instrumentation.toggle_profiler(interval=0.001)
+    profiler = instrumentation.profiler
+    assert profiler.running
+    assert not instrumentation.toggle_profiler()
+    assert not profiler.running and not profiler.thread.is_alive()
+
+
+@pytest.mark.skipif(not hasattr(signal, 'SIGUSR1'), reason='no SIGUSR1 on this platform')
+def test_signals_toggle_and_dump(tmp_path):
+    path = str(tmp_path / 'instrument.json')
+    _provider, instrumentation = instrumented()
+    handlers = signal.getsignal(signal.SIGUSR1), signal.getsignal(signal.SIGUSR2)
+    try:
+        assert instrumentation.install_signal_handlers(path)
+        os.kill(os.getpid(), signal.SIGUSR1)
+        assert instrumentation.enabled
+        assert instrumentation.profiler.running
+        with instrumentation.tick():
+            instrumentation.batt_mon.is_plugged_in
+        busy(0.05)
+        os.kill(os.getpid(), signal.SIGUSR2)
+        with open(path) as f:
+            dumped = json.load(f)
+        assert dumped['enabled']
+        assert dumped['ticks']['count'] == 1
+        assert 'BatteryStatus' in dumped['queries']
+        assert dumped['profile']
+        os.kill(os.getpid(), signal.SIGUSR1)
+        assert not instrumentation.enabled
+        assert not instrumentation.profiler.running
+    finally:
+        signal.signal(signal.SIGUSR1, handlers[0])
+        signal.signal(signal.SIGUSR2, handlers[1])
@@ -0,0 +1,78 @@
+from urllib.request import urlopen
+
+import pytest
+
+from lifesaver import monitor
+from lifesaver.daemon import Daemon
+from lifesaver.fakes import FakeProvider
+from lifesaver.metrics import CONTENT_TYPE, MetricsExporter, MetricsServer
+from lifesaver.monitor import BatteryMonitor, Snapshot
+from lifesaver.sysfs import SysfsProvider
+from lifesaver.telemetry import TelemetryAgent
+
+
+def snapshot(t, charge=0.5):
+    return Snapshot(t, False, charge * 50000, 50000, charge, 10000, 0, charge * 5)
+
+
+def test_metrics_include_telemetry_overhead():
+    frames = []
+    agent = TelemetryAgent('laptop', frames.append)
+    agent.add_sample(snapshot(1000.0))
+    agent.flush()
+    text = MetricsExporter(telemetry=agent.overhead).render().decode('utf-8')
+    assert 'lifesaver_telemetry_samples_total 1.0' in text
+    assert 'lifesaver_telemetry_frames_sent_total 1.0' in text
+    assert len(frames) == 1
+
+
+def test_ups_online_reaches_metrics(tmp_path, supply):
+    supply('ups', type='UPS', present=1, online=1, status='Full',
+           energy_now=600000000, energy_full=600000000, voltage_now=24000000)
+    exporter = MetricsExporter()
+    exporter.observe(BatteryMonitor(SysfsProvider(str(tmp_path))).snapshot())
+    assert 'lifesaver_ac_online 1' in exporter.render().decode('utf-8')
+
+
+def test_payload_cached_until_next_sample():
+    exporter = MetricsExporter()
+    exporter.observe(snapshot(1000.0))
+    first = exporter.render()
+    assert exporter.render() is first
+    exporter.record_tick(0.01)
+    ticked = exporter.render()
+    assert ticked is not first
+    assert b'lifesaver_tick_duration_seconds_count 1' in ticked
+    exporter.observe(snapshot(1002.0, 0.4))
+    assert b'lifesaver_charge_ratio 0.4' in exporter.render()
+
+
+def test_scrapes_never_read_the_battery():
+    provider = FakeProvider()
+    batt_mon = BatteryMonitor(provider)
+    exporter = MetricsExporter()
+    daemon = Daemon(batt_mon, sinks=[exporter.record_alert], observers=[exporter.observe],
+                    tick_listeners=[exporter.record_tick])
+    daemon.tick()
+    rendered = exporter.render()
+    server = MetricsServer(exporter, port=0).start()
+    try:
+        queries = provider.queries
+        for _i in range(5):
+            response = urlopen('http://127.0.0.1:%i/metrics' % server.port, timeout=5)
+            assert response.headers['Content-Type'] == CONTENT_TYPE
+            assert response.read() == rendered
+        assert provider.queries == queries
+        # the payload served is the one rendered after the last tick, not a new one
+        assert exporter.render() is rendered
+    finally:
+        server.stop()
+
+
+@pytest.mark.parametrize('option', [['--metrics-port', '9470'], ['--telemetry', 'http://collector'],
+                                    ['--history', 'bl.history'], ['--alert', 'stdout']])
+def test_daemon_options_rejected_without_daemon(option, capsys):
+    with pytest.raises(SystemExit) as exited:
+        monitor.main(option)
+    assert exited.value.code == 2
+    assert '%s can only be used with --daemon' % option[0] in capsys.readouterr().err
@@ -0,0 +1,109 @@
+from lifesaver.resume import SuspendDetector
+
+
+class Clocks(object):
+    ''' Wall, monotonic and boot time clocks which tests move independently '''
+
+    def __init__(self):
+        self.wall = 1.0e9
+        self.monotonic = 100.0
+        self.boot = 200.0
+
+    def tick(self, seconds=2):
+        self.wall += seconds
+        self.monotonic += seconds
+        self.boot += seconds
+
+    def detector(self, boottime=True):
+        return SuspendDetector(2, wall=lambda: self.wall, monotonic=lambda: self.monotonic,
+                               boottime=(lambda: self.boot) if boottime else None)
+
+
+def test_regular_ticks():
+    clocks = Clocks()
+    detector = clocks.detector()
+    for _i in range(10):
+        assert detector.check() is None
+        clocks.tick()
+
+
+def test_suspend_from_boottime():
+    clocks = Clocks()
+    detector = clocks.detector()
+    detector.check()
+    clocks.tick()
+    # the monotonic clock stops while suspended
+    clocks.wall += 3600
+    clocks.boot += 3600
+    gap = detector.check()
+    assert gap.kind == 'suspend'
+    assert gap.seconds == 3600
+    assert gap.timestamp == clocks.wall
+
+
+def test_wall_clock_alone_is_a_clock_step():
+    clocks = Clocks()
+    detector = clocks.detector(boottime=False)
+    detector.check()
+    clocks.tick()
+    clocks.wall += 600
+    gap = detector.check()
+    assert gap.kind == 'clock_step'
+    assert not gap.suspended
+
+
+def test_clock_step():
+    clocks = Clocks()
+    detector = clocks.detector()
+    detector.check()
+    clocks.tick()
+    clocks.wall -= 3600
+    gap = detector.check()
+    assert gap.kind == 'clock_step'
+    assert gap.seconds == -3600
+    clocks.tick()
+    assert detector.check() is None
+
+
+def test_suspend_with_clock_step_is_a_suspend():
+    clocks = Clocks()
+    detector = clocks.detector()
+    detector.check()
+    clocks.tick()
+    clocks.boot += 3600
+    clocks.wall += 7200
+    gap = detector.check()
+    assert gap.kind == 'suspend'
+    assert gap.suspended
+
+
+def test_long_interval_is_a_gap():
+    clocks = Clocks()
+    detector = clocks.detector()
+    detector.check()
+    clocks.tick(60)
+    gap = detector.check()
+    assert gap.kind == 'gap'
+    assert gap.seconds == 60
+
+
+def test_notify_is_reported_once():
+    clocks = Clocks()
+    detector = clocks.detector()
+    detector.check()
+    detector.notify()
+    clocks.tick()
+    assert detector.check().kind == 'suspend'
+    clocks.tick()
+    assert detector.check() is None
+
+
+def test_substitute_clock():
+    now = [1000.0]
+    detector = SuspendDetector.for_clock(2, lambda: now[0])
+    assert detector.boottime is None
+    detector.check()
+    now[0] += 2
+    assert detector.check() is None
+    now[0] += 600
+    assert detector.check().kind == 'gap'
@@ -0,0 +1,64 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from lifesaver import sources
+from lifesaver.fakes import FakeProvider
+from lifesaver.sysfs import Record
+
+
+def test_hid_device_with_capacity_only(tmp_path, supply):
+    supply('BAT0', type='Battery', present=1, status='Discharging', scope='System',
+           energy_now=30000000, energy_full=60000000, power_now=15000000, voltage_now=12000000)
+    supply('hidpp_battery_0', type='Battery', present=1, status='Discharging',
+           scope='Device', capacity=55)
+    table = sources.PowerSourceTable.from_sysfs(str(tmp_path))
+    result = sources.aggregate(table)
+    assert list(table.kind) == [sources.BATTERY, sources.DEVICE]
+    assert list(result.percentages) == [0.5, 0.55]
+    assert not result.low.any()
+    assert result.percentage_charge_remaining == 0.5
+    # the device's percentage is kept out of the capacity totals, which are all mWh
+    assert list(result.full_by_kind) == [60000, 0, 0]
+    assert list(result.remaining_by_kind) == [30000, 0, 0]
+    assert np.isnan(table.reported_charge[0])
+    assert table.reported_charge[1] == 0.55
+
+
+class MissingCapacities(FakeProvider):
+
+    def ExecQuery(self, query):
+        if 'BatteryFullChargedCapacity' in query:
+            return [Record(FullChargedCapacity=50000)]
+        return FakeProvider.ExecQuery(self, query)
+
+
+def test_fewer_capacity_rows_than_batteries():
+    table = sources.PowerSourceTable.from_provider(MissingCapacities(batteries=3, charge=0.5))
+    assert list(table.full_charge_capacity) == [50000, 0, 0]
+    result = sources.aggregate(table)
+    assert list(result.percentages) == [0.5, 0, 0]
+    assert list(result.low) == [False, False, False]
+
+
+def test_alert_flags():
+    table = sources.PowerSourceTable.from_provider(FakeProvider(charge=0.1))
+    assert sources.aggregate(table).should_plug_in
+    assert not sources.aggregate(table, plugin_alert_enabled=False).should_plug_in
+    table = sources.PowerSourceTable.from_provider(FakeProvider(charge=0.9, plugged_in=True))
+    assert sources.aggregate(table).should_unplug
+    assert not sources.aggregate(table, unplug_alert_enabled=False).should_unplug
+
+
+def test_monitor_passes_alert_flags():
+    from lifesaver.monitor import BatteryMonitor
+    batt_mon = BatteryMonitor(FakeProvider(charge=0.1))
+    assert batt_mon.power_sources().should_plug_in
+    batt_mon.plugin_alert_enabled = False
+    assert not batt_mon.power_sources().should_plug_in
+
+
+def test_no_system_battery():
+    result = sources.aggregate(sources.PowerSourceTable([]))
+    assert result.percentage_charge_remaining is None
+    assert not result.should_plug_in and not result.should_unplug
@@ -0,0 +1,32 @@
+import time
+
+import pytest
+
+from lifesaver.startup import BackgroundConnector, StartupTimeline, process_age
+
+
+def test_timeline_starts_at_process_start():
+    age = process_age()
+    if age is None:
+        pytest.skip('process start time not available on this platform')
+    timeline = StartupTimeline()
+    # this process has been running at least as long as the test session
+    assert timeline.now() >= age * 1000 - 1
+    assert timeline.lines()[0].split()[-2] == 'imports'
+
+
+def test_retry_after_failure():
+    attempts = []
+
+    def flaky():
+        attempts.append(time.time())
+        if len(attempts) == 1:
+            raise IOError('not ready')
+        return 'connection'
+
+    connector = BackgroundConnector({'battery': flaky}, timeline=StartupTimeline())
+    with pytest.raises(IOError):
+        connector.result('battery')
+    connector.retry('battery')
+    assert connector.result('battery') == 'connection'
+    assert len(attempts) == 2
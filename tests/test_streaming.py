@@ -0,0 +1,81 @@
+import asyncio
+
+from lifesaver.fakes import FakeProvider
+from lifesaver.monitor import BatteryMonitor, Snapshot
+from lifesaver.streaming import SnapshotHub, Subscription
+
+
+def snapshot(t, charge, plugged_in=False):
+    return Snapshot(t, plugged_in, charge * 50000, 50000, charge, 0 if plugged_in else 10000,
+                    25000 if plugged_in else 0, None)
+
+
+def test_streams_share_one_sampler():
+    provider = FakeProvider()
+    hub = SnapshotHub(BatteryMonitor(provider), interval=0.01)
+
+    async def take(count):
+        taken = []
+        async for snap in hub.stream(interval=0.01):
+            taken.append(snap)
+            if len(taken) == count:
+                return taken
+
+    async def run():
+        return await asyncio.gather(take(5), take(5))
+    first, second = asyncio.run(run())
+    # both streams were given the same snapshots, from one read each
+    assert [s.timestamp for s in first] == [s.timestamp for s in second]
+    assert provider.queries <= 2 * 6
+
+
+def test_slow_subscriber_loses_oldest():
+    async def run():
+        hub = SnapshotHub(BatteryMonitor(FakeProvider()))
+        slow, fast = Subscription(2), Subscription(16)
+        hub.streams.update([slow, fast])
+        for t in range(5):
+            hub.publish(snapshot(t, 0.5))
+        drain = lambda sub: [sub.queue.get_nowait().timestamp for _i in range(sub.queue.qsize())]
+        return slow.dropped, drain(slow), drain(fast)
+    dropped, slow, fast = asyncio.run(run())
+    assert dropped == 3
+    assert slow == [3, 4]
+    assert fast == [0, 1, 2, 3, 4]
+
+
+def test_sampler_stops_with_last_subscriber():
+    async def run():
+        hub = SnapshotHub(BatteryMonitor(FakeProvider()), interval=0.01)
+        streams = [hub.stream(interval=0.01), hub.events()]
+        await streams[0].__anext__()
+        events = asyncio.ensure_future(streams[1].__anext__())
+        await asyncio.sleep(0.02)
+        task = hub.task
+        await streams[0].aclose()
+        assert hub.task is task and not task.done()
+        events.cancel()
+        try:
+            await events
+        except asyncio.CancelledError:
+            pass
+        await streams[1].aclose()
+        await asyncio.sleep(0)
+        return hub, task
+    hub, task = asyncio.run(run())
+    assert hub.task is None
+    assert task.cancelled()
+
+
+def test_events_follow_monitor_alert_rules():
+    mon = BatteryMonitor(FakeProvider())
+    hub = SnapshotHub(mon)
+    kinds = lambda previous, snap: [e.kind for e in hub.detect_events(previous, snap)]
+    assert kinds(None, snapshot(0, 0.2)) == ['plugin']
+    assert kinds(snapshot(0, 0.2), snapshot(2, 0.2)) == []
+    assert kinds(snapshot(0, 0.2), snapshot(2, 0.2, True)) == ['plugged_in']
+    assert kinds(snapshot(0, 0.7, True), snapshot(2, 0.85, True)) == ['unplug']
+    assert kinds(snapshot(0, 0.99, True), snapshot(2, 1.0, True)) == ['fully_charged']
+    mon.plugin_alert_enabled = False
+    assert kinds(None, snapshot(0, 0.2)) == []
+    assert kinds(None, Snapshot(0, False, 0, 0, None, 0, 0, None)) == []
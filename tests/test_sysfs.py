@@ -0,0 +1,79 @@
+import os
+
+import pytest
+
+from lifesaver.sysfs import SysfsProvider
+
+
+@pytest.fixture
+def power_supply(tmp_path, supply):
+    supply('AC', type='Mains', online=0)
+    supply('BAT0', type='Battery', present=1, status='Discharging', scope='System',
+           energy_now=30000000, energy_full=60000000, power_now=15000000, voltage_now=12000000)
+    # a wireless mouse: only capacity, no energy, charge or rate
+    supply('hidpp_battery_0', type='Battery', present=1, status='Discharging',
+           scope='Device', capacity=55)
+    return tmp_path
+
+
+def test_device_scope_batteries_are_ignored(power_supply):
+    provider = SysfsProvider(str(power_supply))
+    assert [os.path.basename(b) for b in provider.batteries()] == ['BAT0']
+    statuses = provider.ExecQuery('Select * from BatteryStatus where Voltage > 0')
+    capacities = provider.ExecQuery('Select * from BatteryFullChargedCapacity')
+    assert [s.RemainingCapacity for s in statuses] == [30000]
+    assert [s.DischargeRate for s in statuses] == [15000]
+    assert [c.FullChargedCapacity for c in capacities] == [60000]
+
+
+def test_supply_records_include_devices(power_supply, supply):
+    supply('BAT1', type='Battery', present=0)
+    records = SysfsProvider(str(power_supply)).supply_records()
+    assert [(r.Name, r.Type, r.Scope) for r in records] == [('BAT0', 'Battery', 'System'),
+                                                            ('hidpp_battery_0', 'Battery', 'Device')]
+    battery, mouse = records
+    assert (battery.RemainingCapacity, battery.FullChargedCapacity, battery.Capacity) == (30000, 60000, None)
+    assert battery.DischargeRate == 15000 and not battery.PowerOnline
+    assert (mouse.RemainingCapacity, mouse.FullChargedCapacity, mouse.Capacity) == (0, 0, 55)
+
+
+def test_monitor_with_device_battery(power_supply):
+    from lifesaver.monitor import BatteryMonitor
+    batt_mon = BatteryMonitor(SysfsProvider(str(power_supply)))
+    assert batt_mon.percentage_charge_remaining == 0.5
+    assert batt_mon.battery_statuses == ['Battery #1: 50% available']
+    batt_mon.time_remaining_min_samples = 1
+    assert batt_mon.time_remaining == '2 hr 0 min'
+
+
+def test_no_battery(tmp_path, supply):
+    from lifesaver.daemon import Daemon
+    from lifesaver.monitor import BatteryMonitor
+    supply('AC', type='Mains', online=1)
+    batt_mon = BatteryMonitor(SysfsProvider(str(tmp_path)))
+    assert batt_mon.percentage_charge_remaining is None
+    assert batt_mon.snapshot().percentage_charge_remaining is None
+    assert batt_mon.tooltip == 'No battery information'
+    assert batt_mon.icon_name == 'battery_discharging_000'
+    assert batt_mon.check_alerts() == []
+    assert batt_mon.check_fully_charged() is None
+    snapshots = []
+    daemon = Daemon(batt_mon, sinks=[], observers=[snapshots.append],
+                    full_charge_reminder_frequency=0)
+    assert daemon.tick() == []
+    assert len(snapshots) == 1
+
+
+@pytest.mark.parametrize('attrs, online', [
+    ({'online': 1, 'status': 'Full'}, True),
+    ({'online': 0, 'status': 'Discharging'}, False),
+    ({'status': 'Charging'}, True),
+    ({'status': 'Discharging'}, False),
+])
+def test_ups_gives_ac_state(tmp_path, supply, attrs, online):
+    supply('ups', type='UPS', present=1, scope='System',
+           energy_now=500000000, energy_full=600000000, voltage_now=24000000, **attrs)
+    provider = SysfsProvider(str(tmp_path))
+    assert provider.power_online() is online
+    statuses = provider.ExecQuery('Select * from BatteryStatus where Voltage > 0')
+    assert [s.PowerOnline for s in statuses] == [online]